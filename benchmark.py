@@ -0,0 +1,355 @@
+# benchmark.py - ĐO HIỆU NĂNG CÁC ĐƯỜNG NÓNG (CHẠY OFFLINE)
+#
+# Chạy:  python benchmark.py --output bench_report.json
+# So sánh 2 phiên bản:  python benchmark.py --compare bench_old.json
+#
+# Toàn bộ request REST đi tới 1 server HTTP giả lập cục bộ (127.0.0.1),
+# không cần mạng / API key.
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import trading_bot_lib as tbl
+
+BENCH_SYMBOLS = [f"BENCH{i}USDC" for i in range(50)]
+
+# ========== DỮ LIỆU NẾN (GHI SẴN HOẶC TỔNG HỢP) ==========
+def load_klines(path=None, count=500, seed=42):
+    """
+    Đọc nến đã ghi (JSON format /fapi/v1/klines) hoặc sinh random-walk cố định seed.
+    """
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    rng = random.Random(seed)
+    klines = []
+    price = 100.0
+    open_time = 1_700_000_000_000
+    for _ in range(count):
+        o = price
+        c = max(0.01, o * (1 + rng.gauss(0, 0.004)))
+        h = max(o, c) * (1 + abs(rng.gauss(0, 0.001)))
+        l = min(o, c) * (1 - abs(rng.gauss(0, 0.001)))
+        vol = rng.uniform(500, 5000)
+        klines.append([
+            open_time, f"{o:.4f}", f"{h:.4f}", f"{l:.4f}", f"{c:.4f}", f"{vol:.3f}",
+            open_time + 299_999, f"{vol * c:.4f}", 100, "0", "0", "0"
+        ])
+        price = c
+        open_time += 300_000
+    return klines
+
+# ========== SERVER BINANCE GIẢ LẬP ==========
+class FakeExchangeState:
+    def __init__(self, klines):
+        self.klines = klines
+        self.positions = {}     # {symbol: positionAmt}
+        self.orders = {}        # {clientOrderId: order}
+        self.order_ids = 0
+        self.price = float(klines[-1][4])
+        self.exchange_info = {
+            "symbols": [
+                {
+                    "symbol": sym,
+                    "status": "TRADING",
+                    "filters": [{"filterType": "LOT_SIZE", "stepSize": "0.001", "minQty": "0.001"}]
+                }
+                for sym in BENCH_SYMBOLS
+            ]
+        }
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self):
+            parsed = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            path = parsed.path
+
+            if path == "/fapi/v1/klines":
+                limit = int(query.get("limit", 500))
+                offset = sum(map(ord, query.get("symbol", ""))) % max(1, len(state.klines) - limit)
+                return state.klines[offset:offset + limit]
+            if path == "/fapi/v1/exchangeInfo":
+                return state.exchange_info
+            if path == "/fapi/v1/leverageBracket":
+                return [{"symbol": query.get("symbol"), "brackets": [{"initialLeverage": 50}]}]
+            if path == "/fapi/v1/ticker/24hr":
+                return [
+                    {
+                        "symbol": sym, "lastPrice": f"{state.price:.4f}",
+                        "highPrice": f"{state.price * (1.02 + i * 0.001):.4f}",
+                        "lowPrice": f"{state.price * 0.98:.4f}", "quoteVolume": f"{1_000_000 + i * 5000:.2f}"
+                    }
+                    for i, sym in enumerate(BENCH_SYMBOLS)
+                ]
+            if path == "/fapi/v1/ticker/bookTicker":
+                return [
+                    {"symbol": sym, "bidPrice": f"{state.price:.4f}", "askPrice": f"{state.price * (1 + (i % 7) * 1e-4):.4f}"}
+                    for i, sym in enumerate(BENCH_SYMBOLS)
+                ]
+            if path == "/fapi/v1/ticker/price":
+                return {"symbol": query.get("symbol"), "price": f"{state.price:.4f}"}
+            if path == "/fapi/v2/positionRisk":
+                return [
+                    {
+                        "symbol": sym, "positionAmt": str(amt), "entryPrice": f"{state.price:.4f}",
+                        "unRealizedProfit": "0", "leverage": "10"
+                    }
+                    for sym, amt in state.positions.items()
+                ]
+            if path == "/fapi/v2/account":
+                return {"assets": [{"asset": "USDC", "availableBalance": "1000", "walletBalance": "1000"}]}
+            if path == "/fapi/v1/leverage":
+                return {"leverage": int(query.get("leverage", 10)), "symbol": query.get("symbol")}
+            if path == "/fapi/v1/order" and self.command == "GET":
+                order = state.orders.get(query.get("origClientOrderId"))
+                return order if order else ({"code": -2013, "msg": "Order does not exist."}, 400)
+            if path == "/fapi/v1/order":
+                state.order_ids += 1
+                client_id = query.get("newClientOrderId") or f"bench-{state.order_ids}"
+                order = {
+                    "orderId": state.order_ids, "clientOrderId": client_id, "status": "FILLED",
+                    "symbol": query.get("symbol"), "side": query.get("side"),
+                    "executedQty": query.get("quantity", "0"), "avgPrice": f"{state.price:.4f}"
+                }
+                state.orders[client_id] = order
+                return order
+            if path == "/fapi/v1/allOpenOrders":
+                return {"code": 200, "msg": "ok"}
+            if path == "/fapi/v1/time":
+                return {"serverTime": int(time.time() * 1000)}
+            return None
+
+        def _handle(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            payload = self._route()
+            if payload is None:
+                self._send({"code": -1, "msg": "not found"}, status=404)
+            elif isinstance(payload, tuple):
+                self._send(*payload)
+            else:
+                self._send(payload)
+
+        do_GET = _handle
+        do_POST = _handle
+        do_DELETE = _handle
+
+    return Handler
+
+def start_fake_exchange(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class NullWebSocketManager:
+    """WebSocketManager rỗng cho bot benchmark (không mở socket)"""
+    def add_symbol(self, symbol, callback, owner=None):
+        pass
+
+    def remove_symbol(self, symbol, owner=None):
+        pass
+
+    def stop(self):
+        pass
+
+# ========== HÀM ĐO ==========
+def measure(func, iterations, warmup=3):
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    mean = statistics.fmean(samples)
+    return {
+        "iterations": iterations,
+        "mean_ms": mean * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "min_ms": samples[0] * 1000,
+        "max_ms": samples[-1] * 1000,
+        "ops_per_sec": (1 / mean) if mean > 0 else 0,
+    }
+
+def bench_websocket_throughput(messages=20000):
+    """Đo số message trade/giây mà WebSocketManager xử lý (parse + dispatch callback)"""
+    ws_manager = tbl.WebSocketManager()
+    done = threading.Event()
+    received = [0]
+    lock = threading.Lock()
+
+    def callback(price):
+        with lock:
+            received[0] += 1
+            if received[0] >= messages:
+                done.set()
+
+    payloads = [
+        json.dumps({"e": "trade", "s": "BENCH0USDC", "p": f"{100 + i * 0.01:.2f}", "q": "0.5"})
+        for i in range(messages)
+    ]
+    t0 = time.perf_counter()
+    for msg in payloads:
+        ws_manager._handle_message("BENCH0USDC", callback, msg)
+    done.wait(timeout=60)
+    elapsed = time.perf_counter() - t0
+    ws_manager.executor.shutdown(wait=True)
+    return {
+        "messages": messages,
+        "elapsed_ms": elapsed * 1000,
+        "msgs_per_sec": messages / elapsed if elapsed > 0 else 0,
+    }
+
+def run_benchmarks(klines_path=None, quick=False):
+    scale = 0.2 if quick else 1.0
+    n = lambda x: max(5, int(x * scale))
+
+    klines = load_klines(klines_path)
+    state = FakeExchangeState(klines)
+    server = start_fake_exchange(state)
+    host, port = server.server_address
+    runtime = tbl.RuntimeContext(
+        rest_base_url=f"http://{host}:{port}",
+        ws_base_url=f"ws://{host}:{port}",
+        telegram_base_url=f"http://{host}:{port}",
+        sleep=lambda s: None
+    )
+    tbl.set_runtime(runtime)
+
+    results = {}
+    secret = "x" * 64
+    query = "symbol=BTCUSDC&side=BUY&type=MARKET&quantity=0.001&timestamp=1700000000000"
+    results["sign"] = measure(lambda: tbl.sign(query, secret), n(20000))
+
+    ticker_url = runtime.rest_url("/fapi/v1/ticker/price?symbol=BENCH0USDC")
+    results["binance_api_request"] = measure(
+        lambda: tbl.binance_api_request(ticker_url, runtime=runtime), n(500)
+    )
+
+    finder = tbl.SmartCoinFinder("key", secret, runtime=runtime)
+    closes = [float(k[4]) for k in klines[:15]]
+    results["calculate_rsi"] = measure(lambda: finder.calculate_rsi(closes), n(20000))
+    results["get_rsi_signal"] = measure(lambda: finder.get_rsi_signal("BENCH0USDC"), n(300))
+    results["universe_refresh"] = measure(
+        lambda: (runtime.market_data.invalidate("ticker_24hr"), runtime.universe.refresh()), n(50)
+    )
+    results["find_best_coin"] = measure(
+        lambda: finder.find_best_coin("BUY", excluded_coins=[], required_leverage=10), n(10), warmup=1
+    )
+
+    results["websocket_handle_message"] = bench_websocket_throughput(n(20000))
+
+    bot = tbl.BaseBot(
+        None, 10, 5, 100, 50, None, NullWebSocketManager(), "key", secret,
+        None, None, "Benchmark", bot_id="BENCH_BOT", max_coins=1,
+        runtime=runtime, auto_start=False
+    )
+    bot._add_symbol("BENCH0USDC")
+
+    def idle_pass():
+        data = bot.symbol_data["BENCH0USDC"]
+        data.last_position_check = 0
+        data.last_close_time = runtime.time()
+        bot._process_single_symbol("BENCH0USDC")
+
+    results["process_single_symbol_idle"] = measure(idle_pass, n(200))
+
+    state.positions["BENCH0USDC"] = 1.0
+
+    def open_pass():
+        data = bot.symbol_data["BENCH0USDC"]
+        data.last_position_check = 0
+        data.last_average_down_time = runtime.time()
+        bot._process_single_symbol("BENCH0USDC")
+
+    results["process_single_symbol_open"] = measure(open_pass, n(200))
+    state.positions.clear()
+
+    server.shutdown()
+    tbl.set_runtime(None)
+    return results
+
+def build_report(results):
+    try:
+        import numpy as np
+        numpy_version = np.__version__
+    except Exception:
+        numpy_version = None
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": numpy_version,
+            "git_rev": os.popen("git rev-parse --short HEAD 2>/dev/null").read().strip() or None,
+        },
+        "results": results,
+    }
+
+def compare_reports(old, new):
+    """In % thay đổi mean_ms (hoặc msgs_per_sec) giữa 2 report"""
+    lines = []
+    for name, cur in new["results"].items():
+        prev = old.get("results", {}).get(name)
+        if not prev:
+            lines.append(f"{name:32s} (mới)")
+            continue
+        key = "mean_ms" if "mean_ms" in cur else "msgs_per_sec"
+        if not prev.get(key):
+            continue
+        change = (cur[key] - prev[key]) / prev[key] * 100
+        lines.append(f"{name:32s} {key}: {prev[key]:.4f} -> {cur[key]:.4f} ({change:+.1f}%)")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các đường nóng của trading_bot_lib")
+    parser.add_argument("--output", default="bench_report.json", help="file JSON kết quả")
+    parser.add_argument("--klines", default=None, help="file JSON nến đã ghi (format /fapi/v1/klines)")
+    parser.add_argument("--compare", default=None, help="report JSON cũ để so sánh")
+    parser.add_argument("--quick", action="store_true", help="giảm số vòng lặp")
+    args = parser.parse_args()
+
+    report = build_report(run_benchmarks(args.klines, quick=args.quick))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    for name, res in report["results"].items():
+        if "mean_ms" in res:
+            print(f"{name:32s} mean={res['mean_ms']:.4f}ms p95={res['p95_ms']:.4f}ms")
+        else:
+            print(f"{name:32s} {res['msgs_per_sec']:.0f} msg/s")
+    print(f"📄 Đã ghi report: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print(compare_reports(json.load(f), report))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 # main.py
-from trading_bot_lib import BotManager
+import time
+STARTUP_T0 = time.perf_counter()    # đo thời gian khởi động (tính cả import)
+
+from trading_bot_lib import BotManager, ShardedBotManager, RuntimeContext
 import os
 import json
-import time
+import signal
+import logging
 
 # Lấy cấu hình từ biến môi trường
 BINANCE_API_KEY = os.getenv('BINANCE_API_KEY', '')
@@ -16,6 +20,49 @@ print(f"BINANCE_SECRET_KEY: {'***' if BINANCE_SECRET_KEY else 'Không có'}")
 print(f"TELEGRAM_BOT_TOKEN: {'***' if TELEGRAM_BOT_TOKEN else 'Không có'}")
 print(f"TELEGRAM_CHAT_ID: {TELEGRAM_CHAT_ID if TELEGRAM_CHAT_ID else 'Không có'}")
 
+# Base URL / đồng hồ ảo (để chạy với simulator cục bộ)
+BINANCE_REST_URL = os.getenv('BINANCE_REST_URL', 'https://fapi.binance.com')
+BINANCE_WS_URL = os.getenv('BINANCE_WS_URL', 'wss://fstream.binance.com')
+SIM_CLOCK_SPEED = float(os.getenv('SIM_CLOCK_SPEED', '0') or 0)
+
+# Cổng endpoint /metrics (0 = tắt)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0') or 0)
+
+# Profiling vòng lặp bot: BOT_PROFILING=1, cProfile mẫu mỗi N vòng vào BOT_CPROFILE_DIR
+BOT_PROFILING = os.getenv('BOT_PROFILING', '0') == '1'
+BOT_CPROFILE_DIR = os.getenv('BOT_CPROFILE_DIR', '') or None
+BOT_CPROFILE_EVERY = int(os.getenv('BOT_CPROFILE_EVERY', '0') or 0)
+
+# File SQLite lưu trạng thái bot để khôi phục sau restart ('' = tắt)
+STATE_DB = os.getenv('STATE_DB', 'bot_state.db')
+# File SQLite nhật ký giao dịch ('' = tắt)
+TRADE_JOURNAL_DB = os.getenv('TRADE_JOURNAL_DB', 'trade_journal.db')
+
+# Số worker process chạy bot (>1 = chế độ supervisor, bot chia theo consistent hashing)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '0') or 0)
+
+# Dịch vụ giữ coin dùng chung giữa nhiều process/replica: đường dẫn Unix socket hoặc host:port ('' = tắt)
+COIN_SERVICE = os.getenv('COIN_SERVICE', '')
+# Khóa dùng chung cho dịch vụ giữ coin qua TCP (host:port bắt buộc có; Unix socket không cần)
+COIN_SERVICE_AUTHKEY = os.getenv('COIN_SERVICE_AUTHKEY', '')
+
+# Bảng giá toàn thị trường qua 1 WebSocket (!miniTicker@arr + !markPrice@arr@1s); mặc định tắt khi chạy simulator
+MARKET_STREAM = os.getenv('MARKET_STREAM', '0' if SIM_CLOCK_SPEED > 0 else '1') == '1'
+
+# Khung xác nhận tín hiệu RSI 5m, vd "15m,1h" (nến gộp từ trade stream); '' = chỉ 5m
+SIGNAL_CONFIRM_TIMEFRAMES = tuple(
+    tf.strip() for tf in os.getenv('SIGNAL_CONFIRM_TIMEFRAMES', '').split(',') if tf.strip()
+)
+
+# Tài khoản phụ chạy chung process (JSON): {"sub1": {"api_key": "...", "api_secret": "..."}}
+# Bot chọn tài khoản bằng "account_id" trong cấu hình dạng dict của BOT_CONFIGS
+try:
+    BINANCE_ACCOUNTS = json.loads(os.getenv('BINANCE_ACCOUNTS', '{}') or '{}')
+except Exception as e:
+    print(f"Lỗi phân tích cấu hình BINANCE_ACCOUNTS: {e}")
+    BINANCE_ACCOUNTS = {}
+print(f"BINANCE_ACCOUNTS: {', '.join(BINANCE_ACCOUNTS) if BINANCE_ACCOUNTS else 'Không có'}")
+
 # Cấu hình bot từ biến môi trường (dạng JSON)
 bot_config_json = os.getenv('BOT_CONFIGS', '[]')
 try:
@@ -32,29 +79,82 @@ def main():
     
     print("🟢 Đang khởi động hệ thống bot...")
     
+    if SIM_CLOCK_SPEED > 0:
+        runtime = RuntimeContext.simulated(BINANCE_REST_URL, BINANCE_WS_URL, speed=SIM_CLOCK_SPEED)
+        print(f"⏩ Chạy với đồng hồ ảo x{SIM_CLOCK_SPEED}: {BINANCE_REST_URL}")
+    else:
+        runtime = RuntimeContext(rest_base_url=BINANCE_REST_URL, ws_base_url=BINANCE_WS_URL)
+    
     # Khởi tạo hệ thống
-    manager = BotManager(
+    options = dict(
         api_key=BINANCE_API_KEY,
         api_secret=BINANCE_SECRET_KEY,
         telegram_bot_token=TELEGRAM_BOT_TOKEN,
-        telegram_chat_id=TELEGRAM_CHAT_ID
+        telegram_chat_id=TELEGRAM_CHAT_ID,
+        runtime=runtime,
+        metrics_port=METRICS_PORT,
+        profiling=BOT_PROFILING,
+        cprofile_dir=BOT_CPROFILE_DIR,
+        cprofile_every=BOT_CPROFILE_EVERY,
+        state_db=STATE_DB or None,
+        journal_db=TRADE_JOURNAL_DB or None,
+        coin_service=COIN_SERVICE or None,
+        coin_authkey=COIN_SERVICE_AUTHKEY or None,
+        market_stream=MARKET_STREAM,
+        confirm_timeframes=SIGNAL_CONFIRM_TIMEFRAMES
     )
+    if BOT_WORKERS > 1 and SIM_CLOCK_SPEED > 0:
+        print("⚠️ BOT_WORKERS bị bỏ qua khi chạy đồng hồ ảo (SIM_CLOCK_SPEED)")
+    if BOT_WORKERS > 1 and SIM_CLOCK_SPEED <= 0:
+        manager = ShardedBotManager(workers=BOT_WORKERS, accounts=BINANCE_ACCOUNTS, **options)
+        print(f"🧩 Chạy {BOT_WORKERS} worker process")
+    else:
+        manager = BotManager(**options)
+    
+    # kill -USR1 <pid> → in profile hiện tại ra stdout
+    if BOT_PROFILING and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print(manager.dump_profile(), flush=True))
     if not manager.running:
         print("🔴 BotManager.running đã bị đặt thành False ngay sau khởi tạo!")
     
-    # Thêm các bot từ cấu hình
+    for account_id, keys in BINANCE_ACCOUNTS.items():
+        manager.add_account(account_id, keys["api_key"], keys["api_secret"])
+    
+    # Khôi phục bot đã lưu (sau khi Railway restart)
+    restored = manager.restore_bots()
+    if restored:
+        print(f"♻️ Đã khôi phục {restored} bot từ {STATE_DB}")
+    
+    # Thêm các bot từ cấu hình: 1 lần kiểm tra API + 1 snapshot vị thế, bot khởi động song song
     if BOT_CONFIGS:
         print(f"🟢 Đang khởi động {len(BOT_CONFIGS)} bot từ cấu hình...")
-        for config in BOT_CONFIGS:
-            if len(config) >= 6:
-                symbol, lev, percent, tp, sl, strategy = config[0], config[1], config[2], config[3], config[4], config[5]
-                if manager.add_bot(symbol, lev, percent, tp, sl, strategy):
-                    print(f"✅ Bot {strategy} cho {symbol} khởi động thành công")
-                else:
-                    print(f"❌ Bot {strategy} cho {symbol} khởi động thất bại")
+        for result in manager.add_bots(BOT_CONFIGS, timeout=30):
+            config = BOT_CONFIGS[result["index"]]
+            if isinstance(config, dict):
+                name = f"{config.get('strategy_type')} cho {config.get('symbol')} [{config.get('account_id', 'main')}]"
+            elif isinstance(config, list) and len(config) >= 6:
+                name = f"{config[5]} cho {config[0]}"
+            else:
+                name = str(config)
+            if result["ok"]:
+                startup = f"{result['startup_ms']:.0f}ms" if result["startup_ms"] is not None else "chưa xong"
+                print(f"✅ Bot {name} khởi động thành công ({result['bot_id']}, tạo {result['create_ms']:.0f}ms, sẵn sàng {startup})")
+            elif result["skipped"]:
+                print(f"♻️ Bot {name} đã được khôi phục, bỏ qua")
+            else:
+                print(f"❌ Bot {name} khởi động thất bại: {result['error']}")
     else:
         print("⚠️ Không tìm thấy cấu hình bot! Vui lòng thiết lập biến môi trường BOT_CONFIGS.")
     
+    if manager.bots:
+        ready = manager.wait_until_ready(timeout=30, since=STARTUP_T0)
+        if ready["first_ready"] is not None:
+            all_ready = f"{ready['all_ready']:.2f}s" if ready["all_ready"] is not None else "chưa xong"
+            print(
+                f"🚀 Bot đầu tiên sẵn sàng sau {ready['first_ready']:.2f}s | "
+                f"{ready['ready']}/{ready['total']} bot sẵn sàng ({all_ready})"
+            )
+    
     try:
         print("🟢 Hệ thống đã sẵn sàng. Đang chạy...")
         # Giữ chương trình chạy
@@ -63,12 +163,18 @@ def main():
             
     except KeyboardInterrupt:
         print("\n👋 Nhận tín hiệu dừng từ người dùng...")
-        manager.log("👋 Nhận tín hiệu dừng từ người dùng...")
+        manager.log("👋 Nhận tín hiệu dừng từ người dùng...", logging.INFO, event="shutdown")
     except Exception as e:
         print(f"❌ LỖI HỆ THỐNG: {str(e)}")
-        manager.log(f"❌ LỖI HỆ THỐNG: {str(e)}")
+        manager.log(f"❌ LỖI HỆ THỐNG: {str(e)}", logging.ERROR, event="system_error")
     finally:
         manager.stop_all()
+        manager.shutdown()
+        # gửi nốt các thông báo Telegram còn trong hàng đợi
+        if manager.notifier:
+            manager.notifier.flush(timeout=10)
+        if manager.journal:
+            manager.journal.close()
 
 if __name__ == "__main__":
     main()
@@ -2,61 +2,680 @@
 import json
 import hmac
 import hashlib
+import importlib
+import bisect
+import copy
+import multiprocessing
+import socket
+import socketserver
+import sys
+import tempfile
 import time
 import threading
 import urllib.request
 import urllib.parse
-import numpy as np
-import websocket
 import logging
-import requests
+import logging.handlers
+import atexit
 import os
-import math
 import traceback
 import random
+import queue
+import shutil
+import sqlite3
 from datetime import datetime
+from decimal import Decimal, ROUND_FLOOR
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
-import time
+from collections import defaultdict, deque
 import ssl
 
+# ========== IMPORT TRỄ MODULE NẶNG ==========
+class _LazyModule:
+    """Chỉ import module ở lần truy cập thuộc tính đầu tiên (import trading_bot_lib nhanh hơn)"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+np = _LazyModule("numpy")
+requests = _LazyModule("requests")
+websocket = _LazyModule("websocket")
+
 # ========== BYPASS SSL VERIFICATION ==========
 ssl._create_default_https_context = ssl._create_unverified_context
 
-def _last_closed_1m_quote_volume(symbol):
-    data = binance_api_request(
-        "https://fapi.binance.com/fapi/v1/klines",
-        params={"symbol": symbol, "interval": "1m", "limit": 2}
-    )
-    if not data or len(data) < 2:
-        return None
-    k = data[-2]               # nến 1m đã đóng gần nhất
-    return float(k[7])         # quoteVolume (USDC)
-
 # ========== CẤU HÌNH LOGGING ==========
-def setup_logging():
+LOG_FIELDS = ("bot_id", "symbol", "event", "latency_ms")
+
+class JsonLogFormatter(logging.Formatter):
+    """Mỗi record là 1 dòng JSON (kèm bot_id / symbol / event / latency_ms nếu có)"""
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+class _EnqueueOnlyHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler không format trên luồng gọi: chi phí trên hot path chỉ là 1 lần enqueue.
+    (record đi qua queue trong cùng process nên không cần prepare/pickle)
+    """
+    def prepare(self, record):
+        return record
+
+_log_listener = None
+
+def setup_logging(log_file="trading_bot_errors.log", level=logging.WARNING,
+                  max_bytes=10 * 1024 * 1024, backup_count=5, rotate_when=None, json_file=True):
+    """
+    Logger "trading_bot_lib" ghi qua QueueHandler → QueueListener (thread riêng):
+    - console: dạng text như cũ
+    - file: JSON lines, xoay vòng theo dung lượng (max_bytes) hoặc thời gian (rotate_when='midnight', ...)
+    """
+    global _log_listener
     logger = logging.getLogger("trading_bot_lib")
-    logger.setLevel(logging.WARNING)  # chỉ log WARNING/ERROR trở lên
+    logger.setLevel(level)  # mặc định chỉ log WARNING/ERROR trở lên
 
     if not logger.handlers:
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.WARNING)
         formatter = logging.Formatter(
             '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
         )
+        ch = logging.StreamHandler()
+        ch.setLevel(level)
         ch.setFormatter(formatter)
-        logger.addHandler(ch)
 
-        fh = logging.FileHandler("trading_bot_errors.log", encoding="utf-8")
-        fh.setLevel(logging.WARNING)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        if rotate_when:
+            fh = logging.handlers.TimedRotatingFileHandler(
+                log_file, when=rotate_when, backupCount=backup_count, encoding="utf-8"
+            )
+        else:
+            fh = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+            )
+        fh.setLevel(level)
+        fh.setFormatter(JsonLogFormatter() if json_file else formatter)
+
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(_EnqueueOnlyHandler(log_queue))
+        logger.propagate = False
+
+        _log_listener = logging.handlers.QueueListener(
+            log_queue, ch, fh, respect_handler_level=True
+        )
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
 
     return logger
 
 logger = setup_logging()
 
+# ========== NGỮ CẢNH RUNTIME (BASE URL + ĐỒNG HỒ) ==========
+class VirtualClock:
+    """
+    Đồng hồ ảo tăng tốc cho simulator cục bộ.
+    speed=1440 → 1 ngày giao dịch chạy trong 1 phút thực.
+    """
+    def __init__(self, start=None, speed=1.0):
+        self.speed = float(speed) if speed and speed > 0 else 1.0
+        self._start_virtual = float(start) if start is not None else time.time()
+        self._start_real = time.monotonic()
+        self._offset = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._start_real
+            return self._start_virtual + elapsed * self.speed + self._offset
+
+    def sleep(self, seconds):
+        if seconds and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def advance(self, seconds):
+        """Nhảy đồng hồ ảo về phía trước (không chờ thực)"""
+        with self._lock:
+            self._offset += float(seconds)
+
+class RuntimeContext:
+    """
+    Gom base URL và đồng hồ dùng chung cho các hàm API, WebSocket và bot.
+    Mặc định trỏ tới Binance/Telegram thật với time.time/time.sleep.
+    """
+    def __init__(
+        self,
+        rest_base_url="https://fapi.binance.com",
+        ws_base_url="wss://fstream.binance.com",
+        telegram_base_url="https://api.telegram.org",
+        clock=None,
+        sleep=None
+    ):
+        self.rest_base_url = rest_base_url.rstrip("/")
+        self.ws_base_url = ws_base_url.rstrip("/")
+        self.telegram_base_url = telegram_base_url.rstrip("/")
+        self.clock = clock or time.time
+        self.sleep_func = sleep or time.sleep
+        self._market_data = None
+        self._universe = None
+        self._prices = None
+        self._symbols = None
+        self._server_clock = None
+        self._breakers = {}
+        self._single_flight = None
+        self._candles = None
+        self._market_data_lock = threading.RLock()   # property lazy có thể lồng nhau (prices -> symbols)
+
+    @classmethod
+    def simulated(cls, rest_base_url, ws_base_url, speed=1.0, start=None,
+                  telegram_base_url="https://api.telegram.org"):
+        """Tạo context cho simulator cục bộ với đồng hồ ảo tăng tốc"""
+        vclock = VirtualClock(start=start, speed=speed)
+        return cls(
+            rest_base_url=rest_base_url,
+            ws_base_url=ws_base_url,
+            telegram_base_url=telegram_base_url,
+            clock=vclock.time,
+            sleep=vclock.sleep
+        )
+
+    @property
+    def market_data(self):
+        """Cache dữ liệu thị trường dùng chung cho mọi bot / tài khoản trên context này"""
+        if self._market_data is None:
+            with self._market_data_lock:
+                if self._market_data is None:
+                    self._market_data = MarketDataCache(self)
+        return self._market_data
+
+    @property
+    def symbols(self):
+        """Registry symbol -> id dày + metadata (stream, filter) dùng chung trên context này"""
+        if self._symbols is None:
+            with self._market_data_lock:
+                if self._symbols is None:
+                    self._symbols = SymbolRegistry(self)
+        return self._symbols
+
+    @property
+    def universe(self):
+        """Bảng xếp hạng coin (ticker 24h, làm mới nền) dùng chung trên context này"""
+        if self._universe is None:
+            with self._market_data_lock:
+                if self._universe is None:
+                    self._universe = UniverseRanker(self)
+        return self._universe
+
+    @property
+    def prices(self):
+        """Bảng giá toàn thị trường (stream !miniTicker@arr / !markPrice@arr@1s) dùng chung"""
+        if self._prices is None:
+            with self._market_data_lock:
+                if self._prices is None:
+                    self._prices = UniversePriceTable(self)
+        return self._prices
+
+    @property
+    def server_clock(self):
+        """Giờ server Binance (offset + recvWindow) cho request ký trên context này"""
+        if self._server_clock is None:
+            with self._market_data_lock:
+                if self._server_clock is None:
+                    self._server_clock = ServerClock(self)
+        return self._server_clock
+
+    @property
+    def candles(self):
+        """Nến đa khung dựng từ trade stream của các symbol đang theo dõi"""
+        if self._candles is None:
+            with self._market_data_lock:
+                if self._candles is None:
+                    self._candles = CandleStore(self)
+        return self._candles
+
+    @property
+    def single_flight(self):
+        """Gộp GET REST giống hệt đang chạy đồng thời trên context này"""
+        if self._single_flight is None:
+            with self._market_data_lock:
+                if self._single_flight is None:
+                    self._single_flight = SingleFlight()
+        return self._single_flight
+
+    def circuit_breaker(self, group):
+        """Circuit breaker dùng chung theo nhóm endpoint (order / account / market)"""
+        breaker = self._breakers.get(group)
+        if breaker is None:
+            with self._market_data_lock:
+                breaker = self._breakers.get(group)
+                if breaker is None:
+                    breaker = self._breakers[group] = CircuitBreaker(group, self.time)
+        return breaker
+
+    def close(self):
+        """Dừng các thread nền đã khởi tạo (bảng giá toàn thị trường, bảng xếp hạng coin)"""
+        with self._market_data_lock:
+            daemons = (self._prices, self._universe)
+        for daemon in daemons:
+            if daemon is not None:
+                daemon.stop()
+
+    def time(self):
+        return self.clock()
+
+    def sleep(self, seconds):
+        self.sleep_func(seconds)
+
+    def rest_url(self, path):
+        return f"{self.rest_base_url}{path}"
+
+    def ws_url(self, stream):
+        return f"{self.ws_base_url}/ws/{stream}"
+
+    def ws_combined_url(self, streams):
+        return f"{self.ws_base_url}/stream?streams={'/'.join(streams)}"
+
+    def telegram_url(self, bot_token, method):
+        return f"{self.telegram_base_url}/bot{bot_token}/{method}"
+
+_runtime = RuntimeContext()
+
+def get_runtime():
+    return _runtime
+
+def set_runtime(runtime):
+    """Thay context mặc định cho toàn thư viện (dùng cho simulator / test hiệu năng)"""
+    global _runtime
+    _runtime = runtime or RuntimeContext()
+    return _runtime
+
+# ========== METRICS (PROMETHEUS TEXT FORMAT) ==========
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in items)
+    return "{" + body + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] += value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(_label_key(labels), None)
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # {label_key: [bucket_counts..., sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, entry in self._values.items():
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', str(bound))])} {entry[i]}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {entry[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {entry[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {entry[-1]}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Registry metrics tối giản (không phụ thuộc prometheus_client).
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+# --- metrics cho REST Binance ---
+API_LATENCY = metrics.histogram("binance_request_duration_seconds", "Độ trễ request REST Binance theo endpoint")
+API_STATUS = metrics.counter("binance_http_status_total", "Số response theo endpoint và HTTP status")
+API_RETRIES = metrics.counter("binance_request_retries_total", "Số lần retry request REST theo endpoint")
+API_FAILURES = metrics.counter("binance_request_failures_total", "Số request thất bại sau khi hết retry")
+API_RATE_LIMITED = metrics.counter("binance_rate_limited_total", "Số response 429/418 theo endpoint")
+API_USED_WEIGHT = metrics.gauge("binance_used_weight_1m", "Weight đã dùng trong 1 phút (X-MBX-USED-WEIGHT-1M)")
+# --- metrics cho Telegram ---
+TELEGRAM_LATENCY = metrics.histogram("telegram_send_duration_seconds", "Độ trễ gửi tin Telegram")
+TELEGRAM_STATUS = metrics.counter("telegram_send_total", "Số lần gửi Telegram theo kết quả")
+# --- metrics cho WebSocket ---
+WS_MESSAGES = metrics.counter("ws_messages_total", "Số message WebSocket đã xử lý")
+WS_ERRORS = metrics.counter("ws_errors_total", "Số lỗi WebSocket theo loại")
+WS_RECONNECTS = metrics.counter("ws_reconnects_total", "Số lần reconnect WebSocket")
+WS_HANDLE_LATENCY = metrics.histogram(
+    "ws_message_handle_seconds", "Thời gian parse + dispatch 1 message WebSocket",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+)
+WS_CONNECTIONS = metrics.gauge("ws_connections", "Số kết nối WebSocket đang mở")
+# --- metrics cho bot ---
+BOT_OPEN_POSITIONS = metrics.gauge("bot_open_positions", "Số vị thế đang mở theo bot")
+BOT_ACTIVE_SYMBOLS = metrics.gauge("bot_active_symbols", "Số coin đang quản lý theo bot")
+BOT_LOOP_SECONDS = metrics.gauge("bot_loop_iteration_seconds", "Thời gian vòng lặp _run gần nhất theo bot")
+BOT_LOOP_LATENCY = metrics.histogram("bot_loop_iteration_duration_seconds", "Phân bố thời gian vòng lặp _run")
+BOT_STARTUP_SECONDS = metrics.gauge("bot_startup_seconds", "Thời gian khởi động (bootstrap) của bot")
+
+def _endpoint_label(url):
+    try:
+        return urllib.parse.urlparse(url).path or url
+    except Exception:
+        return "unknown"
+
+def _record_used_weight(headers):
+    if not headers:
+        return
+    weight = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("x-mbx-used-weight-1m")
+    if weight:
+        try:
+            API_USED_WEIGHT.set(float(weight))
+        except ValueError:
+            pass
+
+class MetricsServer:
+    """
+    HTTP server cục bộ phục vụ /metrics (Prometheus text format).
+    Mặc định chỉ nghe trên 127.0.0.1; truyền host="0.0.0.0" nếu Prometheus scrape từ máy khác.
+    """
+    def __init__(self, registry=None, host="127.0.0.1", port=9100):
+        self.registry = registry or metrics
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+            return True
+        except Exception as e:
+            logger.error(f"Lỗi khởi động metrics server cổng {self.port}: {str(e)}")
+            self._server = None
+            return False
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# ========== PROFILING VÒNG LẶP BOT ==========
+_rest_local = threading.local()
+_cprofile_lock = threading.Lock()   # cProfile chỉ chạy 1 phiên tại 1 thời điểm
+
+def _count_rest_call():
+    _rest_local.calls = getattr(_rest_local, "calls", 0) + 1
+
+def rest_calls_in_thread():
+    """Tổng số request REST đã gọi từ thread hiện tại"""
+    return getattr(_rest_local, "calls", 0)
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+class _PhaseTimer:
+    __slots__ = ("profiler", "phase", "symbol", "started", "rest_before")
+
+    def __init__(self, profiler, phase, symbol):
+        self.profiler = profiler
+        self.phase = phase
+        self.symbol = symbol
+
+    def __enter__(self):
+        self.rest_before = rest_calls_in_thread()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(
+            self.phase,
+            time.perf_counter() - self.started,
+            rest_calls_in_thread() - self.rest_before,
+            symbol=self.symbol
+        )
+        return False
+
+class LoopProfiler:
+    """
+    Ghi thời gian từng pha + số request REST của mỗi vòng _run (theo bot và theo symbol),
+    gom thành percentile trên cửa sổ trượt. Có thể lấy mẫu cProfile ra đĩa.
+    """
+    def __init__(self, name, window=500, cprofile_dir=None, cprofile_every=0):
+        self.name = name
+        self.window = window
+        self.cprofile_dir = cprofile_dir
+        self.cprofile_every = int(cprofile_every or 0)
+        self.iterations = 0
+        self._phases = {}           # {(symbol, phase): {"time": deque, "rest": deque}}
+        self._lock = threading.Lock()
+        self._iteration_started = 0
+        self._iteration_rest = 0
+        self._cprofile = None
+
+    def phase(self, name, symbol=None):
+        return _PhaseTimer(self, name, symbol)
+
+    def record(self, phase, elapsed, rest_calls=0, symbol=None):
+        key = (symbol, phase)
+        with self._lock:
+            entry = self._phases.get(key)
+            if entry is None:
+                entry = {"time": deque(maxlen=self.window), "rest": deque(maxlen=self.window)}
+                self._phases[key] = entry
+            entry["time"].append(elapsed)
+            entry["rest"].append(rest_calls)
+
+    def begin_iteration(self):
+        self.iterations += 1
+        self._iteration_started = time.perf_counter()
+        self._iteration_rest = rest_calls_in_thread()
+        if (
+            self.cprofile_dir
+            and self.cprofile_every > 0
+            and self.iterations % self.cprofile_every == 0
+            and _cprofile_lock.acquire(blocking=False)
+        ):
+            import cProfile
+            try:
+                self._cprofile = cProfile.Profile()
+                self._cprofile.enable()
+            except Exception as e:
+                logger.error(f"Lỗi bật cProfile {self.name}: {str(e)}")
+                self._cprofile = None
+                _cprofile_lock.release()
+
+    def end_iteration(self):
+        self.record(
+            "iteration",
+            time.perf_counter() - self._iteration_started,
+            rest_calls_in_thread() - self._iteration_rest
+        )
+        if self._cprofile is not None:
+            try:
+                self._cprofile.disable()
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                path = os.path.join(self.cprofile_dir, f"{self.name}_{self.iterations}.prof")
+                self._cprofile.dump_stats(path)
+            except Exception as e:
+                logger.error(f"Lỗi ghi cProfile {self.name}: {str(e)}")
+            finally:
+                self._cprofile = None
+                _cprofile_lock.release()
+
+    def summary(self):
+        """{(symbol, phase): {count, p50, p90, p99, max, rest_avg}} (thời gian tính bằng ms)"""
+        with self._lock:
+            snapshot = {k: (list(v["time"]), list(v["rest"])) for k, v in self._phases.items()}
+        result = {}
+        for key, (times, rests) in snapshot.items():
+            times.sort()
+            result[key] = {
+                "count": len(times),
+                "p50": _percentile(times, 50) * 1000,
+                "p90": _percentile(times, 90) * 1000,
+                "p99": _percentile(times, 99) * 1000,
+                "max": times[-1] * 1000 if times else 0,
+                "rest_avg": sum(rests) / len(rests) if rests else 0,
+            }
+        return result
+
+    def format_report(self):
+        summary = self.summary()
+        if not summary:
+            return f"⏱️ {self.name}: chưa có dữ liệu"
+        lines = [f"⏱️ <b>{self.name}</b> ({self.iterations} vòng)"]
+        for (symbol, phase), s in sorted(summary.items(), key=lambda kv: (kv[0][0] or "", kv[0][1])):
+            label = f"{symbol}/{phase}" if symbol else phase
+            lines.append(
+                f"• {label}: p50 {s['p50']:.1f}ms | p90 {s['p90']:.1f}ms | "
+                f"p99 {s['p99']:.1f}ms | REST {s['rest_avg']:.1f}"
+            )
+        return "\n".join(lines)
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _NullProfiler:
+    """Profiler rỗng khi tắt profiling (không tốn chi phí đo)"""
+    def phase(self, name, symbol=None):
+        return _NULL_PHASE
+
+    def begin_iteration(self):
+        pass
+
+    def end_iteration(self):
+        pass
+
+    def format_report(self):
+        return ""
+
+NULL_PROFILER = _NullProfiler()
+
 # ========== HÀM HỖ TRỢ TELEGRAM ==========
 def escape_html(text: str) -> str:
     if not text:
@@ -69,7 +688,7 @@ def escape_html(text: str) -> str:
     )
 
 def send_telegram(message, chat_id=None, reply_markup=None,
-                  bot_token=None, default_chat_id=None):
+                  bot_token=None, default_chat_id=None, runtime=None):
     """
     Gửi message Telegram (HTML mode).
     Format hàm giữ nguyên như bản gốc.
@@ -83,7 +702,15 @@ def send_telegram(message, chat_id=None, reply_markup=None,
         logger.warning("Telegram Chat ID chưa được thiết lập")
         return False
 
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    ok, _ = _post_telegram_message(message, chat_id, reply_markup, bot_token, runtime)
+    return ok
+
+def _post_telegram_message(message, chat_id, reply_markup, bot_token, runtime=None):
+    """
+    Gọi sendMessage. Trả về (ok, retry_after) - retry_after (giây) khi bị 429.
+    """
+    runtime = runtime or get_runtime()
+    url = runtime.telegram_url(bot_token, "sendMessage")
     safe_message = escape_html(message)
 
     payload = {
@@ -94,16 +721,171 @@ def send_telegram(message, chat_id=None, reply_markup=None,
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup)
 
+    started = time.perf_counter()
     try:
         response = requests.post(url, json=payload, timeout=15)
+        TELEGRAM_LATENCY.observe(time.perf_counter() - started)
+        TELEGRAM_STATUS.inc(status=response.status_code)
         if response.status_code == 200:
-            return True
-        else:
-            logger.error(f"Lỗi Telegram ({response.status_code}): {response.text}")
-            return False
+            return True, None
+        retry_after = None
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get("parameters", {}).get("retry_after", 1))
+            except Exception:
+                retry_after = 1.0
+        logger.error(f"Lỗi Telegram ({response.status_code}): {response.text}")
+        return False, retry_after
     except Exception as e:
+        TELEGRAM_STATUS.inc(status="error")
         logger.error(f"Lỗi kết nối Telegram: {str(e)}")
-        return False
+        return False, None
+
+# ========== TELEGRAM NOTIFIER (GỬI NỀN, KHÔNG CHẶN LUỒNG GIAO DỊCH) ==========
+TELEGRAM_MAX_MESSAGE_LEN = 4000   # giới hạn Telegram là 4096 ký tự, chừa chỗ cho escape HTML
+NOTIFY_QUEUED = metrics.counter("telegram_notify_queued_total", "Số thông báo đưa vào hàng đợi")
+NOTIFY_DROPPED = metrics.counter("telegram_notify_dropped_total", "Số thông báo bị bỏ do hàng đợi đầy")
+NOTIFY_COALESCED = metrics.counter("telegram_notify_coalesced_total", "Số thông báo được gộp vào tin khác")
+NOTIFY_QUEUE_DEPTH = metrics.gauge("telegram_notify_queue_depth", "Độ dài hàng đợi thông báo Telegram")
+
+class TelegramNotifier:
+    """
+    Dispatcher nền cho thông báo Telegram:
+    - hàng đợi giới hạn, notify() không bao giờ chặn (đầy → bỏ + đếm)
+    - giới hạn tốc độ theo chat (mặc định 1 tin/giây/chat, 30 tin/giây tổng) + tôn trọng retry_after
+    - gộp các tin liên tiếp cùng chat thành 1 tin (tối đa ~4000 ký tự)
+    """
+    def __init__(self, bot_token, default_chat_id=None, runtime=None, max_queue=1000,
+                 per_chat_interval=1.0, global_rate=30, coalesce_window=0.5):
+        self.bot_token = bot_token
+        self.default_chat_id = default_chat_id
+        self.runtime = runtime or get_runtime()
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate else 0
+        self.coalesce_window = coalesce_window
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = None            # item đã lấy ra nhưng khác chat, chờ vòng sau
+        self._last_sent_per_chat = {}
+        self._last_sent = 0
+        self._stop_event = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def notify(self, message, chat_id=None, reply_markup=None):
+        chat_id = chat_id or self.default_chat_id
+        if not self.bot_token or not chat_id:
+            return False
+        try:
+            self._idle.clear()
+            self._queue.put_nowait((str(chat_id), message, reply_markup))
+            NOTIFY_QUEUED.inc()
+            NOTIFY_QUEUE_DEPTH.set(self._queue.qsize())
+            return True
+        except queue.Full:
+            self.dropped += 1
+            NOTIFY_DROPPED.inc()
+            return False
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def flush(self, timeout=5):
+        """Chờ gửi hết hàng đợi (dùng khi tắt hệ thống)"""
+        return self._idle.wait(timeout)
+
+    def stop(self, flush_timeout=5):
+        self.flush(flush_timeout)
+        self._stop_event.set()
+
+    def _next_item(self, timeout):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect_batch(self, first):
+        chat_id, message, reply_markup = first
+        if reply_markup:
+            return chat_id, message, reply_markup
+        parts = [message]
+        length = len(message)
+        deadline = time.monotonic() + self.coalesce_window
+        while length < TELEGRAM_MAX_MESSAGE_LEN:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and self._queue.empty():
+                break
+            try:
+                item = self._queue.get(timeout=max(0, remaining)) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] != chat_id or item[2] or length + len(item[1]) + 2 > TELEGRAM_MAX_MESSAGE_LEN:
+                self._pending = item
+                break
+            parts.append(item[1])
+            length += len(item[1]) + 2
+            self.coalesced += 1
+            NOTIFY_COALESCED.inc()
+        return chat_id, "\n\n".join(parts), None
+
+    def _wait_rate_limit(self, chat_id):
+        now = time.monotonic()
+        wait = max(
+            self._last_sent_per_chat.get(chat_id, 0) + self.per_chat_interval - now,
+            self._last_sent + self.global_interval - now,
+            0
+        )
+        if wait > 0:
+            time.sleep(wait)
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                first = self._next_item(timeout=0.5)
+            except queue.Empty:
+                if self._pending is None:
+                    self._idle.set()
+                continue
+            try:
+                chat_id, text, reply_markup = self._collect_batch(first)
+                NOTIFY_QUEUE_DEPTH.set(self._queue.qsize())
+                for attempt in range(3):
+                    self._wait_rate_limit(chat_id)
+                    ok, retry_after = _post_telegram_message(
+                        text, chat_id, reply_markup, self.bot_token, self.runtime
+                    )
+                    now = time.monotonic()
+                    self._last_sent_per_chat[chat_id] = now
+                    self._last_sent = now
+                    if ok:
+                        self.sent += 1
+                        break
+                    if retry_after is None:
+                        self.failed += 1
+                        break
+                    time.sleep(retry_after)
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Lỗi TelegramNotifier: {str(e)}")
+            finally:
+                if self._queue.empty() and self._pending is None:
+                    self._idle.set()
 
 # ========== KEYBOARD / MENU TELEGRAM (FORMAT CŨ) ==========
 def create_cancel_keyboard():
@@ -143,10 +925,10 @@ def create_bot_mode_keyboard():
         "one_time_keyboard": True
     }
 
-def get_all_usdc_pairs(limit=100):
+def get_all_usdc_pairs(limit=100, runtime=None):
     try:
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
-        data = binance_api_request(url)
+        runtime = runtime or get_runtime()
+        data = runtime.market_data.exchange_info()
         if not data:
             logger.warning("Không lấy được exchangeInfo, trả về danh sách rỗng")
             return []
@@ -163,9 +945,9 @@ def get_all_usdc_pairs(limit=100):
         logger.error(f"Lỗi get_all_usdc_pairs: {str(e)}")
         return []
 
-def create_symbols_keyboard(strategy=None):
+def create_symbols_keyboard(strategy=None, runtime=None):
     try:
-        symbols = get_all_usdc_pairs(limit=12)
+        symbols = get_all_usdc_pairs(limit=12, runtime=runtime)
         if not symbols:
             symbols = [
                 "BTCUSDC", "ETHUSDC", "BNBUSDC", "ADAUSDC",
@@ -282,117 +1064,433 @@ def create_roi_trigger_keyboard():
         "one_time_keyboard": True
     }
 
+# ========== ĐỒNG BỘ GIỜ SERVER (TIMESTAMP + RECVWINDOW) ==========
+TIME_SYNC_INTERVAL = 300        # giây giữa 2 lần đo lại offset
+TIME_SYNC_RETRY = 30            # giây chờ đo lại khi /fapi/v1/time lỗi
+RECV_WINDOW_MIN = 5000          # ms (mặc định của Binance)
+RECV_WINDOW_MAX = 60000         # ms (giới hạn của Binance)
+TIMESTAMP_ERROR = -1021         # "Timestamp for this request is outside of the recvWindow"
+CLOCK_OFFSET = metrics.gauge("binance_clock_offset_ms", "Độ lệch giờ server Binance so với giờ local (ms)")
+CLOCK_RTT = metrics.gauge("binance_time_rtt_ms", "RTT mẫu tốt nhất lần đồng bộ giờ gần nhất (ms)")
+RECV_WINDOW = metrics.gauge("binance_recv_window_ms", "recvWindow đang dùng cho request ký (ms)")
+CLOCK_SYNCS = metrics.counter("binance_time_sync_total", "Số lần đồng bộ giờ server theo kết quả")
+
+class ServerClock:
+    """
+    Giờ server Binance = giờ local + offset.
+    Đo offset/RTT với /fapi/v1/time (lấy mẫu RTT nhỏ nhất), đo lại nền mỗi interval giây
+    hoặc ngay khi sàn báo -1021. recvWindow co giãn theo RTT + jitter thay vì cố định.
+    """
+    def __init__(self, runtime, interval=TIME_SYNC_INTERVAL, samples=3):
+        self.runtime = runtime
+        self.interval = interval
+        self.samples = samples
+        self.offset = 0.0           # giây
+        self.rtt = None             # giây
+        self.jitter = 0.0           # giây, chênh RTT giữa các mẫu
+        self._recv_window = RECV_WINDOW_MIN
+        self._synced_at = None      # time.monotonic() lần đo gần nhất
+        self._syncing = False
+        self._lock = threading.Lock()
+
+    def timestamp(self):
+        """timestamp (ms) theo giờ server cho request ký"""
+        self._maybe_sync()
+        return int((self.runtime.time() + self.offset) * 1000)
+
+    def recv_window(self):
+        return self._recv_window
+
+    def sync(self):
+        best = None
+        rtts = []
+        for _ in range(self.samples):
+            sent_at = self.runtime.time()
+            started = time.perf_counter()
+            data = binance_api_request(self.runtime.rest_url("/fapi/v1/time"), runtime=self.runtime, max_retries=1)
+            rtt = time.perf_counter() - started
+            if not data or "serverTime" not in data:
+                continue
+            rtts.append(rtt)
+            # server đóng dấu giờ khoảng giữa lượt đi và lượt về
+            offset = data["serverTime"] / 1000 - (sent_at + rtt / 2)
+            if best is None or rtt < best[0]:
+                best = (rtt, offset)
+        if best is None:
+            with self._lock:
+                self._synced_at = time.monotonic() - self.interval + TIME_SYNC_RETRY
+            CLOCK_SYNCS.inc(result="failed")
+            logger.warning("⏱️ Không đồng bộ được giờ server Binance, giữ offset cũ")
+            return False
+        with self._lock:
+            self.rtt, self.offset = best
+            self.jitter = max(rtts) - min(rtts)
+            # sai số timestamp khi tới sàn <= RTT + jitter; nhân đôi + 1s dự phòng
+            window = int((2 * (self.rtt + self.jitter) + 1.0) * 1000)
+            self._recv_window = max(RECV_WINDOW_MIN, min(RECV_WINDOW_MAX, window))
+            self._synced_at = time.monotonic()
+        CLOCK_OFFSET.set(self.offset * 1000)
+        CLOCK_RTT.set(self.rtt * 1000)
+        RECV_WINDOW.set(self._recv_window)
+        CLOCK_SYNCS.inc(result="ok")
+        if abs(self.offset) > 1:
+            logger.warning(f"⏱️ Giờ local lệch server Binance {self.offset * 1000:.0f}ms, đã hiệu chỉnh")
+        return True
+
+    def invalidate(self):
+        """Sàn báo -1021: nới recvWindow và đo lại offset ở request ký kế tiếp"""
+        with self._lock:
+            self._recv_window = min(RECV_WINDOW_MAX, self._recv_window * 2)
+            if self._synced_at is not None:
+                self._synced_at = float("-inf")
+        RECV_WINDOW.set(self._recv_window)
+
+    def _maybe_sync(self):
+        with self._lock:
+            if self._syncing:
+                return
+            if self._synced_at is not None and time.monotonic() - self._synced_at < self.interval:
+                return
+            first = self._synced_at is None
+            self._syncing = True
+        if first:
+            # lần đầu đo đồng bộ (1 lần); sau đó đo lại nền, request ký không phải chờ
+            self._run_sync()
+        else:
+            threading.Thread(target=self._run_sync, name="binance-time-sync", daemon=True).start()
+
+    def _run_sync(self):
+        try:
+            self.sync()
+        except Exception as e:
+            logger.error(f"Lỗi đồng bộ giờ server: {str(e)}")
+        finally:
+            with self._lock:
+                self._syncing = False
+                if self._synced_at is None:
+                    self._synced_at = time.monotonic() - self.interval + TIME_SYNC_RETRY
+
+# ========== CIRCUIT BREAKER THEO NHÓM ENDPOINT ==========
+CIRCUIT_OPEN_ERROR = -9001      # mã nội bộ (không phải của Binance): request bị chặn vì circuit mở
+RETRY_BACKOFF_BASE = 0.5        # giây, backoff retry = base * 2^lần thử (có jitter)
+RETRY_BACKOFF_MAX = 8.0
+# nhóm endpoint: sự cố ở máy khớp lệnh không chặn dữ liệu thị trường và ngược lại
+ENDPOINT_GROUPS = {
+    "/fapi/v1/order": "order",
+    "/fapi/v1/allOpenOrders": "order",
+    "/fapi/v2/account": "account",
+    "/fapi/v2/positionRisk": "account",
+    "/fapi/v1/leverage": "account",
+}
+CIRCUIT_STATE = metrics.gauge("binance_circuit_state", "Trạng thái circuit theo nhóm endpoint (0 đóng, 1 nửa mở, 2 mở)")
+CIRCUIT_TRIPS = metrics.counter("binance_circuit_trips_total", "Số lần circuit chuyển sang mở theo nhóm endpoint")
+CIRCUIT_REJECTED = metrics.counter("binance_circuit_rejected_total", "Số request bị chặn ngay vì circuit đang mở")
+
+def _endpoint_group(endpoint):
+    return ENDPOINT_GROUPS.get(endpoint, "market")
+
+def _retry_backoff(attempt, retry_after=None):
+    """Thời gian chờ trước lần thử kế tiếp: Retry-After của sàn nếu có, ngược lại exponential + jitter"""
+    if retry_after:
+        try:
+            return min(RETRY_BACKOFF_MAX * 4, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    ceiling = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+class CircuitBreaker:
+    """
+    Circuit breaker dùng chung cho mọi bot trên 1 runtime, 1 cái cho mỗi nhóm endpoint.
+    - đóng: cho qua; failure_threshold lỗi liên tiếp (mạng, 5xx, 429/418) -> mở
+    - mở: chặn ngay (không tốn thread/weight) trong reset_timeout giây, nhân đôi mỗi lần mở lại
+      liên tiếp tới max_reset_timeout, có jitter để các tiến trình không probe cùng lúc
+    - nửa mở: cho đúng 1 request probe; thành công -> đóng, lỗi -> mở lại
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    PROBE_TIMEOUT = 35          # giây: probe treo quá timeout request -> cho probe khác
+
+    def __init__(self, name, clock, failure_threshold=5, reset_timeout=5.0, max_reset_timeout=60.0):
+        self.name = name
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0              # số lần mở liên tiếp (chưa đóng lại)
+        self.open_until = 0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = self.clock()
+            if self.state == self.OPEN:
+                if now < self.open_until:
+                    return False
+                self._set_state(self.HALF_OPEN)
+                self._probe_started = None
+            if self._probe_started is not None and now - self._probe_started < self.PROBE_TIMEOUT:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"🟢 Circuit {self.name} đóng lại, endpoint đã phục hồi")
+                self._set_state(self.CLOSED)
+            self.failures = 0
+            self.trips = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                return          # request gửi trước lúc mở, không gia hạn thêm
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                timeout = min(self.max_reset_timeout, self.reset_timeout * 2 ** self.trips)
+                timeout *= random.uniform(0.8, 1.2)
+                self.trips += 1
+                self.failures = 0
+                self._probe_started = None
+                self.open_until = self.clock() + timeout
+                self._set_state(self.OPEN)
+                CIRCUIT_TRIPS.inc(group=self.name)
+                logger.warning(f"🔴 Circuit {self.name} mở {timeout:.1f}s sau chuỗi lỗi liên tiếp")
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state], group=self.name)
+
+# ========== GỘP REQUEST ĐỒNG THỜI (SINGLE-FLIGHT) ==========
+REST_COALESCED = metrics.counter(
+    "binance_request_coalesced_total", "Số lời gọi REST được gộp vào request giống hệt đang chạy"
+)
+
+class _Flight:
+    __slots__ = ("done", "result", "shared", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.shared = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Gộp các lời gọi cùng khóa đang chạy đồng thời: caller đầu tiên gọi thật, các caller đến sau
+    chờ và nhận bản sao (deepcopy) của cùng kết quả -> không ai sửa được dữ liệu của người khác.
+    Không cache: request kết thúc là khóa được xóa, lời gọi sau luôn lấy dữ liệu mới.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, label=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            REST_COALESCED.inc(endpoint=label or "unknown")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.shared)
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+                waiters = flight.waiters
+            if waiters and flight.error is None:
+                # chụp trước khi báo xong: caller đầu có thể sửa kết quả của mình ngay sau đó
+                flight.shared = copy.deepcopy(flight.result)
+            flight.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
 # ========== HÀM HỖ TRỢ KÝ VÀ GỌI API BINANCE ==========
+_hmac_keys = {}     # api_secret -> đối tượng HMAC đã nạp key (copy() rẻ hơn hmac.new mỗi lần ký)
+
+def _hmac_key(api_secret):
+    key = _hmac_keys.get(api_secret)
+    if key is None:
+        key = hmac.new(api_secret.encode('utf-8'), digestmod=hashlib.sha256)
+        _hmac_keys[api_secret] = key
+    return key
+
 def sign(query_string, api_secret):
     try:
-        return hmac.new(
-            api_secret.encode('utf-8'),
-            query_string.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
+        mac = _hmac_key(api_secret).copy()
+        mac.update(query_string.encode('utf-8'))
+        return mac.hexdigest()
     except Exception as e:
         logger.error(f"Lỗi tạo chữ ký: {str(e)}")
         return ""
 
-def binance_api_request(url, method='GET', params=None, headers=None):
+def signed_query(params, api_secret, runtime=None):
+    """Thêm timestamp (giờ server đã hiệu chỉnh) + recvWindow, ký và trả về query kèm signature"""
+    runtime = runtime or get_runtime()
+    clock = runtime.server_clock
+    params = dict(params)
+    params["timestamp"] = clock.timestamp()
+    params["recvWindow"] = clock.recv_window()
+    query_string = urllib.parse.urlencode(params)
+    return f"{query_string}&signature={sign(query_string, api_secret)}"
+
+def binance_api_request(url, method='GET', params=None, headers=None, runtime=None,
+                        max_retries=3, return_errors=False, coalesce=True):
     """
-    Gọi API Binance có retry, giữ nguyên format cũ.
+    Gọi API Binance có retry (backoff có jitter), đi qua circuit breaker theo nhóm endpoint.
+    max_retries=1: không tự gửi lại (lệnh POST không idempotent -> OrderManager tự xử lý).
+    return_errors=True: lỗi 4xx của sàn trả về body {"code", "msg"} thay vì None.
+    Circuit đang mở -> trả ngay None ({"code": CIRCUIT_OPEN_ERROR} nếu return_errors), không gọi mạng.
+    GET giống hệt đang chạy đồng thời (cùng tài khoản) được gộp: chỉ 1 request thật, dùng chung kết quả.
+    coalesce=False: luôn gọi riêng - bắt buộc cho đối chiếu sau khi đặt/đóng lệnh, vì flight đang chạy
+    có thể đã bắt đầu trước khi lệnh khớp và trả về trạng thái cũ.
     """
-    max_retries = 3
+    runtime = runtime or get_runtime()
+    if method.upper() != 'GET' or not coalesce:
+        return _binance_request(url, method, params, headers, runtime, max_retries, return_errors)
+    key = _coalesce_key(url, params, headers, max_retries, return_errors)
+    return runtime.single_flight.do(
+        key,
+        lambda: _binance_request(url, method, params, headers, runtime, max_retries, return_errors),
+        label=_endpoint_label(url)
+    )
+
+def _coalesce_key(url, params, headers, max_retries, return_errors):
+    """Khóa gộp request: bỏ timestamp/recvWindow/signature (khác nhau mỗi lần ký), giữ API key"""
+    parsed = urllib.parse.urlparse(url)
+    query = [
+        (k, v) for k, v in urllib.parse.parse_qsl(parsed.query)
+        if k not in ("timestamp", "recvWindow", "signature")
+    ]
+    if params:
+        query.extend((str(k), str(v)) for k, v in params.items())
+    api_key = (headers or {}).get('X-MBX-APIKEY')
+    return (parsed.netloc, parsed.path, tuple(sorted(query)), api_key, max_retries, return_errors)
+
+def _binance_request(url, method, params, headers, runtime, max_retries, return_errors):
+    endpoint = _endpoint_label(url)
+    breaker = runtime.circuit_breaker(_endpoint_group(endpoint))
+    _count_rest_call()
+    
+    # Thêm User-Agent để tránh bị chặn
+    if headers is None:
+        headers = {}
+    if 'User-Agent' not in headers:
+        headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    method = method.upper()
+    data = None
+    if params:
+        if method == 'GET':
+            # ghép query 1 lần (trước đây mỗi lần retry lại ghép thêm "?query" vào url)
+            url = f"{url}?{urllib.parse.urlencode(params)}"
+        else:
+            data = urllib.parse.urlencode(params).encode()
+    
+    delay = 0
     for attempt in range(max_retries):
+        if attempt > 0:
+            API_RETRIES.inc(endpoint=endpoint)
+            runtime.sleep(delay)
+        if not breaker.allow():
+            CIRCUIT_REJECTED.inc(group=breaker.name)
+            if return_errors:
+                return {"code": CIRCUIT_OPEN_ERROR, "msg": f"circuit {breaker.name} đang mở"}
+            return None
+        started = time.perf_counter()
         try:
-            # Thêm User-Agent để tránh bị chặn
-            if headers is None:
-                headers = {}
-            
-            if 'User-Agent' not in headers:
-                headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            
-            if method.upper() == 'GET':
-                if params:
-                    query = urllib.parse.urlencode(params)
-                    url = f"{url}?{query}"
-                req = urllib.request.Request(url, headers=headers)
-            else:
-                data = urllib.parse.urlencode(params).encode() if params else None
-                req = urllib.request.Request(url, data=data, headers=headers, method=method)
-            
-            # Tăng timeout và thêm retry logic
+            req = urllib.request.Request(url, data=data, headers=headers, method=method)
             with urllib.request.urlopen(req, timeout=30) as response:
+                API_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+                API_STATUS.inc(endpoint=endpoint, status=response.status)
+                _record_used_weight(response.headers)
+                breaker.record_success()
                 if response.status == 200:
                     return json.loads(response.read().decode())
-                else:
-                    error_content = response.read().decode()
-                    logger.error(f"Lỗi API ({response.status}): {error_content}")
-                    if response.status == 401:
-                        return None
-                    if response.status == 429:
-                        time.sleep(2 ** attempt)
-                    elif response.status >= 500:
-                        time.sleep(1)
-                    continue
+                error_content = response.read().decode()
+                logger.error(f"Lỗi API ({response.status}): {error_content}")
+                delay = _retry_backoff(attempt)
+                continue
         
         except urllib.error.HTTPError as e:
+            API_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+            API_STATUS.inc(endpoint=endpoint, status=e.code)
+            _record_used_weight(e.headers)
+            if e.code in (418, 429) or e.code >= 500:
+                # sàn quá tải / giới hạn weight -> tính vào circuit, chờ theo Retry-After nếu có
+                breaker.record_failure()
+                if e.code in (418, 429):
+                    API_RATE_LIMITED.inc(endpoint=endpoint, code=e.code)
+                logger.error(f"Lỗi HTTPError ({e.code}): {e.reason}")
+                delay = _retry_backoff(attempt, retry_after=e.headers.get("Retry-After") if e.headers else None)
+                continue
+            # 4xx: sàn vẫn trả lời bình thường -> endpoint khỏe, gửi lại cùng request cũng vô ích
+            breaker.record_success()
             if e.code == 451:
                 logger.error("Lỗi 451: Bị chặn truy cập (có thể do vùng địa lý / IP).")
                 return None
+            try:
+                body = json.loads(e.read().decode())
+            except Exception:
+                body = None
+            if not isinstance(body, dict):
+                body = {"code": e.code, "msg": str(e.reason)}
+            if body.get("code") == TIMESTAMP_ERROR:
+                # gửi lại cùng timestamp vô ích -> đo lại giờ server cho request sau
+                logger.warning(f"⏱️ {endpoint}: timestamp ngoài recvWindow, đồng bộ lại giờ server")
+                runtime.server_clock.invalidate()
             else:
-                logger.error(f"Lỗi HTTPError ({e.code}): {e.reason}")
-                if e.code == 401:
-                    return None
-                if e.code == 429:
-                    time.sleep(2 ** attempt)
-                elif e.code >= 500:
-                    time.sleep(1)
-                continue
+                logger.error(f"Lỗi HTTPError ({e.code}): {e.reason} {body.get('msg', '')}")
+            return body if return_errors else None
         
         except Exception as e:
+            API_STATUS.inc(endpoint=endpoint, status="error")
+            breaker.record_failure()
             msg = str(e)
             if "Name or service not known" in msg:
                 logger.error("❌ Không phân giải được tên miền Binance (DNS). Môi trường không có mạng hoặc bị chặn.")
                 return None
             logger.error(f"Lỗi kết nối API (lần {attempt+1}): {msg}")
-            time.sleep(1)
+            delay = _retry_backoff(attempt)
     
+    API_FAILURES.inc(endpoint=endpoint)
     logger.error(f"Không thể thực hiện API sau {max_retries} lần thử")
     return None
 
-def get_top_volume_symbols(limit=100):
+def get_top_volume_symbols(limit=100, runtime=None):
     """
-    Lấy top symbol theo quoteVolume 1m đã đóng.
+    Lấy top symbol theo quoteVolume 24h (1 request ticker/24hr cho cả universe, có cache).
     """
     try:
-        universe = get_all_usdc_pairs(limit=100) or []
-        if not universe:
+        runtime = runtime or get_runtime()
+        top_symbols = runtime.universe.ranked(limit=limit, by="quote_volume")
+        if not top_symbols:
             logger.warning("Không có USDC pair nào trong universe")
-            return []
-        
-        scored_symbols = []
-        max_workers = 8
-        
-        def worker(symbol):
-            try:
-                qv = _last_closed_1m_quote_volume(symbol)
-                return symbol, qv
-            except:
-                return symbol, None
-        
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(worker, sym) for sym in universe]
-            for future in as_completed(futures):
-                symbol, qv = future.result()
-                if qv is not None:
-                    scored_symbols.append((symbol, qv))
-                time.sleep(0.5)
-        
-        scored_symbols.sort(key=lambda x: x[1], reverse=True)
-        top_symbols = [sym for sym, _ in scored_symbols[:limit]]
         return top_symbols
     except Exception as e:
         logger.error(f"Lỗi get_top_volume_symbols: {str(e)}")
         return []
 
-def get_max_leverage(symbol, api_key, api_secret):
+def get_max_leverage(symbol, api_key, api_secret, runtime=None):
     """
     Lấy leverage chuẩn cho Futures USDC:
     1. Ưu tiên lấy từ leverageBracket (API mới của Binance)
@@ -400,12 +1498,16 @@ def get_max_leverage(symbol, api_key, api_secret):
     3. Cuối cùng trả về 100 (y như file 93)
     """
     try:
-        symbol = symbol.upper()
+        runtime = runtime or get_runtime()
+        symbol = runtime.symbols.intern(symbol).symbol
 
         # --- 1) API chính xác nhất: leverageBracket ---
         try:
-            url = f"https://fapi.binance.com/fapi/v1/leverageBracket?symbol={symbol}"
-            data = binance_api_request(url)
+            url = runtime.rest_url(f"/fapi/v1/leverageBracket?symbol={symbol}")
+            data = runtime.market_data.cached(
+                ("leverage_bracket", symbol), MarketDataCache.LEVERAGE_TTL,
+                lambda: binance_api_request(url, runtime=runtime)
+            )
             if data and isinstance(data, list):
                 brackets = data[0].get("brackets", [])
                 if brackets:
@@ -416,14 +1518,9 @@ def get_max_leverage(symbol, api_key, api_secret):
 
         # --- 2) Fallback: exchangeInfo (có thể thiếu filter LEVERAGE) ---
         try:
-            url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
-            info = binance_api_request(url)
-            if info:
-                for s in info.get("symbols", []):
-                    if s.get("symbol") == symbol:
-                        for f in s.get("filters", []):
-                            if f.get("filterType") == "LEVERAGE":
-                                return int(f.get("maxLeverage", 100))
+            info = runtime.symbols.info(symbol)
+            if info and info.max_leverage:
+                return info.max_leverage
         except Exception:
             pass
 
@@ -434,46 +1531,55 @@ def get_max_leverage(symbol, api_key, api_secret):
         logger.error(f"Lỗi lấy leverage tối đa {symbol}: {str(e)}")
         return 100
 
-def get_step_size(symbol, api_key, api_secret):
-    if not symbol:
-        logger.error("Không thể lấy step size: symbol là None")
-        return 0.001
-    
-    try:
-        exchange_info = binance_api_request("https://fapi.binance.com/fapi/v1/exchangeInfo")
-        if not exchange_info:
-            logger.warning("Không lấy được exchangeInfo, dùng step size mặc định 0.001")
-            return 0.001
-
-        for symbol_info in exchange_info.get("symbols", []):
-            if symbol_info["symbol"] == symbol:
-                for f in symbol_info["filters"]:
-                    if f["filterType"] == "LOT_SIZE" and "stepSize" in f:
-                        return float(f.get("stepSize", 0.001))
-        logger.warning(f"Không tìm được LOT_SIZE stepSize cho {symbol}, dùng 0.001")
-        return 0.001
-    except Exception as e:
-        logger.error(f"Lỗi lấy step size {symbol}: {str(e)}")
-        return 0.001
-
-def set_leverage(symbol, leverage, api_key, api_secret):
+def order_quantity(symbol, notional, price, runtime=None):
+    """
+    Khối lượng lệnh MARKET cho giá trị danh nghĩa notional (USDC) tại giá price,
+    làm tròn xuống theo stepSize bằng số nguyên và kiểm tra minQty / minNotional.
+    Trả về (chuỗi khối lượng, float, None) hoặc (None, 0.0, lý do).
+    """
+    runtime = runtime or get_runtime()
+    if price <= 0 or notional <= 0:
+        return None, 0.0, "giá / vốn không hợp lệ"
+    info = runtime.symbols.info(symbol)
+    if info is None:
+        return None, 0.0, "không có thông tin symbol (exchangeInfo)"
+    text, quantity = info.floor_quantity(notional / price)
+    if text is None:
+        return None, 0.0, f"dưới minQty {info.min_qty}"
+    if info.min_notional and quantity * price < info.min_notional:
+        return None, 0.0, f"dưới minNotional {info.min_notional}"
+    return text, quantity, None
+
+def format_order_quantity(symbol, quantity, runtime=None):
+    """Chuỗi khối lượng gửi lên sàn (theo stepSize nếu biết, không dùng dạng mũ của float)"""
+    if isinstance(quantity, str):
+        return quantity
+    runtime = runtime or get_runtime()
+    info = runtime.symbols.get(symbol)
+    if info is not None and info.status is not None:
+        text, _ = info.floor_quantity(quantity)
+        if text is not None:
+            return text
+    return _format_units(
+        int(Decimal(repr(float(quantity))).scaleb(DEFAULT_QUANTITY_SCALE).to_integral_value(rounding=ROUND_FLOOR)),
+        DEFAULT_QUANTITY_SCALE
+    ).rstrip("0").rstrip(".")
+
+def set_leverage(symbol, leverage, api_key, api_secret, runtime=None):
     if not symbol:
         logger.error("Không thể set leverage: symbol là None")
         return False
     
     try:
-        ts = int(time.time() * 1000)
+        runtime = runtime or get_runtime()
         params = {
             "symbol": symbol,
-            "leverage": leverage,
-            "timestamp": ts
+            "leverage": leverage
         }
-        query_string = urllib.parse.urlencode(params)
-        signature = sign(query_string, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/leverage?{query_string}&signature={signature}"
+        url = runtime.rest_url(f"/fapi/v1/leverage?{signed_query(params, api_secret, runtime)}")
         headers = {'X-MBX-APIKEY': api_key}
         
-        response = binance_api_request(url, method='POST', headers=headers)
+        response = binance_api_request(url, method='POST', headers=headers, runtime=runtime)
         if response and 'leverage' in response:
             return True
         logger.error(f"Lỗi set leverage {symbol}: {response}")
@@ -482,19 +1588,16 @@ def set_leverage(symbol, leverage, api_key, api_secret):
         logger.error(f"Lỗi set leverage {symbol}: {str(e)}")
         return False
 
-def get_balance(api_key, api_secret):
+def get_balance(api_key, api_secret, runtime=None):
     """
     Lấy số dư USDC khả dụng (availableBalance).
     """
     try:
-        ts = int(time.time() * 1000)
-        params = {"timestamp": ts}
-        query_string = urllib.parse.urlencode(params)
-        signature = sign(query_string, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/account?{query_string}&signature={signature}"
+        runtime = runtime or get_runtime()
+        url = runtime.rest_url(f"/fapi/v2/account?{signed_query({}, api_secret, runtime)}")
         headers = {'X-MBX-APIKEY': api_key}
         
-        response = binance_api_request(url, method='GET', headers=headers)
+        response = binance_api_request(url, method='GET', headers=headers, runtime=runtime)
         if not response:
             logger.error("Không thể lấy thông tin account")
             return None
@@ -512,80 +1615,278 @@ def get_balance(api_key, api_secret):
         logger.error(f"Lỗi get_balance: {str(e)}")
         return None
 
-def place_order(symbol, side, quantity, api_key, api_secret):
+def place_order(symbol, side, quantity, api_key, api_secret, runtime=None,
+                client_order_id=None, reduce_only=False, max_retries=3):
+    """
+    Lệnh MARKET (newOrderRespType=RESULT: response có executedQty/avgPrice thật).
+    client_order_id: newClientOrderId do OrderManager cấp -> gửi lại không bị khớp 2 lần.
+    """
     if not symbol:
         logger.error("Không thể đặt lệnh: symbol là None")
         return None
     
     try:
-        ts = int(time.time() * 1000)
+        runtime = runtime or get_runtime()
         params = {
             "symbol": symbol,
             "side": side,
             "type": "MARKET",
-            "quantity": quantity,
-            "timestamp": ts
+            "quantity": format_order_quantity(symbol, quantity, runtime),
+            "newOrderRespType": "RESULT"
         }
-        query_string = urllib.parse.urlencode(params)
-        signature = sign(query_string, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/order?{query_string}&signature={signature}"
+        if client_order_id:
+            params["newClientOrderId"] = client_order_id
+        if reduce_only:
+            params["reduceOnly"] = "true"
+        url = runtime.rest_url(f"/fapi/v1/order?{signed_query(params, api_secret, runtime)}")
         headers = {'X-MBX-APIKEY': api_key}
         
-        return binance_api_request(url, method='POST', headers=headers)
+        return binance_api_request(url, method='POST', headers=headers, runtime=runtime,
+                                   max_retries=max_retries, return_errors=client_order_id is not None)
     except Exception as e:
         logger.error(f"Lỗi đặt lệnh: {str(e)}")
     return None
 
-def cancel_all_orders(symbol, api_key, api_secret):
+def cancel_all_orders(symbol, api_key, api_secret, runtime=None):
     if not symbol:
         logger.error("❌ Không thể hủy lệnh: symbol là None")
         return False
     try:
-        ts = int(time.time() * 1000)
-        params = {"symbol": symbol, "timestamp": ts}
-        query_string = urllib.parse.urlencode(params)
-        signature = sign(query_string, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/allOpenOrders?{query_string}&signature={signature}"
+        runtime = runtime or get_runtime()
+        url = runtime.rest_url(f"/fapi/v1/allOpenOrders?{signed_query({'symbol': symbol}, api_secret, runtime)}")
         headers = {'X-MBX-APIKEY': api_key}
         
-        _ = binance_api_request(url, method='DELETE', headers=headers)
+        _ = binance_api_request(url, method='DELETE', headers=headers, runtime=runtime)
         return True
     except Exception as e:
         logger.error(f"Lỗi hủy tất cả lệnh {symbol}: {str(e)}")
         return False
 
-def get_current_price(symbol):
-    if not symbol:
-        logger.error("Không thể lấy giá hiện tại: symbol là None")
-        return 0
-    try:
-        url = f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={symbol}"
-        data = binance_api_request(url)
-        if data and "price" in data:
-            price = float(data["price"])
-            if price > 0:
-                return price
-        logger.warning(f"Giá hiện tại cho {symbol} không hợp lệ hoặc không có")
-        return 0
-    except Exception as e:
-        logger.error(f"Lỗi lấy giá hiện tại {symbol}: {str(e)}")
-        return 0
-
-def get_position_summary(api_key, api_secret):
+def get_order(symbol, api_key, api_secret, client_order_id=None, order_id=None, runtime=None):
     """
-    Lấy danh sách vị thế đang mở (format cũ).
+    Trạng thái 1 lệnh theo origClientOrderId hoặc orderId (1 lần gọi, không retry).
+    Lệnh không tồn tại -> {"code": -2013, ...}; lỗi mạng/5xx -> None.
+    Không gộp request (coalesce=False): kết quả phải phản ánh trạng thái sau khi gửi lệnh.
     """
+    if not symbol or not (client_order_id or order_id):
+        return None
     try:
-        ts = int(time.time() * 1000)
-        params = {"timestamp": ts}
-        query_string = urllib.parse.urlencode(params)
-        signature = sign(query_string, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/positionRisk?{query_string}&signature={signature}"
+        runtime = runtime or get_runtime()
+        params = {"symbol": symbol}
+        if client_order_id:
+            params["origClientOrderId"] = client_order_id
+        else:
+            params["orderId"] = order_id
+        url = runtime.rest_url(f"/fapi/v1/order?{signed_query(params, api_secret, runtime)}")
         headers = {'X-MBX-APIKEY': api_key}
-        
-        positions = binance_api_request(url, headers=headers)
-        if not positions:
-            return []
+        return binance_api_request(
+            url, headers=headers, runtime=runtime, max_retries=1, return_errors=True, coalesce=False
+        )
+    except Exception as e:
+        logger.error(f"Lỗi truy vấn lệnh {symbol}: {str(e)}")
+        return None
+
+# ========== QUẢN LÝ LỆNH (IDEMPOTENT) ==========
+ORDER_NOT_FOUND = -2013
+ORDER_FINAL_STATUSES = ("FILLED", "CANCELED", "EXPIRED", "REJECTED")
+ORDER_RESULTS = metrics.counter("orders_total", "Số lệnh theo intent và kết quả")
+ORDER_RESENDS = metrics.counter("order_resends_total", "Số lần gửi lại lệnh sau khi xác nhận lệnh trước không tồn tại")
+ORDER_STATUS_QUERIES = metrics.counter("order_status_queries_total", "Số lần hỏi trạng thái lệnh trước khi gửi lại")
+ORDER_FILL_LATENCY = metrics.histogram("order_fill_duration_seconds", "Thời gian từ lúc gửi lệnh tới khi khớp theo intent")
+ORDER_IN_FLIGHT = metrics.gauge("orders_in_flight", "Số lệnh đang chờ kết quả")
+
+class OrderManager:
+    """
+    Đặt lệnh an toàn khi retry cho 1 tài khoản:
+    - mỗi ý định (open/close/average_down) có 1 newClientOrderId, giữ nguyên qua các lần gửi lại
+    - timeout/5xx -> hỏi trạng thái theo clientOrderId; chỉ gửi lại khi sàn xác nhận lệnh chưa tồn tại
+      (-2013 lặp lại missing_confirmations lần, cách nhau retry_delay)
+    - rủi ro còn lại: sàn chỉ chặn trùng newClientOrderId trong các lệnh còn mở, lệnh MARKET đã khớp
+      mà truy vấn vẫn trả -2013 (sàn ghi nhận chậm) thì lần gửi lại sẽ khớp thêm 1 lần nữa;
+      bot đối chiếu lại khối lượng thật qua positionRisk sau lệnh
+    - mỗi symbol chỉ 1 lệnh cùng intent đang bay; lệnh thứ 2 bị từ chối ngay
+    - thống kê độ trễ khớp lệnh (fill_stats)
+    """
+    def __init__(self, api_key, api_secret, runtime=None, max_attempts=3, retry_delay=0.2,
+                 status_checks=3, missing_confirmations=2, fill_timeout=5.0, poll_interval=0.2, prefix="tb"):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.runtime = runtime or get_runtime()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.status_checks = status_checks
+        self.missing_confirmations = max(1, min(missing_confirmations, status_checks))
+        self.fill_timeout = fill_timeout
+        self.poll_interval = poll_interval
+        self.prefix = f"{prefix}{os.getpid() % 0x10000:x}"
+        self._seq = 0
+        self._in_flight = defaultdict(dict)     # symbol -> {client_id: {"intent", "side", "quantity", "started"}}
+        self._fills = deque(maxlen=500)         # (intent, giây từ lúc gửi tới lúc khớp)
+        self._lock = threading.Lock()
+
+    def new_client_order_id(self, intent):
+        """<= 36 ký tự [A-Za-z0-9-], duy nhất theo tiến trình + thời điểm + số thứ tự"""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        millis = int(self.runtime.time() * 1000)
+        return f"{self.prefix}-{intent[:5]}-{millis:x}-{seq:x}"[:36]
+
+    def in_flight(self, symbol=None):
+        with self._lock:
+            if symbol is not None:
+                return [dict(order, client_order_id=cid) for cid, order in self._in_flight.get(symbol, {}).items()]
+            return {sym: list(orders) for sym, orders in self._in_flight.items() if orders}
+
+    def submit(self, symbol, side, quantity, intent="open", reduce_only=False):
+        """
+        Trả về response lệnh (có orderId), body lỗi của sàn ({"code", "msg"}) hoặc None khi
+        không xác định được / đang có lệnh cùng intent cho symbol.
+        """
+        client_id = self.new_client_order_id(intent)
+        with self._lock:
+            pending = self._in_flight[symbol]
+            if any(order["intent"] == intent for order in pending.values()):
+                logger.warning(f"⏳ {symbol}: đang có lệnh {intent} chờ kết quả, bỏ qua lệnh trùng")
+                ORDER_RESULTS.inc(intent=intent, outcome="duplicate")
+                return None
+            pending[client_id] = {"intent": intent, "side": side, "quantity": quantity,
+                                  "started": self.runtime.time()}
+            ORDER_IN_FLIGHT.set(sum(len(orders) for orders in self._in_flight.values()))
+        started = time.perf_counter()
+        outcome = "failed"
+        result = None
+        try:
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    ORDER_RESENDS.inc(intent=intent)
+                    self.runtime.sleep(self.retry_delay)
+                response = place_order(symbol, side, quantity, self.api_key, self.api_secret,
+                                       runtime=self.runtime, client_order_id=client_id,
+                                       reduce_only=reduce_only, max_retries=1)
+                if response and "orderId" in response:
+                    result = response
+                    break
+                if response and response.get("code") is not None:
+                    # sàn đã từ chối rõ ràng (ký quỹ, precision...) -> gửi lại cũng vô ích
+                    result = response
+                    outcome = "rejected"
+                    break
+                # timeout/5xx: lệnh có thể đã tới sàn -> hỏi trạng thái trước khi gửi lại
+                state, order = self._resolve(symbol, client_id)
+                if state == "found":
+                    result = order
+                    break
+                if state == "unknown":
+                    logger.error(f"❌ {symbol}: không xác định được lệnh {client_id}, không gửi lại")
+                    outcome = "unknown"
+                    break
+            if result and "orderId" in result:
+                result = self._await_fill(symbol, client_id, result)
+                outcome = str(result.get("status") or "accepted").lower()
+                if result.get("status") == "FILLED":
+                    elapsed = time.perf_counter() - started
+                    ORDER_FILL_LATENCY.observe(elapsed, intent=intent)
+                    with self._lock:
+                        self._fills.append((intent, elapsed))
+            return result
+        finally:
+            with self._lock:
+                pending = self._in_flight.get(symbol)
+                if pending is not None:
+                    pending.pop(client_id, None)
+                    if not pending:
+                        del self._in_flight[symbol]
+                ORDER_IN_FLIGHT.set(sum(len(orders) for orders in self._in_flight.values()))
+            ORDER_RESULTS.inc(intent=intent, outcome=outcome)
+
+    def _resolve(self, symbol, client_id):
+        """
+        ("found", order) | ("missing", None) | ("unknown", None).
+        "missing" chỉ khi -2013 lặp lại đủ missing_confirmations lần: 1 lần -2013 ngay sau timeout
+        có thể chỉ là sàn chưa kịp ghi nhận lệnh, gửi lại lúc đó dễ khớp 2 lần.
+        """
+        missing = 0
+        for check in range(self.status_checks):
+            if check:
+                self.runtime.sleep(self.retry_delay)
+            ORDER_STATUS_QUERIES.inc()
+            order = get_order(symbol, self.api_key, self.api_secret, client_order_id=client_id, runtime=self.runtime)
+            if order and "orderId" in order:
+                return "found", order
+            if order and order.get("code") == ORDER_NOT_FOUND:
+                missing += 1
+                if missing >= self.missing_confirmations:
+                    return "missing", None
+        return "unknown", None
+
+    def _await_fill(self, symbol, client_id, order):
+        """Lệnh MARKET thường FILLED ngay trong response RESULT; nếu chưa, poll tới fill_timeout"""
+        deadline = self.runtime.time() + self.fill_timeout
+        while order.get("status") and order.get("status") not in ORDER_FINAL_STATUSES:
+            if self.runtime.time() >= deadline:
+                break
+            self.runtime.sleep(self.poll_interval)
+            latest = get_order(symbol, self.api_key, self.api_secret, client_order_id=client_id, runtime=self.runtime)
+            if latest and "orderId" in latest:
+                order = latest
+        return order
+
+    def fill_stats(self):
+        """{intent: {"count", "p50_ms", "p95_ms", "max_ms"}} trên 500 lệnh khớp gần nhất"""
+        with self._lock:
+            fills = list(self._fills)
+        by_intent = defaultdict(list)
+        for intent, elapsed in fills:
+            by_intent[intent].append(elapsed)
+        stats = {}
+        for intent, values in by_intent.items():
+            values.sort()
+            stats[intent] = {
+                "count": len(values),
+                "p50_ms": _percentile(values, 50) * 1000,
+                "p95_ms": _percentile(values, 95) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return stats
+
+def get_current_price(symbol, runtime=None):
+    if not symbol:
+        logger.error("Không thể lấy giá hiện tại: symbol là None")
+        return 0
+    try:
+        runtime = runtime or get_runtime()
+        # stream toàn thị trường đang chạy -> đọc giá O(1), không gọi REST
+        price = runtime.prices.price(symbol)
+        if price:
+            return price
+        url = runtime.rest_url(f"/fapi/v1/ticker/price?symbol={symbol}")
+        data = binance_api_request(url, runtime=runtime)
+        if data and "price" in data:
+            price = float(data["price"])
+            if price > 0:
+                return price
+        logger.warning(f"Giá hiện tại cho {symbol} không hợp lệ hoặc không có")
+        return 0
+    except Exception as e:
+        logger.error(f"Lỗi lấy giá hiện tại {symbol}: {str(e)}")
+        return 0
+
+def get_position_summary(api_key, api_secret, runtime=None, coalesce=True):
+    """
+    Lấy danh sách vị thế đang mở (format cũ).
+    Lỗi mạng / 5xx / circuit đang mở -> None (khác [] = chắc chắn không có vị thế):
+    caller phải giữ nguyên trạng thái khi nhận None.
+    coalesce=False: đọc mới, không dùng chung flight positionRisk bắt đầu trước khi đặt/đóng lệnh.
+    """
+    try:
+        runtime = runtime or get_runtime()
+        url = runtime.rest_url(f"/fapi/v2/positionRisk?{signed_query({}, api_secret, runtime)}")
+        headers = {'X-MBX-APIKEY': api_key}
+        
+        positions = binance_api_request(url, headers=headers, runtime=runtime, coalesce=coalesce)
+        if not isinstance(positions, list):
+            return None
         
         open_positions = []
         for pos in positions:
@@ -595,129 +1896,1304 @@ def get_position_summary(api_key, api_secret):
         return open_positions
     except Exception as e:
         logger.error(f"Lỗi get_position_summary: {str(e)}")
-        return []
+        return None
+
+# ========== DỮ LIỆU THỊ TRƯỜNG DÙNG CHUNG (CACHE TTL) ==========
+MARKET_CACHE_HITS = metrics.counter("market_data_cache_hits_total", "Số lần lấy dữ liệu thị trường từ cache")
+MARKET_CACHE_MISSES = metrics.counter("market_data_cache_misses_total", "Số lần phải gọi REST lấy dữ liệu thị trường")
+# độ dài nến (ms) của các interval thẳng hàng mốc epoch; 1w/1M không thẳng hàng -> không memo
+KLINE_INTERVAL_MS = dict(
+    [(f"{n}m", n * 60_000) for n in (1, 3, 5, 15, 30)]
+    + [(f"{n}h", n * 3_600_000) for n in (1, 2, 4, 6, 8, 12)]
+    + [("1d", 86_400_000)]
+)
+
+class MarketDataCache:
+    """
+    Cache TTL cho dữ liệu thị trường công khai (exchangeInfo, klines, leverageBracket).
+    Không phụ thuộc tài khoản -> mọi bot / tài khoản dùng chung 1 RuntimeContext dùng chung cache.
+    Kết quả rỗng / lỗi không được cache.
+    """
+    EXCHANGE_INFO_TTL = 300
+    KLINES_TTL = 2
+    LEVERAGE_TTL = 3600
+    TICKER_TTL = 30
+
+    def __init__(self, runtime, max_entries=5000):
+        self.runtime = runtime
+        self.max_entries = max_entries
+        self._entries = {}      # {key: (expires_at, value)}
+        self._closed = {}       # {(symbol id, interval): (close time nến đóng gần nhất, [nến đã đóng])}
+        self._lock = threading.Lock()
+
+    def cached(self, key, ttl, fetch):
+        now = self.runtime.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                MARKET_CACHE_HITS.inc(kind=key[0])
+                return entry[1]
+        MARKET_CACHE_MISSES.inc(kind=key[0])
+        value = fetch()
+        if value:
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._evict(now)
+                self._entries[key] = (now + ttl, value)
+        return value
+
+    def _evict(self, now):
+        """Xóa entry hết hạn; vẫn đầy thì bỏ nửa số entry sắp hết hạn nhất"""
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            by_expiry = sorted(self._entries, key=lambda k: self._entries[k][0])
+            for key in by_expiry[:len(by_expiry) // 2]:
+                del self._entries[key]
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            if kind in (None, "closed_klines"):
+                self._closed.clear()
+            if kind is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == kind]:
+                    del self._entries[key]
+
+    def exchange_info(self):
+        return self.cached(
+            ("exchange_info",), self.EXCHANGE_INFO_TTL,
+            lambda: binance_api_request(self.runtime.rest_url("/fapi/v1/exchangeInfo"), runtime=self.runtime)
+        )
+
+    def klines(self, symbol, interval, limit):
+        return self.cached(
+            ("klines", symbol, interval, limit), self.KLINES_TTL,
+            lambda: binance_api_request(
+                self.runtime.rest_url("/fapi/v1/klines"),
+                params={"symbol": symbol, "interval": interval, "limit": limit},
+                runtime=self.runtime
+            )
+        )
+
+    def closed_klines(self, symbol, interval, limit):
+        """
+        `limit` nến ĐÃ ĐÓNG gần nhất. Nến đã đóng không đổi -> memo theo (symbol id, interval,
+        close time nến đóng gần nhất): tự hết hạn đúng lúc nến kế tiếp đóng, giữa 2 mốc không gọi REST.
+        """
+        span = KLINE_INTERVAL_MS.get(interval)
+        if span is None:
+            data = self.klines(symbol, interval, limit + 1)
+            return data[:-1] if data else data
+        # giờ server (đã hiệu chỉnh offset nếu đã đồng bộ) -> mốc đóng nến khớp với sàn
+        now_ms = int((self.runtime.time() + self.runtime.server_clock.offset) * 1000)
+        close_time = now_ms // span * span - 1
+        key = (self.runtime.symbols.intern(symbol).id, interval)
+        with self._lock:
+            entry = self._closed.get(key)
+        if entry and entry[0] == close_time and len(entry[1]) >= limit:
+            MARKET_CACHE_HITS.inc(kind="closed_klines")
+            return entry[1][-limit:]
+        MARKET_CACHE_MISSES.inc(kind="closed_klines")
+        data = binance_api_request(
+            self.runtime.rest_url("/fapi/v1/klines"),
+            params={"symbol": symbol, "interval": interval, "limit": limit + 1},
+            runtime=self.runtime
+        )
+        if not data:
+            return data
+        if int(data[-1][6]) <= close_time:
+            # sàn chưa có nến sau mốc (offset chưa đồng bộ / đồng hồ local chạy trước) -> nến cuối
+            # vẫn đang hình thành: bỏ nó và không memo
+            return data[:-1][-limit:]
+        closed = [k for k in data if int(k[6]) <= close_time]
+        # chỉ memo khi đã có đúng nến đóng gần nhất và sàn đã mở nến kế tiếp
+        if closed and int(closed[-1][6]) == close_time:
+            with self._lock:
+                self._closed[key] = (close_time, closed)
+        return closed[-limit:]
+
+    def ticker_24hr(self):
+        """Ticker 24h của mọi symbol trong 1 request"""
+        return self.cached(
+            ("ticker_24hr",), self.TICKER_TTL,
+            lambda: binance_api_request(self.runtime.rest_url("/fapi/v1/ticker/24hr"), runtime=self.runtime)
+        )
+
+    def book_tickers(self):
+        """Bid/ask tốt nhất của mọi symbol trong 1 request"""
+        return self.cached(
+            ("book_ticker",), self.TICKER_TTL,
+            lambda: binance_api_request(self.runtime.rest_url("/fapi/v1/ticker/bookTicker"), runtime=self.runtime)
+        )
+
+# ========== REGISTRY SYMBOL (ID DÀY + METADATA) ==========
+# Số chữ số thập phân mặc định khi chưa có filter (giống round(quantity, 8) cũ)
+DEFAULT_QUANTITY_SCALE = 8
+
+def _decimal_scale(value):
+    """Số chữ số thập phân của Decimal đã normalize ('0.00100000' -> 3, '10' -> 0)"""
+    return max(0, -value.as_tuple().exponent) if value else 0
+
+def _format_units(units, scale):
+    """Số nguyên đơn vị 10^-scale -> chuỗi thập phân cố định (không mũ, không sai số float)"""
+    if scale <= 0:
+        return str(units)
+    sign = "-" if units < 0 else ""
+    whole, frac = divmod(abs(units), 10 ** scale)
+    return f"{sign}{whole}.{frac:0{scale}d}"
+
+class SymbolInfo:
+    """
+    Metadata 1 symbol: id dày, tên chuẩn (interned), tên stream, filter từ exchangeInfo.
+    Bảng độ chính xác (Decimal -> số nguyên): khối lượng được làm tròn bằng phép chia
+    nguyên theo stepSize rồi format thành chuỗi gửi thẳng lên sàn.
+    """
+    __slots__ = (
+        "id", "symbol", "stream", "status", "base_asset", "quote_asset",
+        "step_size", "tick_size", "min_qty", "min_notional", "max_leverage", "filters",
+        "quantity_precision", "price_precision",
+        "qty_scale", "step_units", "min_qty_units",
+    )
+
+    def __init__(self, symbol_id, symbol):
+        self.id = symbol_id
+        self.symbol = symbol
+        self.stream = f"{symbol.lower()}@trade"
+        self.status = None
+        self.base_asset = None
+        self.quote_asset = None
+        self.step_size = 0.0
+        self.tick_size = 0.0
+        self.min_qty = 0.0
+        self.min_notional = 0.0
+        self.max_leverage = None
+        self.filters = {}           # {filterType: filter dict gốc}
+        self.quantity_precision = None
+        self.price_precision = None
+        # khối lượng = units * 10^-qty_scale, units luôn là bội số của step_units
+        self.qty_scale = DEFAULT_QUANTITY_SCALE
+        self.step_units = 1
+        self.min_qty_units = 0
+
+    def __repr__(self):
+        return f"SymbolInfo({self.id}, {self.symbol!r})"
+
+    def set_precision(self, step_size, min_qty, quantity_precision=None, price_precision=None):
+        """Tính bảng làm tròn từ chuỗi filter gốc (Decimal, không qua float)"""
+        step = Decimal(str(step_size or "0")).normalize()
+        self.quantity_precision = quantity_precision
+        self.price_precision = price_precision
+        self.qty_scale = _decimal_scale(step) if step else (
+            quantity_precision if quantity_precision is not None else DEFAULT_QUANTITY_SCALE
+        )
+        self.step_units = int(step.scaleb(self.qty_scale)) if step else 1
+        self.min_qty_units = int(
+            Decimal(str(min_qty or "0")).scaleb(self.qty_scale).to_integral_value(rounding=ROUND_FLOOR)
+        )
+
+    def quantity_units(self, quantity):
+        """Khối lượng -> số đơn vị 10^-qty_scale, làm tròn XUỐNG tới bội số stepSize"""
+        units = int(Decimal(repr(float(quantity))).scaleb(self.qty_scale).to_integral_value(rounding=ROUND_FLOOR))
+        if self.step_units > 1:
+            units -= units % self.step_units
+        return units
+
+    def floor_quantity(self, quantity):
+        """(chuỗi, float) khối lượng hợp lệ theo stepSize; (None, 0.0) nếu dưới minQty / bằng 0"""
+        units = self.quantity_units(quantity)
+        if units <= 0 or units < self.min_qty_units:
+            return None, 0.0
+        text = _format_units(units, self.qty_scale)
+        return text, float(text)
+
+class SymbolRegistry:
+    """
+    Cấp id số nguyên dày (0, 1, 2...) cho mỗi symbol, chuẩn hóa tên 1 lần (upper + sys.intern)
+    và tính sẵn tên stream + filter (stepSize, tickSize, minQty, minNotional, maxLeverage).
+    Các đường nóng (bảng giá, sổ vị thế, WebSocket, step size) tra theo id / SymbolInfo
+    thay vì upper()/lower() và duyệt exchangeInfo mỗi lần.
+    """
+    def __init__(self, runtime=None):
+        self.runtime = runtime
+        self._by_name = {}          # {tên (mọi kiểu viết đã gặp): SymbolInfo}
+        self._by_id = []            # [SymbolInfo] theo id
+        self._lock = threading.RLock()
+        self._loaded_from = None    # object exchangeInfo đã nạp filter (so sánh identity)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def intern(self, symbol):
+        """SymbolInfo của symbol (cấp id mới nếu chưa có); nhận cả chữ thường"""
+        info = self._by_name.get(symbol)
+        if info is not None:
+            return info
+        canonical = sys.intern(symbol.upper())
+        with self._lock:
+            info = self._by_name.get(canonical)
+            if info is None:
+                info = SymbolInfo(len(self._by_id), canonical)
+                self._by_id.append(info)
+                self._by_name[canonical] = info
+            self._by_name[symbol] = info
+        return info
+
+    def id_of(self, symbol):
+        return self.intern(symbol).id
+
+    def get(self, symbol):
+        """SymbolInfo nếu đã có (không cấp id mới)"""
+        info = self._by_name.get(symbol)
+        if info is None and symbol:
+            info = self._by_name.get(symbol.upper())
+        return info
+
+    def name(self, symbol_id):
+        return self._by_id[symbol_id].symbol
+
+    def load_exchange_info(self, exchange_info):
+        """Nạp status / asset / filter cho mọi symbol trong exchangeInfo"""
+        for raw in exchange_info.get("symbols", []):
+            info = self.intern(raw["symbol"])
+            filters = {f.get("filterType"): f for f in raw.get("filters", [])}
+            lot = filters.get("LOT_SIZE", {})
+            price_filter = filters.get("PRICE_FILTER", {})
+            notional = filters.get("MIN_NOTIONAL", {})
+            leverage = filters.get("LEVERAGE", {})
+            info.status = raw.get("status")
+            info.base_asset = raw.get("baseAsset")
+            info.quote_asset = raw.get("quoteAsset")
+            info.step_size = float(lot.get("stepSize") or 0)
+            info.min_qty = float(lot.get("minQty") or 0)
+            info.tick_size = float(price_filter.get("tickSize") or 0)
+            info.set_precision(
+                lot.get("stepSize"), lot.get("minQty"),
+                quantity_precision=raw.get("quantityPrecision"), price_precision=raw.get("pricePrecision")
+            )
+            info.min_notional = float(notional.get("notional") or notional.get("minNotional") or 0)
+            info.max_leverage = int(leverage["maxLeverage"]) if leverage.get("maxLeverage") else None
+            info.filters = filters
+        self._loaded_from = exchange_info
+
+    def info(self, symbol):
+        """SymbolInfo kèm filter (nạp lại khi cache exchangeInfo đổi); None nếu sàn không có symbol"""
+        runtime = self.runtime or get_runtime()
+        exchange_info = runtime.market_data.exchange_info()
+        if exchange_info and exchange_info is not self._loaded_from:
+            with self._lock:
+                if exchange_info is not self._loaded_from:
+                    self.load_exchange_info(exchange_info)
+        info = self.get(symbol)
+        return info if info is not None and info.status is not None else None
+
+# ========== XẾP HẠNG UNIVERSE (TICKER 24H) ==========
+UNIVERSE_SYMBOLS = metrics.gauge("universe_ranked_symbols", "Số symbol trong bảng xếp hạng universe")
+UNIVERSE_REFRESH_LATENCY = metrics.histogram(
+    "universe_refresh_duration_seconds", "Thời gian làm mới bảng xếp hạng universe"
+)
+
+def _rank_percentiles(values, reverse=False):
+    """{index: percentile 0..1} theo thứ tự tăng dần (reverse=True: giá trị nhỏ được điểm cao)"""
+    order = sorted(range(len(values)), key=values.__getitem__, reverse=reverse)
+    last = max(1, len(order) - 1)
+    return {idx: pos / last for pos, idx in enumerate(order)}
+
+class UniverseRanker:
+    """
+    Xếp hạng toàn bộ cặp USDC đang TRADING chỉ với 2 request bulk (/fapi/v1/ticker/24hr +
+    /fapi/v1/ticker/bookTicker) thay vì 1 request klines cho mỗi symbol.
+    Điểm = tổng có trọng số của percentile quoteVolume 24h, biên độ 24h (high-low)/giá và spread
+    (spread hẹp điểm cao). Thread nền làm mới định kỳ; bộ quét coin đọc kết quả đã cache.
+    """
+    WEIGHTS = {"quote_volume": 0.5, "volatility": 0.3, "spread": 0.2}
+
+    def __init__(self, runtime, refresh_interval=60, quote_asset="USDC", min_quote_volume=0):
+        self.runtime = runtime
+        self.refresh_interval = refresh_interval
+        self.quote_asset = quote_asset
+        self.min_quote_volume = min_quote_volume
+        self.updated_at = 0
+        self._entries = []          # [{symbol, quote_volume, volatility, spread_bps, score}] theo điểm giảm dần
+        self._by_symbol = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_loop, name="universe-ranker", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _refresh_loop(self):
+        while not self._stop_event.wait(self.refresh_interval):
+            self.refresh()
+
+    def refresh(self):
+        """Lấy ticker bulk + xếp hạng lại; giữ bảng cũ nếu lỗi"""
+        with self._refresh_lock:
+            started = time.perf_counter()
+            try:
+                entries = self._build_ranking()
+            except Exception as e:
+                logger.error(f"Lỗi xếp hạng universe: {str(e)}")
+                return False
+            finally:
+                UNIVERSE_REFRESH_LATENCY.observe(time.perf_counter() - started)
+            if not entries:
+                return False
+            with self._lock:
+                self._entries = entries
+                self._by_symbol = {entry["symbol"]: entry for entry in entries}
+                self.updated_at = self.runtime.time()
+            UNIVERSE_SYMBOLS.set(len(entries))
+            return True
+
+    def _build_ranking(self):
+        market = self.runtime.market_data
+        info = market.exchange_info()
+        tickers = market.ticker_24hr()
+        if not info or not isinstance(tickers, list):
+            return []
+        tradable = {
+            s["symbol"] for s in info.get("symbols", [])
+            if s["symbol"].endswith(self.quote_asset) and s.get("status") == "TRADING"
+        }
+        books = market.book_tickers()
+        spreads = {}
+        for book in books if isinstance(books, list) else ():
+            bid = float(book.get("bidPrice") or 0)
+            ask = float(book.get("askPrice") or 0)
+            if bid > 0 and ask >= bid:
+                spreads[book.get("symbol")] = (ask - bid) / ((ask + bid) / 2) * 10000
+
+        entries = []
+        for ticker in tickers:
+            symbol = ticker.get("symbol")
+            if symbol not in tradable:
+                continue
+            last = float(ticker.get("lastPrice") or 0)
+            quote_volume = float(ticker.get("quoteVolume") or 0)
+            if last <= 0 or quote_volume < self.min_quote_volume:
+                continue
+            high = float(ticker.get("highPrice") or last)
+            low = float(ticker.get("lowPrice") or last)
+            entries.append({
+                "symbol": symbol,
+                "quote_volume": quote_volume,
+                "volatility": (high - low) / last * 100,
+                "spread_bps": spreads.get(symbol),
+                "score": 0.0,
+            })
+        if not entries:
+            return []
+
+        volume_rank = _rank_percentiles([e["quote_volume"] for e in entries])
+        volatility_rank = _rank_percentiles([e["volatility"] for e in entries])
+        known_spreads = [i for i, e in enumerate(entries) if e["spread_bps"] is not None]
+        spread_rank = {
+            known_spreads[k]: pct
+            for k, pct in _rank_percentiles([entries[i]["spread_bps"] for i in known_spreads], reverse=True).items()
+        }
+        weights = self.WEIGHTS
+        for idx, entry in enumerate(entries):
+            entry["score"] = (
+                weights["quote_volume"] * volume_rank[idx]
+                + weights["volatility"] * volatility_rank[idx]
+                + weights["spread"] * spread_rank.get(idx, 0.5)
+            )
+        entries.sort(key=lambda e: e["score"], reverse=True)
+        return entries
+
+    def _ensure_fresh(self):
+        self.start()
+        if not self._entries or self.runtime.time() - self.updated_at > self.refresh_interval * 3:
+            self.refresh()
+
+    def ranked(self, limit=None, by="score"):
+        """Danh sách symbol theo điểm tổng hợp (hoặc theo 1 tiêu chí: quote_volume / volatility)"""
+        self._ensure_fresh()
+        with self._lock:
+            entries = self._entries
+        if by != "score":
+            entries = sorted(entries, key=lambda e: e[by], reverse=True)
+        symbols = [entry["symbol"] for entry in entries]
+        return symbols[:limit] if limit else symbols
+
+    def stats(self, symbol):
+        """Chỉ số đã tính của symbol (None nếu ngoài bảng xếp hạng)"""
+        self._ensure_fresh()
+        return self._by_symbol.get(symbol)
+
+# ========== LƯU TRẠNG THÁI BOT (SQLITE WAL) ==========
+# Các trường thay đổi liên tục, không cần lưu
+STATE_VOLATILE_FIELDS = ("current_price", "last_position_check")
+# StateStore / TradeJournal có thể được supervisor + mọi worker process mở chung 1 file:
+# WAL cho đọc song song với ghi, ghi đụng khóa thì chờ tối đa chừng này ms thay vì lỗi "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+class StateStore:
+    """
+    Lưu cấu hình bot + trạng thái từng symbol (nhồi lệnh, entry gốc, ROI đỉnh...) vào SQLite (WAL)
+    để sau khi Railway restart có thể dựng lại bot và tiếp tục quản lý vị thế đang mở.
+    Nhiều process có thể dùng chung file (xem SQLITE_BUSY_TIMEOUT_MS).
+    """
+    def __init__(self, path="bot_state.db", clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bots ("
+            " bot_id TEXT PRIMARY KEY, config TEXT NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS symbol_state ("
+            " bot_id TEXT NOT NULL, symbol TEXT NOT NULL, state TEXT NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (bot_id, symbol))"
+        )
+        self._last_saved = {}   # {(bot_id, symbol): json} tránh ghi trùng
+
+    def save_bot(self, bot_id, config):
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO bots (bot_id, config, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(bot_id) DO UPDATE SET config=excluded.config, updated_at=excluded.updated_at",
+                (bot_id, json.dumps(config), now, now)
+            )
+
+    def delete_bot(self, bot_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM symbol_state WHERE bot_id = ?", (bot_id,))
+            self._conn.execute("DELETE FROM bots WHERE bot_id = ?", (bot_id,))
+            for key in [k for k in self._last_saved if k[0] == bot_id]:
+                del self._last_saved[key]
+
+    def save_symbol(self, bot_id, symbol, state):
+        payload = json.dumps(
+            {k: v for k, v in state.items() if k not in STATE_VOLATILE_FIELDS}, sort_keys=True
+        )
+        key = (bot_id, symbol)
+        with self._lock:
+            if self._last_saved.get(key) == payload:
+                return False
+            self._conn.execute(
+                "INSERT INTO symbol_state (bot_id, symbol, state, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(bot_id, symbol) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+                (bot_id, symbol, payload, self.clock())
+            )
+            self._last_saved[key] = payload
+            return True
+
+    def delete_symbol(self, bot_id, symbol):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM symbol_state WHERE bot_id = ? AND symbol = ?", (bot_id, symbol)
+            )
+            self._last_saved.pop((bot_id, symbol), None)
+
+    def load_bots(self):
+        """[{bot_id, config, symbols: {symbol: state}}] theo thứ tự tạo"""
+        with self._lock:
+            bots = self._conn.execute(
+                "SELECT bot_id, config FROM bots ORDER BY created_at"
+            ).fetchall()
+            rows = self._conn.execute("SELECT bot_id, symbol, state FROM symbol_state").fetchall()
+        symbols = defaultdict(dict)
+        for bot_id, symbol, state in rows:
+            symbols[bot_id][symbol] = json.loads(state)
+        return [
+            {"bot_id": bot_id, "config": json.loads(config), "symbols": symbols.get(bot_id, {})}
+            for bot_id, config in bots
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# ========== NHẬT KÝ GIAO DỊCH (SQLITE) ==========
+EXIT_REASONS = ("tp", "sl", "roi_exit", "manual", "other")
+
+class TradeJournal:
+    """
+    Ghi mọi lần mở / nhồi / đóng lệnh vào SQLite (insert theo lô từ thread nền)
+    và cung cấp truy vấn PnL theo bot / symbol / ngày / lý do thoát.
+    Nhiều process có thể dùng chung file (xem SQLITE_BUSY_TIMEOUT_MS).
+    """
+    def __init__(self, path="trade_journal.db", flush_interval=1.0, batch_size=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._buffer = []
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS trades ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " ts REAL NOT NULL, day TEXT NOT NULL,"
+            " bot_id TEXT NOT NULL, symbol TEXT NOT NULL, event TEXT NOT NULL,"
+            " side TEXT, quantity REAL, price REAL, entry_price REAL, leverage REAL,"
+            " pnl REAL, roi REAL, exit_reason TEXT, reason TEXT, average_down_count INTEGER,"
+            " latency_ms REAL)"
+        )
+        # Index bao phủ (covering) cho các truy vấn PnL: không cần đọc bảng chính
+        for name, cols in (
+            # lọc theo 1 bot (pnl_by_symbol / pnl_by_day / pnl_by_exit_reason với bot_id)
+            ("idx_trades_bot_close", "bot_id, event, ts, symbol, day, exit_reason, pnl, roi"),
+            ("idx_trades_close_bot", "event, bot_id, ts, pnl, roi"),
+            ("idx_trades_close_symbol", "event, symbol, ts, pnl, roi"),
+            ("idx_trades_close_day", "event, day, ts, pnl, roi"),
+            ("idx_trades_close_reason", "event, exit_reason, ts, pnl, roi"),
+            ("idx_trades_close_ts", "event, ts, pnl"),
+        ):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON trades ({cols})")
+
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    # ----- GHI -----
+    def record(self, bot_id, symbol, event, ts, side=None, quantity=None, price=None,
+               entry_price=None, leverage=None, pnl=None, roi=None, exit_reason=None,
+               reason=None, average_down_count=None, latency_ms=None):
+        row = (
+            ts, time.strftime("%Y-%m-%d", time.gmtime(ts)), bot_id, symbol, event,
+            side, quantity, price, entry_price, leverage, pnl, roi, exit_reason, reason,
+            average_down_count, latency_ms
+        )
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        try:
+            with self._db_lock:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO trades (ts, day, bot_id, symbol, event, side, quantity, price,"
+                    " entry_price, leverage, pnl, roi, exit_reason, reason, average_down_count, latency_ms)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Lỗi ghi nhật ký giao dịch ({len(rows)} dòng): {str(e)}")
+            try:
+                self._conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            return 0
+
+    def _writer(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stop_event.set()
+        self._wakeup.set()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    # ----- TRUY VẤN -----
+    def _query(self, sql, params=()):
+        self.flush()
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _pnl_group_by(self, column, since=None, bot_id=None):
+        sql = (
+            f"SELECT {column}, COUNT(*), COALESCE(SUM(pnl), 0), COALESCE(AVG(roi), 0),"
+            " SUM(CASE WHEN pnl > 0 THEN 1 ELSE 0 END)"
+            " FROM trades WHERE event = 'close'"
+        )
+        params = []
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(since)
+        if bot_id is not None:
+            sql += " AND bot_id = ?"
+            params.append(bot_id)
+        sql += f" GROUP BY {column} ORDER BY 3 DESC"
+        return [
+            {"key": key, "trades": trades, "pnl": pnl, "avg_roi": avg_roi, "wins": wins}
+            for key, trades, pnl, avg_roi, wins in self._query(sql, params)
+        ]
+
+    def pnl_by_bot(self, since=None):
+        return self._pnl_group_by("bot_id", since)
+
+    def pnl_by_symbol(self, since=None, bot_id=None):
+        return self._pnl_group_by("symbol", since, bot_id)
+
+    def pnl_by_day(self, since=None, bot_id=None):
+        rows = self._pnl_group_by("day", since, bot_id)
+        return sorted(rows, key=lambda r: r["key"])
+
+    def pnl_by_exit_reason(self, since=None, bot_id=None):
+        return self._pnl_group_by("exit_reason", since, bot_id)
+
+    def totals(self, since=None):
+        sql = (
+            "SELECT COUNT(*), COALESCE(SUM(pnl), 0), SUM(CASE WHEN pnl > 0 THEN 1 ELSE 0 END)"
+            " FROM trades WHERE event = 'close'"
+        )
+        params = ()
+        if since is not None:
+            sql += " AND ts >= ?"
+            params = (since,)
+        trades, pnl, wins = self._query(sql, params)[0]
+        return {"trades": trades, "pnl": pnl, "wins": wins or 0}
 
 # ========== COIN MANAGER ==========
+DEFAULT_ACCOUNT_ID = "main"
+
 class CoinManager:
     """
     Quản lý tập coin đang được các bot sử dụng để tránh trùng lặp.
+    reserve/release nguyên tử theo owner (bot_id); lease có TTL hết hạn nếu owner không gia hạn
+    (ttl=None: giữ tới khi release).
     """
-    def __init__(self):
-        self.active_coins = set()
+    def __init__(self, default_ttl=None, clock=time.monotonic):
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self._leases = {}       # {symbol: (owner, expires_at | None)}
         self._lock = threading.Lock()
 
-    def register_coin(self, symbol):
+    def _live_lease(self, symbol, now):
+        lease = self._leases.get(symbol)
+        if lease and lease[1] is not None and lease[1] <= now:
+            del self._leases[symbol]
+            return None
+        return lease
+
+    def reserve(self, symbol, owner=None, ttl=None):
+        """Giữ coin cho owner; False nếu owner khác đang giữ. Gọi lại bởi cùng owner = gia hạn."""
         if not symbol:
-            return
+            return False
+        ttl = self.default_ttl if ttl is None else ttl
         with self._lock:
-            self.active_coins.add(symbol)
+            now = self.clock()
+            lease = self._live_lease(symbol, now)
+            if lease and lease[0] != owner:
+                return False
+            self._leases[symbol] = (owner, now + ttl if ttl else None)
+            return True
+
+    def release(self, symbol, owner=None):
+        """Trả coin; owner=None trả bất kể ai giữ"""
+        if not symbol:
+            return False
+        with self._lock:
+            lease = self._live_lease(symbol, self.clock())
+            if lease and (owner is None or lease[0] == owner):
+                del self._leases[symbol]
+                return True
+            return False
+
+    def renew(self, symbols, owner=None, ttl=None):
+        """Gia hạn (hoặc giữ lại) nhiều coin; trả về list coin đã bị owner khác lấy"""
+        return [symbol for symbol in symbols if not self.reserve(symbol, owner, ttl)]
+
+    def claim(self, symbol, owner=None):
+        """Giữ coin đã có vị thế lưu (khôi phục); trong process không có lease chờ nên = reserve"""
+        return self.reserve(symbol, owner)
+
+    def holder(self, symbol):
+        with self._lock:
+            lease = self._live_lease(symbol, self.clock())
+            return lease[0] if lease else None
+
+    # API cũ
+    def register_coin(self, symbol):
+        return self.reserve(symbol)
 
     def unregister_coin(self, symbol):
+        return self.release(symbol)
+
+    def is_coin_active(self, symbol):
         if not symbol:
+            return False
+        with self._lock:
+            return self._live_lease(symbol, self.clock()) is not None
+
+    def get_active_coins(self):
+        with self._lock:
+            now = self.clock()
+            return [symbol for symbol in list(self._leases) if self._live_lease(symbol, now)]
+
+# ========== DỊCH VỤ GIỮ COIN GIỮA CÁC PROCESS (UNIX SOCKET / TCP) ==========
+COIN_LEASE_TTL = 30             # giây; holder chết -> coin tự nhả sau TTL
+COIN_SERVICE_TIMEOUT = 5        # giây chờ 1 request tới server
+
+def _parse_coin_service_address(address):
+    """'/path/to.sock' -> Unix socket; 'host:port' -> TCP (vd. nhiều replica trong cùng mạng nội bộ)"""
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+def _coin_service_authkey(address, authkey):
+    """
+    TCP: bắt buộc authkey dùng chung (challenge-response HMAC khi kết nối) -> trả về bytes.
+    Unix socket: quyền truy cập do quyền file quyết định -> None.
+    """
+    family, _ = _parse_coin_service_address(address)
+    if family == socket.AF_UNIX:
+        return None
+    if not authkey:
+        raise ValueError(f"Dịch vụ giữ coin TCP {address} cần authkey dùng chung")
+    return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+
+def _coin_auth_digest(authkey, challenge):
+    return hmac.new(authkey, challenge.encode(), hashlib.sha256).hexdigest()
+
+class _CoinRequestHandler(socketserver.StreamRequestHandler):
+    def _authenticate(self, authkey):
+        challenge = os.urandom(16).hex()
+        self.wfile.write((json.dumps({"challenge": challenge}) + "\n").encode())
+        try:
+            digest = str(json.loads(self.rfile.readline()).get("auth", ""))
+        except (ValueError, AttributeError):
+            digest = ""
+        ok = hmac.compare_digest(digest, _coin_auth_digest(authkey, challenge))
+        self.wfile.write((json.dumps({"ok": ok}) + "\n").encode())
+        if not ok:
+            logger.warning(f"⚠️ Từ chối kết nối dịch vụ giữ coin từ {self.client_address}: sai authkey")
+        return ok
+
+    def handle(self):
+        authkey = self.server.coin_service.authkey
+        if authkey is not None and not self._authenticate(authkey):
             return
+        for line in self.rfile:
+            try:
+                response = self.server.coin_service.handle_request(json.loads(line))
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class CoinReservationServer:
+    """
+    Server giữ coin (1 CoinManager có TTL cho mỗi namespace = account_id), giao thức JSON theo dòng.
+    grace > 0 (khởi động lại sau khi server cũ chết): trong grace giây chỉ nhận gia hạn (renew)
+    để client cũ kịp giữ lại coin của mình trước khi nhận đặt mới.
+    TCP: client phải trả lời đúng challenge HMAC(authkey) ngay khi kết nối, sai -> đóng kết nối.
+    """
+    def __init__(self, address, ttl=COIN_LEASE_TTL, grace=0, authkey=None):
+        self.address = address
+        self.authkey = _coin_service_authkey(address, authkey)
+        self.ttl = ttl
+        self.grace_until = time.monotonic() + grace
+        self._managers = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _manager(self, namespace):
         with self._lock:
-            self.active_coins.discard(symbol)
+            manager = self._managers.get(namespace)
+            if manager is None:
+                manager = self._managers[namespace] = CoinManager(default_ttl=self.ttl)
+            return manager
+
+    def handle_request(self, request):
+        op = request.get("op")
+        manager = self._manager(request.get("ns") or DEFAULT_ACCOUNT_ID)
+        symbol = request.get("symbol")
+        owner = request.get("owner")
+        if op == "reserve":
+            if time.monotonic() < self.grace_until:
+                return {"ok": False, "grace": True}
+            return {"ok": manager.reserve(symbol, owner, request.get("ttl"))}
+        if op == "release":
+            return {"ok": manager.release(symbol, owner)}
+        if op == "renew":
+            return {"ok": True, "lost": manager.renew(request.get("symbols", []), owner, request.get("ttl"))}
+        if op == "active":
+            return {"ok": True, "symbols": manager.get_active_coins()}
+        if op == "is_active":
+            return {"ok": True, "active": manager.is_coin_active(symbol)}
+        return {"ok": False, "error": f"op không hợp lệ: {op}"}
+
+    def start(self):
+        family, addr = _parse_coin_service_address(self.address)
+        server_cls = _ThreadingUnixServer if family == socket.AF_UNIX else _ThreadingTCPServer
+        self._server = server_cls(addr, _CoinRequestHandler)
+        self._server.coin_service = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"🔐 Dịch vụ giữ coin chạy tại {self.address}")
+        return self
 
-    def is_coin_active(self, symbol):
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            family, addr = _parse_coin_service_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(addr):
+                os.unlink(addr)
+            self._server = None
+
+def _coin_service_reachable(address):
+    family, addr = _parse_coin_service_address(address)
+    try:
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(addr)
+        return True
+    except OSError:
+        return False
+
+def ensure_coin_service(address, ttl=COIN_LEASE_TTL, grace=0, authkey=None):
+    """
+    Đã có server tại address -> None. Chưa có -> khởi động server trong process này và trả về nó
+    (Unix socket: khóa file .lock để 2 process không cùng dựng server; socket cũ của process đã chết bị xóa).
+    """
+    family, addr = _parse_coin_service_address(address)
+    if family != socket.AF_UNIX:
+        if _coin_service_reachable(address):
+            return None
+        try:
+            return CoinReservationServer(address, ttl, grace, authkey).start()
+        except OSError:
+            if _coin_service_reachable(address):
+                return None
+            raise
+
+    import fcntl
+    with open(f"{addr}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if _coin_service_reachable(address):
+            return None
+        if os.path.exists(addr):
+            os.unlink(addr)
+        return CoinReservationServer(address, ttl, grace, authkey).start()
+
+class RemoteCoinManager:
+    """
+    Client của CoinReservationServer, cùng interface với CoinManager.
+    Thread nền gia hạn mọi coin đang giữ mỗi ttl/3 giây; server mất -> tự dựng server mới (có grace)
+    rồi giữ lại coin của mình. Lỗi kết nối -> từ chối giữ coin mới (an toàn: không trùng vị thế).
+    """
+    def __init__(self, address, namespace=DEFAULT_ACCOUNT_ID, ttl=COIN_LEASE_TTL, authkey=None):
+        self.address = address
+        self.namespace = namespace
+        self.ttl = ttl
+        self.authkey = _coin_service_authkey(address, authkey)
+        # owner phải duy nhất giữa các process / replica
+        self.client_id = f"{socket.gethostname()}:{os.getpid()}:{random.randint(1000, 9999)}"
+        # _held / _pending được thread bot và thread heartbeat cùng sửa -> giữ _state_lock
+        self._held = {}         # {symbol: owner}
+        self._pending = {}      # {symbol: owner} coin khôi phục đang chờ lease cũ hết hạn
+        self._state_lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()   # 1 request trên socket tại 1 thời điểm
+        self._stop_event = threading.Event()
+        self._server = None     # server dựng tại process này khi failover
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def _owner(self, owner):
+        return f"{self.client_id}:{owner}"
+
+    def _connect(self):
+        family, addr = _parse_coin_service_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(COIN_SERVICE_TIMEOUT)
+        sock.connect(addr)
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        if self.authkey is not None:
+            challenge = json.loads(self._reader.readline()).get("challenge", "")
+            sock.sendall((json.dumps({"auth": _coin_auth_digest(self.authkey, challenge)}) + "\n").encode())
+            if not json.loads(self._reader.readline()).get("ok"):
+                raise ConnectionError("dịch vụ giữ coin từ chối authkey")
+
+    def _close_socket(self):
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+    def _request(self, payload):
+        payload = dict(payload, ns=self.namespace)
+        line = (json.dumps(payload) + "\n").encode()
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(line)
+                    response = self._reader.readline()
+                    if not response:
+                        raise ConnectionError("server đóng kết nối")
+                    return json.loads(response)
+                except (OSError, ValueError) as e:
+                    self._close_socket()
+                    if attempt == 1:
+                        logger.error(f"Lỗi dịch vụ giữ coin {self.address}: {str(e)}")
+        return None
+
+    def reserve(self, symbol, owner=None, ttl=None):
         if not symbol:
             return False
+        response = self._request({"op": "reserve", "symbol": symbol, "owner": self._owner(owner), "ttl": ttl or self.ttl})
+        ok = bool(response and response.get("ok"))
+        if ok:
+            with self._state_lock:
+                self._held[symbol] = owner
+        return ok
+
+    def claim(self, symbol, owner=None):
+        """
+        Như reserve nhưng nếu coin còn bị lease cũ giữ (vd. worker trước đã chết) thì heartbeat
+        tiếp tục thử giữ tới khi lease cũ hết hạn.
+        """
+        if self.reserve(symbol, owner):
+            return True
+        with self._state_lock:
+            self._pending[symbol] = owner
+        return False
+
+    def release(self, symbol, owner=None):
+        if not symbol:
+            return False
+        with self._state_lock:
+            held_owner = self._held.pop(symbol, None)
+            self._pending.pop(symbol, None)
+        owner = held_owner if owner is None else owner
+        response = self._request({"op": "release", "symbol": symbol, "owner": self._owner(owner)})
+        return bool(response and response.get("ok"))
+
+    def renew(self, symbols=None, owner=None, ttl=None):
+        """Gia hạn coin đang giữ (theo từng owner); trả về list coin bị mất"""
+        if symbols is None:
+            with self._state_lock:
+                held = dict(self._held)
+        else:
+            held = {s: owner for s in symbols}
+        by_owner = defaultdict(list)
+        for symbol, held_owner in held.items():
+            by_owner[held_owner].append(symbol)
+        lost = []
+        for held_owner, owner_symbols in by_owner.items():
+            response = self._request({
+                "op": "renew", "symbols": owner_symbols,
+                "owner": self._owner(held_owner), "ttl": ttl or self.ttl
+            })
+            if response is None:
+                return None
+            lost.extend(response.get("lost", []))
+        return lost
+
+    def _heartbeat(self):
+        while not self._stop_event.wait(self.ttl / 3):
+            with self._state_lock:
+                pending = list(self._pending.items())
+            for symbol, owner in pending:
+                if self.reserve(symbol, owner):
+                    with self._state_lock:
+                        still_wanted = self._pending.pop(symbol, None) is not None
+                    if not still_wanted:
+                        # bot đã nhả coin trong lúc đang giữ lại -> trả lease vừa lấy
+                        self.release(symbol, owner)
+            with self._state_lock:
+                if not self._held:
+                    continue
+            lost = self.renew()
+            if lost is None:
+                # server không phản hồi -> thử dựng server mới tại đây (grace = ttl) rồi giữ lại coin
+                try:
+                    self._server = ensure_coin_service(
+                        self.address, self.ttl, grace=self.ttl, authkey=self.authkey
+                    ) or self._server
+                except OSError as e:
+                    logger.error(f"Không dựng lại được dịch vụ giữ coin: {str(e)}")
+                    continue
+                lost = self.renew() or []
+            for symbol in lost:
+                with self._state_lock:
+                    self._held.pop(symbol, None)
+                logger.error(f"⚠️ Mất quyền giữ coin {symbol} [{self.namespace}] (lease hết hạn, đã bị giữ bởi process khác)")
+
+    def close(self):
+        self._stop_event.set()
+        with self._state_lock:
+            held = list(self._held)
+        for symbol in held:
+            self.release(symbol)
         with self._lock:
-            return symbol in self.active_coins
+            self._close_socket()
+
+    # API cũ
+    def register_coin(self, symbol):
+        return self.reserve(symbol)
+
+    def unregister_coin(self, symbol):
+        return self.release(symbol)
+
+    def is_coin_active(self, symbol):
+        response = self._request({"op": "is_active", "symbol": symbol})
+        return True if response is None else bool(response.get("active"))
 
     def get_active_coins(self):
+        response = self._request({"op": "active"})
+        if response is None:
+            with self._state_lock:
+                return list(self._held)
+        return response.get("symbols", [])
+
+# ========== TÀI KHOẢN (NHIỀU SUB-ACCOUNT / 1 PROCESS) ==========
+
+class Account:
+    """
+    1 tài khoản Binance: key ký request, CoinManager, snapshot vị thế và trạng thái kiểm tra API riêng.
+    Dữ liệu thị trường (WebSocket, MarketDataCache) dùng chung giữa các tài khoản.
+    """
+    def __init__(self, account_id, api_key, api_secret, runtime=None, coin_manager=None):
+        self.account_id = account_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.runtime = runtime or get_runtime()
+        self.coin_manager = coin_manager or CoinManager()
+        self.symbol_locks = defaultdict(threading.Lock)
+        self.orders = OrderManager(api_key, api_secret, runtime=self.runtime)
+        self.verified_at = None         # lần kiểm tra API thành công gần nhất (đồng hồ runtime)
+        self._positions = None
+        self._positions_at = 0
+        self._lock = threading.Lock()
+
+    def balance(self):
+        return get_balance(self.api_key, self.api_secret, runtime=self.runtime)
+
+    def open_positions(self, max_age=0):
+        """
+        Vị thế đang mở; max_age > 0: dùng lại snapshot nếu chưa cũ hơn max_age giây.
+        None nếu positionRisk lỗi (không ghi đè snapshot cũ).
+        """
+        now = self.runtime.time()
+        with self._lock:
+            if self._positions is not None and max_age > 0 and now - self._positions_at < max_age:
+                return self._positions
+        positions = get_position_summary(self.api_key, self.api_secret, runtime=self.runtime)
+        if positions is None:
+            return None
         with self._lock:
-            return list(self.active_coins)
+            self._positions = positions
+            self._positions_at = now
+        return positions
+
+# ========== PIPELINE TÍN HIỆU ĐA KHUNG ==========
+def calculate_rsi(prices, period=14):
+    """Tính RSI từ danh sách giá"""
+    if len(prices) < period + 1:
+        return 50  # Giá trị trung bình nếu không đủ dữ liệu
+        
+    deltas = np.diff(prices)
+    gains = np.where(deltas > 0, deltas, 0)
+    losses = np.where(deltas < 0, -deltas, 0)
+    
+    avg_gain = np.mean(gains[:period])
+    avg_loss = np.mean(losses[:period])
+    
+    if avg_loss == 0:
+        return 100
+    
+    rs = avg_gain / avg_loss
+    rsi = 100 - (100 / (1 + rs))
+    return rsi
+
+class IndicatorStage:
+    """
+    1 bước của pipeline tín hiệu: nhận nến 1 khung (cũ -> mới, nến cuối đang chạy) và giá trị
+    các bước trước trên cùng khung, trả về dict giá trị mới. min_bars: số nến tối thiểu cần có.
+    """
+    name = "stage"
+    min_bars = 1
+
+    def compute(self, bars, values):
+        raise NotImplementedError
+
+class RSIStage(IndicatorStage):
+    name = "rsi"
+
+    def __init__(self, period=14):
+        self.period = period
+        self.min_bars = period + 1
+
+    def compute(self, bars, values):
+        return {"rsi": calculate_rsi([float(k[4]) for k in bars], self.period)}
+
+class VolumeChangeStage(IndicatorStage):
+    """Nến đã đóng gần nhất so với nến trước đó: giá đóng cửa + khối lượng"""
+    name = "volume_change"
+    min_bars = 3
+
+    def compute(self, bars, values):
+        prev_candle, current_candle = bars[-3], bars[-2]
+        prev_volume = float(prev_candle[5])
+        current_volume = float(current_candle[5])
+        return {
+            "prev_close": float(prev_candle[4]),
+            "close": float(current_candle[4]),
+            "prev_volume": prev_volume,
+            "volume": current_volume,
+            "volume_change_pct": (current_volume / prev_volume - 1) * 100 if prev_volume > 0 else None,
+        }
+
+class RSIVolumeRuleStage(IndicatorStage):
+    """6 điều kiện RSI + giá + khối lượng -> values["signal"] ("BUY" / "SELL" / None)"""
+    name = "signal"
+    min_bars = 3
+
+    def __init__(self, volume_threshold=20):
+        self.volume_threshold = volume_threshold
+
+    def compute(self, bars, values):
+        rsi_current = values["rsi"]
+        threshold = self.volume_threshold
+        
+        # Xu hướng giá
+        price_increase = values["close"] > values["prev_close"]
+        price_decrease = values["close"] < values["prev_close"]
+        
+        # Xu hướng khối lượng
+        volume_increase = values["volume"] > values["prev_volume"] * (1 + threshold/100)
+        volume_decrease = values["volume"] < values["prev_volume"] * (1 - threshold/100)
+        
+        signal = None
+        # 1) RSI > 80 + price increase + volume increase → SELL
+        if rsi_current > 80 and price_increase and volume_increase:
+            signal = "SELL"
+        # 2) RSI < 20 + price decrease + volume decrease → SELL
+        elif rsi_current < 20 and price_decrease and volume_decrease:
+            signal = "SELL"
+        # 3) RSI > 80 + price increase + volume decrease → BUY
+        elif rsi_current > 80 and price_increase and volume_decrease:
+            signal = "BUY"
+        # 4) RSI < 20 + price decrease + volume increase → BUY
+        elif rsi_current < 20 and price_decrease and volume_increase:
+            signal = "BUY"
+        # 5) RSI > 20 + no price decrease + volume decrease → BUY
+        elif rsi_current > 20 and (not price_decrease) and volume_decrease:
+            signal = "BUY"
+        # 6) RSI < 80 + no price increase + volume increase → SELL
+        elif rsi_current < 80 and (not price_increase) and volume_increase:
+            signal = "SELL"
+        return {"signal": signal}
+
+class SignalPipeline:
+    """
+    Chạy các IndicatorStage theo thứ tự trên từng khung thời gian.
+    Nguồn nến: CandleStore (trade stream, gộp 1m -> 5m/15m/1h tại chỗ, không tốn request) nếu symbol
+    đang có stream; ngược lại nến đã đóng memo + giá live, cuối cùng là REST klines.
+    """
+    def __init__(self, runtime, stages, bars=15):
+        self.runtime = runtime
+        self.stages = list(stages)
+        self.bar_count = max([bars] + [stage.min_bars for stage in self.stages])
+
+    def bars(self, symbol, interval):
+        limit = self.bar_count
+        bars = self.runtime.candles.bars(symbol, interval, limit)
+        if bars:
+            return bars
+        price = self.runtime.prices.price(symbol)
+        if price:
+            closed = self.runtime.market_data.closed_klines(symbol, interval, limit - 1)
+            if closed and len(closed) == limit - 1:
+                # nến đang chạy chỉ cần close = giá live (volume chỉ đọc ở nến đã đóng)
+                return closed + [[int(closed[-1][6]) + 1, price, price, price, price, 0]]
+        return self.runtime.market_data.klines(symbol, interval, limit)
+
+    def evaluate(self, symbol, interval):
+        """{tên giá trị: ...} sau khi chạy mọi stage trên khung interval; None nếu thiếu nến"""
+        bars = self.bars(symbol, interval)
+        if not bars or len(bars) < self.bar_count:
+            return None
+        values = {"interval": interval}
+        for stage in self.stages:
+            values.update(stage.compute(bars, values))
+        return values
 
 # ========== SMART COIN FINDER (GIỮ FORMAT CŨ + LOGIC RSI MỚI) ==========
+SIGNAL_TIMEFRAME = "5m"
+
 class SmartCoinFinder:
-    def __init__(self, api_key, api_secret):
+    def __init__(self, api_key, api_secret, runtime=None, confirm_timeframes=()):
         self.api_key = api_key
         self.api_secret = api_secret
+        self.runtime = runtime or get_runtime()
+        # khung lớn hơn dùng để xác nhận tín hiệu 5m (vd ("15m", "1h")); rỗng = chỉ 5m như cũ
+        self.confirm_timeframes = tuple(tf for tf in (confirm_timeframes or ()) if tf != SIGNAL_TIMEFRAME)
+        self._pipelines = {}    # {volume_threshold: SignalPipeline}
         
     def get_symbol_leverage(self, symbol):
         """Lấy đòn bẩy tối đa của symbol"""
-        return get_max_leverage(symbol, self.api_key, self.api_secret)
+        return get_max_leverage(symbol, self.api_key, self.api_secret, runtime=self.runtime)
     
     def calculate_rsi(self, prices, period=14):
         """Tính RSI từ danh sách giá"""
-        if len(prices) < period + 1:
-            return 50  # Giá trị trung bình nếu không đủ dữ liệu
-            
-        deltas = np.diff(prices)
-        gains = np.where(deltas > 0, deltas, 0)
-        losses = np.where(deltas < 0, -deltas, 0)
-        
-        avg_gain = np.mean(gains[:period])
-        avg_loss = np.mean(losses[:period])
-        
-        if avg_loss == 0:
-            return 100
-        
-        rs = avg_gain / avg_loss
-        rsi = 100 - (100 / (1 + rs))
-        return rsi
+        return calculate_rsi(prices, period)
+    
+    def signal_pipeline(self, volume_threshold):
+        pipeline = self._pipelines.get(volume_threshold)
+        if pipeline is None:
+            pipeline = self._pipelines[volume_threshold] = SignalPipeline(
+                self.runtime, [RSIStage(), VolumeChangeStage(), RSIVolumeRuleStage(volume_threshold)]
+            )
+        return pipeline
     
     def get_rsi_signal(self, symbol, volume_threshold=20):
         """
-        Logic RSI + khối lượng MỚI theo đúng 6 điều kiện bạn yêu cầu.
+        Logic RSI + khối lượng MỚI theo đúng 6 điều kiện bạn yêu cầu (nến 5m).
+        confirm_timeframes: khung lớn hơn ra tín hiệu ngược chiều -> bỏ tín hiệu.
         """
         try:
-            data = binance_api_request(
-                "https://fapi.binance.com/fapi/v1/klines",
-                params={"symbol": symbol, "interval": "5m", "limit": 15}
-            )
-            if not data or len(data) < 15:
+            pipeline = self.signal_pipeline(volume_threshold)
+            values = pipeline.evaluate(symbol, SIGNAL_TIMEFRAME)
+            signal = values["signal"] if values else None
+            if signal is None:
                 return None
-            
-            prev_candle = data[-3]     # nến trước
-            current_candle = data[-2]  # nến hiện tại
-            latest_candle = data[-1]   # nến mới nhất (có thể chưa đóng)
-            
-            # Giá đóng cửa
-            closes = [float(k[4]) for k in data]
-            rsi_current = self.calculate_rsi(closes)
-            
-            prev_close = float(prev_candle[4])
-            current_close = float(current_candle[4])
-            latest_close = float(latest_candle[4]) if len(latest_candle) > 4 else current_close
-            
-            # Khối lượng
-            prev_volume = float(prev_candle[5])
-            current_volume = float(current_candle[5])
-            
-            # Xu hướng giá
-            price_increase = current_close > prev_close
-            price_decrease = current_close < prev_close
-            
-            # Xu hướng khối lượng
-            volume_increase = current_volume > prev_volume * (1 + volume_threshold/100)
-            volume_decrease = current_volume < prev_volume * (1 - volume_threshold/100)
-            
-            # 1) RSI > 80 + price increase + volume increase → SELL
-            if rsi_current > 80 and price_increase and volume_increase:
-                return "SELL"
-            
-            # 2) RSI < 20 + price decrease + volume decrease → SELL
-            if rsi_current < 20 and price_decrease and volume_decrease:
-                return "SELL"
-            
-            # 3) RSI > 80 + price increase + volume decrease → BUY
-            if rsi_current > 80 and price_increase and volume_decrease:
-                return "BUY"
-            
-            # 4) RSI < 20 + price decrease + volume increase → BUY
-            if rsi_current < 20 and price_decrease and volume_increase:
-                return "BUY"
-            
-            # 5) RSI > 20 + no price decrease + volume decrease → BUY
-            if rsi_current > 20 and (not price_decrease) and volume_decrease:
-                return "BUY"
-            
-            # 6) RSI < 80 + no price increase + volume increase → SELL
-            if rsi_current < 80 and (not price_increase) and volume_increase:
-                return "SELL"
-            
-            return None
+            for interval in self.confirm_timeframes:
+                confirm = pipeline.evaluate(symbol, interval)
+                if confirm and confirm["signal"] and confirm["signal"] != signal:
+                    return None
+            return signal
         except Exception as e:
             logger.error(f"Lỗi phân tích RSI {symbol}: {str(e)}")
             return None
@@ -731,11 +3207,14 @@ class SmartCoinFinder:
         return self.get_rsi_signal(symbol, volume_threshold=40)
     
     def has_existing_position(self, symbol):
-        """Kiểm tra xem symbol đã có vị thế trên Binance chưa"""
+        """
+        Kiểm tra xem symbol đã có vị thế trên Binance chưa.
+        True / False; None nếu không lấy được positionRisk (caller không được coi là "không có").
+        """
         try:
-            positions = get_position_summary(self.api_key, self.api_secret)
-            if not positions:
-                return False
+            positions = get_position_summary(self.api_key, self.api_secret, runtime=self.runtime)
+            if positions is None:
+                return None
             
             for pos in positions:
                 if pos.get("symbol") == symbol:
@@ -746,12 +3225,13 @@ class SmartCoinFinder:
             return False
         except Exception as e:
             logger.error(f"Lỗi kiểm tra vị thế {symbol}: {str(e)}")
-            return True
+            return None
     
     def find_best_coin(self, target_direction, excluded_coins=None, required_leverage=10):
         """Tìm coin tốt nhất - format cũ, mỗi coin độc lập"""
         try:
-            all_symbols = get_all_usdc_pairs(limit=50)
+            # xét 50 coin đứng đầu bảng xếp hạng universe (ticker 24h, cache nền)
+            all_symbols = self.runtime.universe.ranked(limit=50) or get_all_usdc_pairs(limit=50, runtime=self.runtime)
             if not all_symbols:
                 return None
             
@@ -762,8 +3242,8 @@ class SmartCoinFinder:
                 if excluded_coins and symbol in excluded_coins:
                     continue
                 
-                # Coin đã có vị thế trên Binance?
-                if self.has_existing_position(symbol):
+                # Coin đã có vị thế trên Binance? (không kiểm tra được -> cũng bỏ qua)
+                if self.has_existing_position(symbol) is not False:
                     logger.info(f"🚫 Bỏ qua {symbol} - đã có vị thế trên Binance")
                     continue
                 
@@ -786,7 +3266,7 @@ class SmartCoinFinder:
             max_lev = self.get_symbol_leverage(selected_symbol)
             
             # Kiểm tra lần cuối
-            if self.has_existing_position(selected_symbol):
+            if self.has_existing_position(selected_symbol) is not False:
                 logger.info(f"🚫 {selected_symbol} - Coin được chọn đã có vị thế, bỏ qua")
                 return None
             
@@ -798,47 +3278,52 @@ class SmartCoinFinder:
 
 # ========== WEBSOCKET MANAGER ==========
 class WebSocketManager:
-    def __init__(self):
-        self.connections = {}
+    """
+    1 kết nối trade stream cho mỗi symbol, dùng chung cho mọi bot / tài khoản.
+    Mỗi subscriber (owner, thường là bot_id) đăng ký 1 callback; kết nối đóng khi không còn subscriber.
+    """
+    def __init__(self, runtime=None):
+        self.runtime = runtime or get_runtime()
+        self.connections = {}       # {symbol: {"ws", "thread", "callback", "subscribers": {owner: callback}}}
         self.executor = ThreadPoolExecutor(max_workers=10)
         self._lock = threading.Lock()
         self._stop_event = threading.Event()
 
-    def add_symbol(self, symbol, callback):
+    def add_symbol(self, symbol, callback, owner=None):
         if not symbol:
             return
-        symbol = symbol.upper()
+        symbol = self.runtime.symbols.intern(symbol).symbol
         with self._lock:
-            if symbol not in self.connections:
-                self._create_connection(symbol, callback)
+            conn = self.connections.get(symbol)
+            if conn is None:
+                self._create_connection(symbol, {owner: callback})
+            else:
+                conn["subscribers"][owner] = callback
 
-    def _create_connection(self, symbol, callback):
+    def _create_connection(self, symbol, subscribers):
         if self._stop_event.is_set():
             return
         
-        stream = f"{symbol.lower()}@trade"
-        url = f"wss://fstream.binance.com/ws/{stream}"
+        stream = self.runtime.symbols.intern(symbol).stream
+        url = self.runtime.ws_url(stream)
+        callback = lambda price: self._dispatch(symbol, price)
+        self.runtime.candles.track(symbol)
 
         def on_message(ws, message):
-            try:
-                data = json.loads(message)
-                if "p" in data:
-                    price = float(data["p"])
-                    self.executor.submit(callback, price)
-            except Exception as e:
-                logger.error(f"Lỗi xử lý message WebSocket {symbol}: {str(e)}")
+            self._handle_message(symbol, callback, message)
 
         def on_error(ws, error):
+            WS_ERRORS.inc(kind="socket")
             logger.error(f"Lỗi WebSocket {symbol}: {error}")
             if not self._stop_event.is_set():
-                time.sleep(5)
-                self._reconnect(symbol, callback)
+                self.runtime.sleep(5)
+                self._reconnect(symbol, ws)
 
         def on_close(ws, close_status_code, close_msg):
             logger.info(f"WebSocket đóng {symbol}: {close_status_code}, {close_msg}")
             if not self._stop_event.is_set() and symbol in self.connections:
-                time.sleep(5)
-                self._reconnect(symbol, callback)
+                self.runtime.sleep(5)
+                self._reconnect(symbol, ws)
 
         ws = websocket.WebSocketApp(
             url,
@@ -850,33 +3335,793 @@ class WebSocketManager:
         thread = threading.Thread(target=ws.run_forever, kwargs={"ping_interval": 20}, daemon=True)
         thread.start()
         
-        self.connections[symbol] = {"ws": ws, "thread": thread, "callback": callback}
+        self.connections[symbol] = {"ws": ws, "thread": thread, "callback": callback, "subscribers": subscribers}
+        WS_CONNECTIONS.set(len(self.connections))
         logger.info(f"Đã start WebSocket cho {symbol}")
 
-    def _reconnect(self, symbol, callback):
-        logger.info(f"Reconnect WebSocket cho {symbol}")
-        self.remove_symbol(symbol)
-        self._create_connection(symbol, callback)
+    def _dispatch(self, symbol, price):
+        conn = self.connections.get(symbol)
+        if not conn:
+            return
+        for owner, callback in list(conn["subscribers"].items()):
+            try:
+                callback(price)
+            except Exception as e:
+                logger.error(f"Lỗi callback giá {symbol} ({owner}): {str(e)}")
+
+    def _handle_message(self, symbol, callback, message):
+        started = time.perf_counter()
+        try:
+            data = json.loads(message)
+            if "p" in data:
+                price = float(data["p"])
+                # gộp trade vào nến 1m ngay trên thread WebSocket (vài phép so sánh)
+                self.runtime.candles.on_trade(symbol, price, data.get("q"), data.get("T"))
+                self.executor.submit(callback, price)
+            WS_MESSAGES.inc()
+        except Exception as e:
+            WS_ERRORS.inc(kind="message")
+            logger.error(f"Lỗi xử lý message WebSocket {symbol}: {str(e)}")
+        finally:
+            WS_HANDLE_LATENCY.observe(time.perf_counter() - started)
+
+    def _reconnect(self, symbol, old_ws):
+        with self._lock:
+            conn = self.connections.get(symbol)
+            # đã có kết nối mới / symbol đã bị gỡ -> bỏ qua
+            if not conn or conn["ws"] is not old_ws:
+                return
+            WS_RECONNECTS.inc()
+            logger.info(f"Reconnect WebSocket cho {symbol}")
+            del self.connections[symbol]
+            self.runtime.candles.reset(symbol)
+            try:
+                old_ws.close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng WebSocket {symbol}: {str(e)}")
+            # giữ nguyên subscriber khi reconnect
+            self._create_connection(symbol, conn["subscribers"])
 
-    def remove_symbol(self, symbol):
+    def remove_symbol(self, symbol, owner=None):
+        """owner=None: gỡ toàn bộ subscriber; ngược lại chỉ gỡ owner đó"""
         if not symbol:
             return
-        symbol = symbol.upper()
+        symbol = self.runtime.symbols.intern(symbol).symbol
         with self._lock:
             conn = self.connections.get(symbol)
-            if conn:
-                try:
-                    conn["ws"].close()
-                except Exception as e:
-                    logger.error(f"Lỗi đóng WebSocket {symbol}: {str(e)}")
-                del self.connections[symbol]
+            if not conn:
+                return
+            if owner is not None:
+                conn["subscribers"].pop(owner, None)
+                if conn["subscribers"]:
+                    return
+            try:
+                conn["ws"].close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng WebSocket {symbol}: {str(e)}")
+            del self.connections[symbol]
+            self.runtime.candles.untrack(symbol)
+            WS_CONNECTIONS.set(len(self.connections))
 
     def stop(self):
         self._stop_event.set()
         for symbol in list(self.connections.keys()):
             self.remove_symbol(symbol)
 
+# ========== BẢNG GIÁ TOÀN THỊ TRƯỜNG (ALL-MARKET STREAM) ==========
+MARKET_STREAMS = ("!miniTicker@arr", "!markPrice@arr@1s")
+# stream im lặng lâu hơn ngưỡng này -> coi như mất, quay về REST
+MARKET_STREAM_MAX_SILENCE = 5.0
+
+MARKET_STREAM_UPDATES = metrics.counter(
+    "market_stream_updates_total", "Số cập nhật giá nhận từ stream toàn thị trường theo loại"
+)
+
+class UniversePriceTable:
+    """
+    Giá last (miniTicker) + mark price của toàn bộ symbol qua 1 kết nối WebSocket combined stream.
+    Giá lưu trong mảng NumPy cấp phát sẵn, đánh chỉ số theo id symbol của SymbolRegistry:
+    mọi bot, bộ quét coin và màn hình Telegram đọc giá bất kỳ symbol với O(1).
+    Stream !miniTicker@arr chỉ gửi symbol có thay đổi -> độ mới tính theo kết nối, không theo symbol.
+    """
+    def __init__(self, runtime, capacity=1024, streams=MARKET_STREAMS):
+        self.runtime = runtime
+        self.streams = streams
+        self.registry = runtime.symbols
+        self._initial_capacity = capacity
+        self._capacity = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._ws = None
+        self._last_message_at = 0
+
+    def _ensure_capacity(self, size):
+        if size <= self._capacity:
+            return
+        capacity = max(self._capacity * 2, self._initial_capacity, size)
+        for name in ("_last", "_mark", "_updated_at"):
+            arr = np.zeros(capacity, dtype=np.float64)
+            if self._capacity:
+                arr[:self._capacity] = getattr(self, name)
+            setattr(self, name, arr)
+        self._capacity = capacity
+
+    def symbol_id(self, symbol):
+        """Id registry của symbol (mở rộng mảng nếu id mới vượt dung lượng)"""
+        idx = self.registry.id_of(symbol)
+        if idx >= self._capacity:
+            with self._lock:
+                self._ensure_capacity(idx + 1)
+        return idx
+
+    # ----- kết nối -----
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name="market-stream", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng stream toàn thị trường: {str(e)}")
+
+    def _run(self):
+        url = self.runtime.ws_combined_url(self.streams)
+        while not self._stop_event.is_set():
+            self._ws = websocket.WebSocketApp(
+                url,
+                on_message=lambda ws, message: self.handle_message(message),
+                on_error=lambda ws, error: WS_ERRORS.inc(kind="market_stream")
+            )
+            logger.info(f"Đã start stream toàn thị trường: {', '.join(self.streams)}")
+            self._ws.run_forever(ping_interval=20)
+            if self._stop_event.wait(5):
+                break
+            WS_RECONNECTS.inc()
+            logger.info("Reconnect stream toàn thị trường")
+        self._ws = None
+
+    def handle_message(self, message):
+        """Message combined stream: {"stream": ..., "data": [ {s, c|p, ...}, ... ]}"""
+        try:
+            payload = json.loads(message)
+            items = payload.get("data", payload) if isinstance(payload, dict) else payload
+            if isinstance(items, dict):
+                items = [items]
+            if not items:
+                return
+            is_mark = items[0].get("e") == "markPriceUpdate"
+            field = "p" if is_mark else "c"
+            ids = []
+            values = []
+            symbol_id = self.symbol_id
+            for item in items:
+                value = item.get(field)
+                if value is None:
+                    continue
+                ids.append(symbol_id(item["s"]))
+                values.append(float(value))
+            if not ids:
+                return
+            now = self.runtime.time()
+            with self._lock:
+                target = self._mark if is_mark else self._last
+                target[ids] = values
+                self._updated_at[ids] = now
+                self._last_message_at = now
+            MARKET_STREAM_UPDATES.inc(len(ids), kind="mark" if is_mark else "last")
+        except Exception as e:
+            WS_ERRORS.inc(kind="market_stream_message")
+            logger.error(f"Lỗi xử lý stream toàn thị trường: {str(e)}")
+
+    # ----- đọc giá -----
+    def alive(self):
+        return bool(self._last_message_at) and (
+            self.runtime.time() - self._last_message_at <= MARKET_STREAM_MAX_SILENCE
+        )
+
+    def price(self, symbol, kind="last"):
+        """Giá last (hoặc kind="mark") của symbol; None nếu stream không chạy / chưa có giá"""
+        if not self.alive():
+            return None
+        info = self.registry.get(symbol)
+        if info is None or info.id >= self._capacity:
+            return None
+        value = (self._mark if kind == "mark" else self._last)[info.id]
+        return float(value) if value > 0 else None
+
+    def updated_at(self, symbol):
+        info = self.registry.get(symbol)
+        if info is None or info.id >= self._capacity:
+            return None
+        return float(self._updated_at[info.id]) or None
+
+    def __len__(self):
+        """Số symbol đã có giá"""
+        return int(np.count_nonzero(self._updated_at)) if self._capacity else 0
+
+# ========== NẾN ĐA KHUNG TỪ TRADE STREAM ==========
+CANDLE_TIMEFRAMES = ("1m", "5m", "15m", "1h")
+CANDLE_HISTORY_MINUTES = 1000   # nến 1m giữ lại: đủ 15 nến 1h, nạp bằng 1 request klines (weight 5)
+MINUTE_MS = 60_000
+
+CANDLE_TRADES = metrics.counter("candle_trades_total", "Số trade đã gộp vào nến 1m")
+CANDLE_SEEDS = metrics.counter("candle_seeds_total", "Số lần nạp lịch sử nến 1m qua REST theo kết quả")
+CANDLE_SERIES = metrics.gauge("candle_series", "Số symbol đang dựng nến từ trade stream")
+
+def _aggregate_bars(minutes, span):
+    """Gộp nến 1m [open_time, o, h, l, c, v, close_time] thành nến khung span ms (giữ thứ tự)"""
+    bars = []
+    for m in minutes:
+        start = m[0] - m[0] % span
+        if bars and bars[-1][0] == start:
+            bar = bars[-1]
+            if not m[5]:
+                continue    # phút không có trade (nến phẳng theo giá đóng trước) không đổi OHLC
+            if not bar[5]:
+                # khung chỉ mới có phút phẳng: open/high/low lấy từ phút có trade đầu tiên
+                bar[1], bar[2], bar[3] = m[1], m[2], m[3]
+            if m[2] > bar[2]:
+                bar[2] = m[2]
+            if m[3] < bar[3]:
+                bar[3] = m[3]
+            bar[4] = m[4]
+            bar[5] += m[5]
+        else:
+            bars.append([start, m[1], m[2], m[3], m[4], m[5], start + span - 1])
+    return bars
+
+class CandleSeries:
+    """
+    Nến 1m của 1 symbol dựng từ trade stream (lịch sử nạp 1 lần qua REST) + nến khung lớn hơn
+    gộp tại chỗ từ nến 1m. Nến: [open_time, open, high, low, close, volume, close_time] như klines.
+    """
+    __slots__ = ("symbol", "minutes", "forming", "closed_bars", "seeded", "_lock")
+
+    def __init__(self, symbol, timeframes=CANDLE_TIMEFRAMES, history=CANDLE_HISTORY_MINUTES):
+        self.symbol = symbol
+        self.minutes = deque(maxlen=history)     # nến 1m đã đóng
+        self.forming = None                      # nến 1m đang chạy
+        self.closed_bars = {
+            tf: deque(maxlen=history * MINUTE_MS // KLINE_INTERVAL_MS[tf] + 1)
+            for tf in timeframes if tf != "1m"
+        }
+        self.seeded = False
+        self._lock = threading.Lock()
+
+    def seed(self, rows, now_ms):
+        """Nạp nến 1m từ REST klines (nến cuối có thể đang chạy); trade trước lúc nạp đã nằm trong đó"""
+        rows = [
+            [int(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5]), int(k[6])]
+            for k in rows
+        ]
+        closed = [r for r in rows if r[6] < now_ms]
+        forming = rows[-1] if rows and rows[-1][6] >= now_ms else None
+        with self._lock:
+            self.minutes.clear()
+            self.minutes.extend(closed)
+            self.forming = forming
+            for tf, bars in self.closed_bars.items():
+                bars.clear()
+                if not closed:
+                    continue
+                span = KLINE_INTERVAL_MS[tf]
+                aggregated = _aggregate_bars(closed, span)
+                # bỏ nến đầu thiếu phút (lịch sử bắt đầu giữa khung) và nến cuối chưa đóng
+                if aggregated and aggregated[0][0] < closed[0][0]:
+                    aggregated.pop(0)
+                if aggregated and aggregated[-1][6] > closed[-1][6]:
+                    aggregated.pop()
+                bars.extend(aggregated)
+            self.seeded = bool(rows)
+
+    def on_trade(self, price, qty, trade_ms):
+        with self._lock:
+            if not self.seeded or not self._advance(trade_ms):
+                return
+            bar = self.forming
+            if trade_ms < bar[0]:
+                return      # trade trễ thuộc phút đã đóng
+            if bar[5] == 0:
+                # trade đầu tiên của phút: open/high/low là giá trade (như kline của sàn)
+                bar[1] = bar[2] = bar[3] = price
+            if price > bar[2]:
+                bar[2] = price
+            if price < bar[3]:
+                bar[3] = price
+            bar[4] = price
+            bar[5] += qty
+
+    def bars(self, interval, limit, now_ms):
+        """limit nến khung interval (nến cuối đang chạy); None nếu chưa đủ lịch sử"""
+        with self._lock:
+            if not self.seeded or not self._advance(now_ms):
+                return None
+            if interval == "1m":
+                if len(self.minutes) < limit - 1:
+                    return None
+                closed = list(self.minutes)[len(self.minutes) - (limit - 1):] if limit > 1 else []
+                return [list(m) for m in closed] + [list(self.forming)]
+            bars = self.closed_bars.get(interval)
+            if bars is None or len(bars) < limit - 1:
+                return None
+            span = KLINE_INTERVAL_MS[interval]
+            start = self.forming[0] - self.forming[0] % span
+            bucket = [self.forming]
+            for m in reversed(self.minutes):
+                if m[0] < start:
+                    break
+                bucket.append(m)
+            bucket.reverse()
+            closed = list(bars)[len(bars) - (limit - 1):] if limit > 1 else []
+            return [list(b) for b in closed] + _aggregate_bars(bucket, span)
+
+    def _advance(self, now_ms):
+        """Đóng các phút đã qua (phút không có trade -> nến phẳng); False nếu khoảng trống quá dài"""
+        minute = now_ms - now_ms % MINUTE_MS
+        bar = self.forming
+        if bar is None:
+            if not self.minutes:
+                return False
+            last = self.minutes[-1]
+            bar = [last[0] + MINUTE_MS, last[4], last[4], last[4], last[4], 0.0, last[6] + MINUTE_MS]
+        if (minute - bar[0]) // MINUTE_MS > self.minutes.maxlen:
+            self.seeded = False     # mất dữ liệu quá lâu -> nạp lại
+            return False
+        while bar[0] < minute:
+            self._close_minute(bar)
+            close = bar[4]
+            bar = [bar[0] + MINUTE_MS, close, close, close, close, 0.0, bar[6] + MINUTE_MS]
+        self.forming = bar
+        return True
+
+    def _close_minute(self, bar):
+        self.minutes.append(bar)
+        end = bar[6] + 1
+        for tf, bars in self.closed_bars.items():
+            span = KLINE_INTERVAL_MS[tf]
+            if end % span:
+                continue
+            start = end - span
+            bucket = []
+            for m in reversed(self.minutes):
+                if m[0] < start:
+                    break
+                bucket.append(m)
+            # chỉ nhận nến khung lớn có đủ phút từ đầu khung
+            if bucket and bucket[-1][0] == start:
+                bucket.reverse()
+                bars.extend(_aggregate_bars(bucket, span))
+
+class CandleStore:
+    """
+    Nến đa khung cho các symbol đang có trade stream (WebSocketManager đăng ký / hủy).
+    Lịch sử 1m nạp lười 1 lần qua REST ở lần đọc đầu; sau đó 5m/15m/1h gộp từ 1m, không gọi mạng.
+    """
+    def __init__(self, runtime, timeframes=CANDLE_TIMEFRAMES, history=CANDLE_HISTORY_MINUTES):
+        self.runtime = runtime
+        self.timeframes = tuple(timeframes)
+        self.history = history
+        self._series = {}       # {symbol: CandleSeries}
+        self._lock = threading.Lock()
+
+    def track(self, symbol):
+        with self._lock:
+            if symbol not in self._series:
+                self._series[symbol] = CandleSeries(symbol, self.timeframes, self.history)
+            CANDLE_SERIES.set(len(self._series))
+
+    def untrack(self, symbol):
+        with self._lock:
+            self._series.pop(symbol, None)
+            CANDLE_SERIES.set(len(self._series))
+
+    def reset(self, symbol):
+        """Stream vừa reconnect (có thể mất trade) -> nạp lại lịch sử ở lần đọc kế tiếp"""
+        series = self._series.get(symbol)
+        if series is not None:
+            series.seeded = False
+
+    def on_trade(self, symbol, price, qty, trade_ms):
+        """qty / trade_ms nguyên dạng message (chuỗi / số); chỉ parse khi symbol đang được dựng nến"""
+        series = self._series.get(symbol)
+        if series is not None and trade_ms is not None:
+            series.on_trade(price, float(qty or 0), int(trade_ms))
+            CANDLE_TRADES.inc()
+
+    def bars(self, symbol, interval, limit):
+        """limit nến khung interval từ trade stream; None nếu symbol không có stream / khung không hỗ trợ"""
+        series = self._series.get(symbol)
+        if series is None or (interval != "1m" and interval not in series.closed_bars):
+            return None
+        now_ms = int((self.runtime.time() + self.runtime.server_clock.offset) * 1000)
+        if not series.seeded:
+            self._seed(series, now_ms)
+        return series.bars(interval, limit, now_ms)
+
+    def _seed(self, series, now_ms):
+        rows = binance_api_request(
+            self.runtime.rest_url("/fapi/v1/klines"),
+            params={"symbol": series.symbol, "interval": "1m", "limit": self.history},
+            runtime=self.runtime
+        )
+        if not rows:
+            CANDLE_SEEDS.inc(result="failed")
+            return
+        series.seed(rows, now_ms)
+        CANDLE_SEEDS.inc(result="ok")
+
+# ========== TRẠNG THÁI SYMBOL ==========
+class SymbolState:
+    """
+    Trạng thái 1 symbol của bot. Dùng __slots__ thay dict 16 key: ít bộ nhớ, truy cập thuộc tính nhanh.
+    Chỉ thread _run của bot ghi các trường vị thế; thread khác (WebSocket, Telegram) chỉ ghi
+    current_price (gán 1 thuộc tính) hoặc đi qua các hàm có lock (update / begin_close).
+    """
+    FIELDS = (
+        "status", "side", "quantity", "entry_price", "current_price", "position_open",
+        "last_trade_time", "last_close_time", "entry_base_price", "average_down_count",
+        "last_average_down_time", "high_water_mark_roi", "roi_check_activated",
+        "close_attempted", "last_close_attempt_time", "last_position_check",
+    )
+    __slots__ = FIELDS + ("_lock",)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status = "waiting"
+        self.side = ""
+        self.quantity = 0
+        self.entry_price = 0
+        self.current_price = 0
+        self.position_open = False
+        self.last_trade_time = 0
+        self.last_close_time = 0
+        self.entry_base_price = 0
+        self.average_down_count = 0
+        self.last_average_down_time = 0
+        self.high_water_mark_roi = 0
+        self.roi_check_activated = False
+        self.close_attempted = False
+        self.last_close_attempt_time = 0
+        self.last_position_check = 0
+
+    @classmethod
+    def from_saved(cls, saved):
+        """Dựng lại từ dict đã lưu (bỏ key lạ, bỏ cờ đang đóng lệnh)"""
+        state = cls()
+        state.update(**{k: v for k, v in saved.items() if k in cls.FIELDS})
+        state.close_attempted = False
+        state.last_close_attempt_time = 0
+        return state
+
+    def update(self, **fields):
+        """Cập nhật nhiều trường cùng lúc (nguyên tử với snapshot/begin_close)"""
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def snapshot(self):
+        """Bản sao dict nhất quán (dùng để lưu / hiển thị)"""
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+    def position(self):
+        """(position_open, side, entry_price, quantity) đọc nhất quán"""
+        with self._lock:
+            return self.position_open, self.side, self.entry_price, self.quantity
+
+    def reset_position(self):
+        with self._lock:
+            self.position_open = False
+            self.status = "waiting"
+            self.side = ""
+            self.quantity = 0
+            self.entry_price = 0
+            self.close_attempted = False
+            self.last_close_attempt_time = 0
+            self.entry_base_price = 0
+            self.average_down_count = 0
+            self.high_water_mark_roi = 0
+            self.roi_check_activated = False
+
+    def begin_close(self, now, retry_after=10):
+        """
+        Giành quyền đóng vị thế (compare-and-set): False nếu không có vị thế
+        hoặc thread khác vừa gửi lệnh đóng trong retry_after giây -> không đóng trùng.
+        Lệnh đóng trùng còn bị chặn bởi OrderManager (in-flight + reduceOnly) nên cửa sổ ngắn là đủ.
+        """
+        with self._lock:
+            if not self.position_open or abs(self.quantity) <= 0:
+                return False
+            if self.close_attempted and now - self.last_close_attempt_time < retry_after:
+                return False
+            self.close_attempted = True
+            self.last_close_attempt_time = now
+            return True
+
+# ========== SỔ VỊ THẾ (NUMPY, VECTOR HÓA) ==========
+# Mốc lỗ (% ROI theo entry gốc) để nhồi lệnh Fibonacci
+AVERAGE_DOWN_LEVELS = (200, 300, 500, 800, 1300, 2100, 3400)
+# Giá từ WebSocket cũ hơn ngưỡng này -> lấy lại qua REST
+PRICE_MAX_AGE = 2.0
+# Thread nền của sổ vị thế gom các tick giá trong khoảng này rồi đánh giá cả sổ 1 lần
+POSITION_BOOK_BATCH_INTERVAL = 0.1
+
+POSITION_BOOK_EVALUATIONS = metrics.counter(
+    "position_book_evaluations_total", "Số lần tính ROI/TP/SL vector hóa cho toàn bộ vị thế"
+)
+POSITION_BOOK_SIZE = metrics.gauge("position_book_positions", "Số vị thế đang mở trong sổ vị thế")
+
+def position_roi(side, entry_price, quantity, price, leverage):
+    """ROI (%) theo vốn ký quỹ: lãi / (entry * qty / leverage) * 100; 0 nếu thiếu dữ liệu"""
+    invested = entry_price * abs(quantity) / leverage if leverage else 0
+    if invested <= 0 or price <= 0:
+        return 0
+    if side == "BUY":
+        profit = (price - entry_price) * abs(quantity)
+    else:
+        profit = (entry_price - price) * abs(quantity)
+    return profit / invested * 100
+
+class PositionRisk:
+    """Kết quả đánh giá 1 vị thế từ PositionBook"""
+    __slots__ = ("price", "roi", "base_roi", "high_water_mark_roi", "tp_hit", "sl_hit", "roi_armed", "average_due")
+
+    def __init__(self, price, roi, base_roi, high_water_mark_roi, tp_hit, sl_hit, roi_armed, average_due):
+        self.price = price
+        self.roi = roi
+        self.base_roi = base_roi
+        self.high_water_mark_roi = high_water_mark_roi
+        self.tp_hit = tp_hit
+        self.sl_hit = sl_hit
+        self.roi_armed = roi_armed
+        self.average_due = average_due
+
+class PositionBook:
+    """
+    Sổ vị thế dùng chung cho mọi bot: entry, khối lượng, hướng, đòn bẩy, ngưỡng TP/SL/ROI
+    nằm trong mảng NumPy (struct-of-arrays, 1 dòng / (bot_id, symbol)).
+    Giá từ WebSocket cập nhật thẳng vào mảng; thread nền "position-book" gom tick trong
+    batch_interval giây rồi gọi evaluate() 1 lần: tính ROI, ROI đỉnh và trigger TP/SL/ROI/nhồi
+    cho toàn bộ vị thế trong 1 bước vector hóa. Bot đọc kết quả đã tính qua risk() (O(1), trễ
+    tối đa 1 batch); chỉ thread bot gửi lệnh (book không đặt lệnh).
+    """
+    def __init__(self, capacity=64, clock=time.time, registry=None, batch_interval=POSITION_BOOK_BATCH_INTERVAL):
+        self.clock = clock
+        self.batch_interval = batch_interval
+        self.registry = registry if registry is not None else get_runtime().symbols
+        self._lock = threading.Lock()
+        self._index = {}                    # {(bot_id, symbol): row}
+        self._symbol_rows = defaultdict(set)  # {symbol_id: {row}} để cập nhật giá theo symbol
+        self._prices = {}                   # {symbol_id: (price, ts)} kể cả symbol chưa có vị thế
+        self._free = []
+        self._size = 0
+        self._version = 0
+        self._evaluated_version = -1
+        self._dirty = threading.Event()     # có tick giá / vị thế mới chưa đánh giá
+        self._stop_event = threading.Event()
+        self._thread = None
+        # cấp phát mảng khi có vị thế đầu tiên (không import NumPy lúc khởi động)
+        self._initial_capacity = capacity
+        self._capacity = 0
+        self._levels = None
+
+    def _alloc(self, capacity):
+        old = self._capacity
+        self._capacity = capacity
+        if self._levels is None:
+            self._levels = np.array(AVERAGE_DOWN_LEVELS, dtype=np.float64)
+
+        def grow(name, fill, dtype=np.float64):
+            arr = np.full(capacity, fill, dtype=dtype)
+            if old:
+                arr[:old] = getattr(self, name)
+            setattr(self, name, arr)
+
+        grow("active", False, np.bool_)
+        grow("direction", 0.0)          # +1 BUY, -1 SELL
+        grow("entry", 0.0)
+        grow("base_entry", 0.0)
+        grow("quantity", 0.0)
+        grow("leverage", 0.0)
+        grow("take_profit", np.nan)
+        grow("stop_loss", np.nan)
+        grow("roi_trigger", np.nan)
+        grow("average_count", 0, np.int64)
+        grow("price", 0.0)
+        grow("roi", np.nan)
+        grow("base_roi", np.nan)
+        grow("hwm", 0.0)
+        grow("tp_hit", False, np.bool_)
+        grow("sl_hit", False, np.bool_)
+        grow("roi_armed", False, np.bool_)
+        grow("average_due", False, np.bool_)
+
+    def __len__(self):
+        return len(self._index)
+
+    def start(self):
+        """Chạy thread đánh giá theo batch (tự gọi khi có vị thế đầu tiên)"""
+        with self._lock:
+            if self._thread is None:
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name="position-book", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=1):
+        self._stop_event.set()
+        self._dirty.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if not self._dirty.wait(1):
+                continue
+            self._dirty.clear()
+            try:
+                self.evaluate()
+            except Exception as e:
+                logger.error(f"Lỗi đánh giá sổ vị thế: {str(e)}")
+            # các tick đến trong lúc chờ được gom vào lần đánh giá sau
+            self._stop_event.wait(self.batch_interval)
+
+    @staticmethod
+    def _threshold(value):
+        return np.nan if value is None else float(value)
+
+    def upsert(self, key, side, entry_price, quantity, leverage, take_profit=None, stop_loss=None,
+               roi_trigger=None, entry_base_price=0, average_down_count=0, high_water_mark_roi=0):
+        """Ghi / cập nhật 1 vị thế mở (giữ ROI đỉnh đã tính nếu vẫn là cùng vị thế)"""
+        symbol_id = self.registry.id_of(key[1])
+        with self._lock:
+            row = self._index.get(key)
+            if row is None:
+                if self._free:
+                    row = self._free.pop()
+                else:
+                    if self._size == self._capacity:
+                        self._alloc(self._capacity * 2 or self._initial_capacity)
+                    row = self._size
+                    self._size += 1
+                self._index[key] = row
+                self._symbol_rows[symbol_id].add(row)
+                self.hwm[row] = 0.0
+                cached = self._prices.get(symbol_id)
+                self.price[row] = cached[0] if cached else 0.0
+            direction = 1.0 if side == "BUY" else -1.0
+            # entry gốc = 0 (vị thế có sẵn trên sàn, không do bot mở) -> không nhồi
+            base_entry = float(entry_base_price or 0)
+            same_position = (
+                self.active[row] and self.direction[row] == direction and self.base_entry[row] == base_entry
+                and (base_entry or self.entry[row] == float(entry_price))
+            )
+            self.active[row] = True
+            self.direction[row] = direction
+            self.entry[row] = float(entry_price)
+            self.base_entry[row] = base_entry
+            self.quantity[row] = abs(float(quantity))
+            self.leverage[row] = float(leverage or 0)
+            self.take_profit[row] = self._threshold(take_profit)
+            self.stop_loss[row] = self._threshold(stop_loss)
+            self.roi_trigger[row] = self._threshold(roi_trigger)
+            self.average_count[row] = int(average_down_count)
+            self.hwm[row] = max(self.hwm[row], high_water_mark_roi) if same_position else high_water_mark_roi
+            # chỉ tính lại dòng này -> risk() có ngay kết quả mà không phải chờ batch
+            self._compute([row])
+            POSITION_BOOK_SIZE.set(len(self._index))
+            started = self._thread is not None
+        if not started:
+            self.start()
+
+    def remove(self, key):
+        with self._lock:
+            row = self._index.pop(key, None)
+            if row is None:
+                return False
+            symbol_id = self.registry.id_of(key[1])
+            rows = self._symbol_rows.get(symbol_id)
+            if rows is not None:
+                rows.discard(row)
+                if not rows:
+                    del self._symbol_rows[symbol_id]
+            self.active[row] = False
+            self.tp_hit[row] = self.sl_hit[row] = self.roi_armed[row] = self.average_due[row] = False
+            self.roi[row] = self.base_roi[row] = np.nan
+            self._free.append(row)
+            POSITION_BOOK_SIZE.set(len(self._index))
+            return True
+
+    def set_price(self, symbol, price, ts=None):
+        """Cập nhật giá (từ WebSocket / REST) cho mọi vị thế của symbol"""
+        if price <= 0:
+            return
+        ts = self.clock() if ts is None else ts
+        symbol_id = self.registry.id_of(symbol)
+        with self._lock:
+            self._prices[symbol_id] = (price, ts)
+            rows = self._symbol_rows.get(symbol_id)
+            if rows:
+                for row in rows:
+                    self.price[row] = price
+                self._version += 1
+                self._dirty.set()
+
+    def fresh_price(self, symbol, max_age=PRICE_MAX_AGE):
+        """Giá gần nhất nếu chưa quá max_age giây, ngược lại None"""
+        info = self.registry.get(symbol)
+        cached = self._prices.get(info.id) if info is not None else None
+        if cached and self.clock() - cached[1] <= max_age:
+            return cached[0]
+        return None
+
+    def forget_price(self, symbol):
+        self._prices.pop(self.registry.id_of(symbol), None)
+
+    def evaluate(self):
+        """Tính lại ROI / ROI đỉnh / trigger cho toàn bộ vị thế (bỏ qua nếu giá không đổi)"""
+        with self._lock:
+            if self._evaluated_version == self._version:
+                return False
+            self._evaluated_version = self._version
+            if not self._size:
+                return False
+            self._compute(slice(0, self._size))
+            POSITION_BOOK_EVALUATIONS.inc()
+            return True
+
+    def _compute(self, rows):
+        """Bước vector hóa cho các dòng rows (slice hoặc list chỉ số); gọi khi đang giữ _lock"""
+        active = self.active[rows]
+        price = self.price[rows]
+        direction = self.direction[rows]
+        leverage = self.leverage[rows]
+        entry = self.entry[rows]
+        base_entry = self.base_entry[rows]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            valid = active & (price > 0) & (leverage > 0)
+            # ROI = hướng * (giá - entry) / entry * đòn bẩy * 100 (= lãi / vốn ký quỹ)
+            roi = np.where(valid & (entry > 0), direction * (price - entry) / entry * leverage * 100, np.nan)
+            base_roi = np.where(valid & (base_entry > 0),
+                                direction * (price - base_entry) / base_entry * leverage * 100, np.nan)
+        has_roi = ~np.isnan(roi)
+        hwm = np.where(has_roi, np.fmax(self.hwm[rows], roi), self.hwm[rows])
+        self.roi[rows] = roi
+        self.base_roi[rows] = base_roi
+        self.hwm[rows] = hwm
+        # so sánh với NaN (ngưỡng tắt / chưa có giá) luôn False
+        with np.errstate(invalid="ignore"):
+            self.tp_hit[rows] = has_roi & (roi >= self.take_profit[rows])
+            self.sl_hit[rows] = has_roi & (self.stop_loss[rows] > 0) & (roi <= -self.stop_loss[rows])
+            self.roi_armed[rows] = active & (hwm >= self.roi_trigger[rows])
+            count = self.average_count[rows]
+            level = self._levels[np.minimum(count, len(self._levels) - 1)]
+            self.average_due[rows] = (count < len(self._levels)) & (base_roi < 0) & (-base_roi >= level)
+
+    def risk(self, key):
+        """PositionRisk của 1 vị thế từ lần đánh giá gần nhất (không tính lại sổ), None nếu không có"""
+        with self._lock:
+            row = self._index.get(key)
+            if row is None or np.isnan(self.roi[row]):
+                return None
+            return PositionRisk(
+                float(self.price[row]), float(self.roi[row]), float(self.base_roi[row]),
+                float(self.hwm[row]), bool(self.tp_hit[row]), bool(self.sl_hit[row]),
+                bool(self.roi_armed[row]), bool(self.average_due[row])
+            )
+
 # ========== BASE BOT (GIAO DỊCH NỐI TIẾP, FORMAT CŨ) ==========
+STOP_SYMBOL_TIMEOUT = 15    # giây thread gọi stop_symbol chờ vòng _run thực hiện lệnh dừng
+
 class BaseBot:
     def __init__(
         self,
@@ -896,8 +4141,24 @@ class BaseBot:
         bot_id=None,
         coin_manager=None,
         symbol_locks=None,
-        max_coins=1
+        max_coins=1,
+        runtime=None,
+        auto_start=True,
+        profiler=None,
+        notifier=None,
+        state_store=None,
+        restored_symbols=None,
+        journal=None,
+        open_positions_snapshot=None,
+        position_book=None,
+        order_manager=None,
+        confirm_timeframes=()
     ):
+        # Ngữ cảnh runtime (base URL + đồng hồ)
+        self.runtime = runtime or get_runtime()
+        # Profiling vòng lặp (tắt mặc định)
+        self.profiler = profiler or NULL_PROFILER
+        
         # Cấu hình cơ bản
         self.symbol = symbol.upper() if symbol else None
         self.leverage = leverage
@@ -914,7 +4175,12 @@ class BaseBot:
         self.strategy_name = strategy_name
         self.config_key = config_key
         
-        self.bot_id = bot_id or f"{strategy_name}_{int(time.time())}_{random.randint(1000, 9999)}"
+        # Thông báo Telegram gửi nền (không chặn luồng giao dịch)
+        self.notifier = notifier
+        if self.notifier is None and telegram_bot_token and telegram_chat_id:
+            self.notifier = TelegramNotifier(telegram_bot_token, telegram_chat_id, runtime=self.runtime)
+        
+        self.bot_id = bot_id or f"{strategy_name}_{int(self.runtime.time())}_{random.randint(1000, 9999)}"
         
         # Thông tin trạng thái toàn bot
         self.status = "searching"
@@ -924,6 +4190,9 @@ class BaseBot:
         self.max_coins = max_coins
         self.active_symbols = []
         self.symbol_data = {}
+        # Lệnh dừng coin từ thread khác (Telegram, manager) -> vòng _run thực hiện,
+        # chỉ thread bot thêm / xóa symbol_data trong lúc bot chạy
+        self._commands = queue.SimpleQueue()
         
         self.current_processing_symbol = None
         self.last_trade_completion_time = 0
@@ -941,68 +4210,137 @@ class BaseBot:
         # Quản lý coin toàn hệ thống
         self.coin_manager = coin_manager or CoinManager()
         self.symbol_locks = symbol_locks or defaultdict(threading.Lock)
-        self.smart_finder = SmartCoinFinder(api_key, api_secret)
+        self.smart_finder = SmartCoinFinder(
+            api_key, api_secret, runtime=self.runtime, confirm_timeframes=confirm_timeframes
+        )
+        # Đặt lệnh idempotent (Account dùng chung cho các bot cùng tài khoản)
+        self.orders = order_manager or OrderManager(api_key, api_secret, runtime=self.runtime)
         
         # Flag: sau khi đóng hết sẽ tìm coin mới
         self.find_new_bot_after_close = True
-        self.bot_creation_time = time.time()
+        self.bot_creation_time = self.runtime.time()
+        
+        # Lock quản lý symbol (RLock: _find_and_add_new_coin gọi lồng _add_symbol/stop_symbol)
+        self.symbol_management_lock = threading.RLock()
         
-        # Lock quản lý symbol
-        self.symbol_management_lock = threading.Lock()
+        # Lưu trạng thái bền vững (khôi phục sau restart) + nhật ký giao dịch
+        self.state_store = state_store
+        self.journal = journal
+        # Sổ vị thế NumPy (BotManager dùng chung cho mọi bot -> ROI/TP/SL tính 1 lần cho cả sổ)
+        self.position_book = position_book if position_book is not None else PositionBook(
+            clock=self.runtime.time, registry=self.runtime.symbols
+        )
         
-        # Nếu có symbol ban đầu -> thêm ngay nếu chưa có vị thế
-        if self.symbol and not self.smart_finder.has_existing_position(self.symbol):
-            self._add_symbol(self.symbol)
+        # Các bước gọi mạng lúc khởi động (khôi phục symbol, check vị thế symbol ban đầu)
+        # chạy trong thread bot -> tạo bot không bị chặn. Giữ chỗ coin đã lưu ngay để bot khác không lấy.
+        self._restored_symbols = dict(restored_symbols or {})
+        # set symbol đang có vị thế (snapshot dùng chung khi tạo nhiều bot; None = tự gọi API)
+        self._open_positions_snapshot = open_positions_snapshot
+        self._snapshot_received_at = self.runtime.time()
+        for sym in self._restored_symbols:
+            self.coin_manager.claim(sym, owner=self.bot_id)
+        self.ready = threading.Event()
+        self.ready_at = None            # time.perf_counter() lúc khởi động xong
+        self.startup_seconds = None
         
-        # Thread chính
+        # Thread chính (auto_start=False để khởi động sau bằng start())
         self.thread = threading.Thread(target=self._run, daemon=True)
-        self.thread.start()
+        if auto_start:
+            self.thread.start()
         
         roi_info = f" | ROI Trigger: {roi_trigger}%" if roi_trigger else " | ROI Trigger: Tắt"
         self.log(
             f"🟢 Bot {self.strategy_name} KHỞI ĐỘNG | "
             f"Max coins: {self.max_coins} | Lev: {self.leverage}x | "
-            f"Vốn: {self.position_percent}% | TP/SL: {self.take_profit}%/{self.stop_loss}%{roi_info}"
+            f"Vốn: {self.position_percent}% | TP/SL: {self.take_profit}%/{self.stop_loss}%{roi_info}",
+            event="bot_start"
         )
 
-    # ========== LOG ==========
-    def log(self, message):
-        important_keywords = ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫']
-        prefix = f"[{self.bot_id}]"
-        
-        if any(k in message for k in important_keywords):
-            logger.warning(f"{prefix} {message}")
-            if self.telegram_bot_token and self.telegram_chat_id:
-                send_telegram(
-                    f"<b>{self.bot_id}</b>: {message}",
-                    chat_id=self.telegram_chat_id,
-                    bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+    def start(self):
+        if self.thread.ident is None:
+            self.thread.start()
+
+    def _bootstrap(self):
+        """Khôi phục symbol đã lưu + thêm symbol ban đầu (nếu chưa có vị thế), rồi báo sẵn sàng"""
+        started = time.perf_counter()
+        try:
+            if self._stop:
+                return
+            # Khôi phục các symbol đã lưu (kể cả đang có vị thế) trước khi thêm symbol mới
+            for sym, saved in self._restored_symbols.items():
+                if not self._restore_symbol(sym, saved) and sym not in self.active_symbols:
+                    self.coin_manager.release(sym, owner=self.bot_id)
+            self._restored_symbols = {}
+            
+            # Nếu có symbol ban đầu -> thêm ngay nếu chưa có vị thế
+            if self.symbol and self.symbol not in self.active_symbols:
+                snapshot = self._open_positions_snapshot
+                fresh = (
+                    snapshot is not None
+                    and self.runtime.time() - self._snapshot_received_at <= POSITION_SNAPSHOT_MAX_AGE
                 )
-        else:
-            logger.info(f"{prefix} {message}")
+                if not fresh:
+                    # không có / snapshot cũ -> _add_symbol tự kiểm tra (1 lần positionRisk)
+                    self._add_symbol(self.symbol)
+                elif self.symbol not in snapshot:
+                    self._add_symbol(self.symbol, known_flat=True)
+            self._open_positions_snapshot = None
+        except Exception as e:
+            self.log(f"❌ Lỗi khởi động bot: {str(e)}", logging.ERROR, event="error")
+        finally:
+            self.ready_at = time.perf_counter()
+            self.startup_seconds = self.ready_at - started
+            BOT_STARTUP_SECONDS.set(self.startup_seconds, bot_id=self.bot_id)
+            self.ready.set()
+            self.log(
+                f"🚀 Sẵn sàng sau {self.startup_seconds * 1000:.0f}ms",
+                logging.INFO, event="bot_ready", latency_ms=self.startup_seconds * 1000
+            )
+
+    # ========== LOG ==========
+    def log(self, message, level=logging.WARNING, event=None, symbol=None, latency_ms=None):
+        """
+        level >= WARNING: ghi log + gửi Telegram. INFO: chỉ ghi log (nếu logger bật INFO).
+        """
+        if logger.isEnabledFor(level):
+            logger.log(
+                level, f"[{self.bot_id}] {message}",
+                extra={"bot_id": self.bot_id, "symbol": symbol, "event": event, "latency_ms": latency_ms}
+            )
+        if level >= logging.WARNING and self.notifier:
+            self.notifier.notify(f"<b>{self.bot_id}</b>: {message}")
 
     # ========== VÒNG LẶP CHÍNH (NỐI TIẾP) ==========
     def _run(self):
+        self._bootstrap()
+        profiler = self.profiler
         while not self._stop:
+            iteration_started = time.perf_counter()
+            profiler.begin_iteration()
             try:
-                now = time.time()
+                self._drain_commands()
+                now = self.runtime.time()
                 
                 # Check vị thế toàn tài khoản định kỳ
                 if now - self.last_global_position_check > self.global_position_check_interval:
-                    self.check_global_positions()
+                    with profiler.phase("global_check"):
+                        self.check_global_positions()
                     self.last_global_position_check = now
                 
                 # Cooldown giữa các lần xử lý
                 if now - self.last_trade_completion_time < self.trade_cooldown:
-                    time.sleep(0.5)
+                    with profiler.phase("cooldown_sleep"):
+                        self._pause(0.5)
                     continue
                 
                 # Luôn cố gắng bổ sung coin mới nếu chưa đủ
                 if len(self.active_symbols) < self.max_coins:
-                    if self._find_and_add_new_coin():
-                        self.last_trade_completion_time = time.time()
-                        time.sleep(3)
+                    with profiler.phase("coin_search"):
+                        found = self._find_and_add_new_coin()
+                    if found:
+                        self.last_trade_completion_time = self.runtime.time()
+                        with profiler.phase("sleep"):
+                            self._pause(3)
                         continue
                 
                 if self.active_symbols:
@@ -1011,16 +4349,20 @@ class BaseBot:
                     self.current_processing_symbol = symbol_to_process
                     
                     # Xử lý coin chính
-                    self._process_single_symbol(symbol_to_process)
+                    with profiler.phase("process_symbol", symbol_to_process):
+                        self._process_single_symbol(symbol_to_process)
                     
                     # Check TP/SL + nhồi cho các coin còn lại
                     for sym in self.active_symbols:
                         if sym != symbol_to_process:
-                            self._check_symbol_tp_sl(sym)
-                            self._check_symbol_averaging_down(sym)
+                            with profiler.phase("tp_sl", sym):
+                                self._check_symbol_tp_sl(sym)
+                            with profiler.phase("averaging", sym):
+                                self._check_symbol_averaging_down(sym)
                     
-                    self.last_trade_completion_time = time.time()
-                    time.sleep(3)
+                    self.last_trade_completion_time = self.runtime.time()
+                    with profiler.phase("sleep"):
+                        self._pause(3)
                     
                     # Xoay vòng danh sách
                     if len(self.active_symbols) > 1:
@@ -1029,12 +4371,29 @@ class BaseBot:
                     self.current_processing_symbol = None
                 else:
                     # Không có coin -> nghỉ lâu hơn
-                    time.sleep(5)
+                    with profiler.phase("idle_sleep"):
+                        self._pause(5)
             except Exception as e:
-                if time.time() - self.last_error_log_time > 10:
-                    self.log(f"❌ Lỗi trong vòng lặp chính: {str(e)}")
-                    self.last_error_log_time = time.time()
-                time.sleep(1)
+                if self.runtime.time() - self.last_error_log_time > 10:
+                    self.log(f"❌ Lỗi trong vòng lặp chính: {str(e)}", logging.ERROR, event="loop_error")
+                    self.last_error_log_time = self.runtime.time()
+                self._pause(1)
+            finally:
+                profiler.end_iteration()
+                self._record_loop_metrics(time.perf_counter() - iteration_started)
+        # lệnh dừng đến sau lượt cuối (vd. từ stop()) vẫn được thực hiện
+        self._drain_commands()
+
+    def _record_loop_metrics(self, elapsed):
+        BOT_LOOP_SECONDS.set(elapsed, bot_id=self.bot_id)
+        BOT_LOOP_LATENCY.observe(elapsed, bot_id=self.bot_id)
+        BOT_ACTIVE_SYMBOLS.set(len(self.active_symbols), bot_id=self.bot_id)
+        open_positions = sum(1 for d in list(self.symbol_data.values()) if d.position_open)
+        BOT_OPEN_POSITIONS.set(open_positions, bot_id=self.bot_id)
+
+    def _clear_metrics(self):
+        for gauge in (BOT_LOOP_SECONDS, BOT_ACTIVE_SYMBOLS, BOT_OPEN_POSITIONS, BOT_STARTUP_SECONDS):
+            gauge.remove(bot_id=self.bot_id)
 
     # ========== TÌM COIN MỚI ==========
     def _find_and_add_new_coin(self):
@@ -1055,73 +4414,137 @@ class BaseBot:
                 if not new_symbol:
                     return False
                 
-                if self.smart_finder.has_existing_position(new_symbol):
-                    self.log(f"🚫 {new_symbol} - phát hiện có vị thế thật, bỏ qua")
+                if self.smart_finder.has_existing_position(new_symbol) is not False:
+                    self.log(f"🚫 {new_symbol} - phát hiện có vị thế thật, bỏ qua", event="coin_skip", symbol=new_symbol)
                     return False
                 
                 if self._add_symbol(new_symbol):
-                    self.log(f"✅ Thêm coin mới: {new_symbol} (tổng {len(self.active_symbols)})")
-                    time.sleep(1)
+                    self.log(f"✅ Thêm coin mới: {new_symbol} (tổng {len(self.active_symbols)})", event="coin_added", symbol=new_symbol)
+                    self.runtime.sleep(1)
                     
                     if self.smart_finder.has_existing_position(new_symbol):
-                        self.log(f"🚫 {new_symbol} - có vị thế thật sau khi thêm, dừng theo dõi")
+                        self.log(f"🚫 {new_symbol} - có vị thế thật sau khi thêm, dừng theo dõi", event="coin_skip", symbol=new_symbol)
                         self.stop_symbol(new_symbol)
                         return False
                     return True
                 return False
             except Exception as e:
-                self.log(f"❌ Lỗi _find_and_add_new_coin: {str(e)}")
+                self.log(f"❌ Lỗi _find_and_add_new_coin: {str(e)}", logging.ERROR, event="error")
                 return False
 
-    def _add_symbol(self, symbol):
+    def _add_symbol(self, symbol, known_flat=False):
+        """known_flat=True: snapshot positionRisk còn mới cho thấy symbol không có vị thế -> không gọi REST"""
         with self.symbol_management_lock:
             if symbol in self.active_symbols:
                 return False
             if len(self.active_symbols) >= self.max_coins:
                 return False
-            if self.smart_finder.has_existing_position(symbol):
+            if not known_flat and self.smart_finder.has_existing_position(symbol) is not False:
                 return False
             
-            self.symbol_data[symbol] = {
-                "status": "waiting",
-                "side": "",
-                "quantity": 0,
-                "entry_price": 0,
-                "current_price": 0,
-                "position_open": False,
-                "last_trade_time": 0,
-                "last_close_time": 0,
-                "entry_base_price": 0,
-                "average_down_count": 0,
-                "last_average_down_time": 0,
-                "high_water_mark_roi": 0,
-                "roi_check_activated": False,
-                "close_attempted": False,
-                "last_close_attempt_time": 0,
-                "last_position_check": 0,
-            }
+            # giữ coin nguyên tử (kể cả giữa các process): bot khác vừa lấy -> bỏ qua
+            if not self.coin_manager.reserve(symbol, owner=self.bot_id):
+                self.log(f"🚫 {symbol} đang được bot khác giữ, bỏ qua", logging.INFO, event="coin_skip", symbol=symbol)
+                return False
             
-            self.active_symbols.append(symbol)
-            self.coin_manager.register_coin(symbol)
-            self.ws_manager.add_symbol(symbol, lambda price, sym=symbol: self._handle_price_update(sym, price))
+            self.symbol_data[symbol] = SymbolState()
             
-            self._check_symbol_position(symbol)
-            if self.symbol_data[symbol]["position_open"]:
-                self.stop_symbol(symbol)
+            self.active_symbols.append(symbol)
+            self.ws_manager.add_symbol(
+                symbol, lambda price, sym=symbol: self._handle_price_update(sym, price), owner=self.bot_id
+            )
+            # vị thế vừa được xác nhận là không có (snapshot hoặc has_existing_position) -> SymbolState() trống là đúng;
+            # vòng _run vẫn đối chiếu lại positionRisk mỗi 30s
+            self._persist_symbol(symbol)
+            return True
+
+    def _restore_symbol(self, symbol, saved):
+        """Dựng lại symbol từ state đã lưu rồi đối chiếu vị thế thật trên sàn"""
+        with self.symbol_management_lock:
+            if symbol in self.active_symbols or len(self.active_symbols) >= self.max_coins:
                 return False
+            data = SymbolState.from_saved(saved)
+            self.symbol_data[symbol] = data
+            
+            self.active_symbols.append(symbol)
+            if not self.coin_manager.claim(symbol, owner=self.bot_id):
+                self.log(f"⚠️ {symbol} đang được giữ bởi lease khác nhưng vẫn khôi phục (vị thế đã lưu)", event="coin_conflict", symbol=symbol)
+            self.ws_manager.add_symbol(
+                symbol, lambda price, sym=symbol: self._handle_price_update(sym, price), owner=self.bot_id
+            )
+            
+            # đối chiếu thành công thì _check_symbol_position đã tự lưu;
+            # lỗi positionRisk -> giữ nguyên state đã lưu (không reset/ghi đè), chỉ đưa vị thế vào sổ
+            # và để last_position_check = 0 cho vòng _run đối chiếu lại ngay lượt sau
+            if self._check_symbol_position(symbol):
+                data.last_position_check = self.runtime.time()
+            else:
+                self._sync_position_book(symbol, data)
             return True
 
+    def _persist_symbol(self, symbol):
+        data = self.symbol_data.get(symbol)
+        if data is None:
+            return
+        self._sync_position_book(symbol, data)
+        if not self.state_store:
+            return
+        try:
+            self.state_store.save_symbol(self.bot_id, symbol, data.snapshot())
+        except Exception as e:
+            logger.error(f"Lỗi lưu trạng thái {self.bot_id}/{symbol}: {str(e)}")
+
     def _handle_price_update(self, symbol, price):
-        if symbol in self.symbol_data:
-            self.symbol_data[symbol]["current_price"] = price
+        data = self.symbol_data.get(symbol)
+        if data is not None:
+            data.current_price = price
+            self.position_book.set_price(symbol, price)
+
+    # ========== SỔ VỊ THẾ ==========
+    def _sync_position_book(self, symbol, data):
+        """Đồng bộ vị thế của symbol vào sổ vị thế (gọi sau mỗi lần đổi trạng thái)"""
+        position_open, side, entry_price, quantity = data.position()
+        key = (self.bot_id, symbol)
+        if position_open and entry_price > 0 and quantity:
+            self.position_book.upsert(
+                key, side, entry_price, quantity, self.leverage,
+                take_profit=self.take_profit, stop_loss=self.stop_loss, roi_trigger=self.roi_trigger,
+                entry_base_price=data.entry_base_price, average_down_count=data.average_down_count,
+                high_water_mark_roi=data.high_water_mark_roi
+            )
+        else:
+            self.position_book.remove(key)
+
+    def _current_price(self, symbol):
+        """Giá từ WebSocket nếu còn mới, ngược lại lấy qua REST (và ghi vào sổ vị thế)"""
+        price = self.position_book.fresh_price(symbol)
+        if price:
+            return price
+        price = get_current_price(symbol, runtime=self.runtime)
+        if price > 0:
+            self.position_book.set_price(symbol, price)
+        return price
+
+    def _position_risk(self, symbol):
+        """ROI / ROI đỉnh / trigger của vị thế đọc từ lần đánh giá vector hóa gần nhất của sổ"""
+        if self._current_price(symbol) <= 0:
+            return None
+        return self.position_book.risk((self.bot_id, symbol))
 
     # ========== QUẢN LÝ VỊ THẾ THEO SYMBOL ==========
-    def _check_symbol_position(self, symbol):
+    def _check_symbol_position(self, symbol, fresh=False):
+        """
+        Đối chiếu vị thế của symbol với positionRisk. True nếu đã đối chiếu;
+        False nếu không lấy được dữ liệu (lỗi mạng / circuit mở) -> giữ nguyên trạng thái đang có.
+        fresh=True: không gộp với request positionRisk đang chạy (dùng ngay trước/sau khi đặt lệnh).
+        """
         try:
-            positions = get_position_summary(self.api_key, self.api_secret)
-            if not positions:
-                self._reset_symbol_position(symbol)
-                return
+            positions = get_position_summary(
+                self.api_key, self.api_secret, runtime=self.runtime, coalesce=not fresh
+            )
+            if positions is None:
+                logger.warning(f"[{self.bot_id}] ⚠️ {symbol}: không lấy được positionRisk, giữ nguyên trạng thái")
+                return False
             
             found = False
             for pos in positions:
@@ -1130,23 +4553,19 @@ class BaseBot:
                     if abs(amt) > 0:
                         found = True
                         data = self.symbol_data[symbol]
-                        data["position_open"] = True
-                        data["status"] = "open"
-                        data["side"] = "BUY" if amt > 0 else "SELL"
-                        data["quantity"] = amt
-                        data["entry_price"] = float(pos.get("entryPrice", 0))
+                        side = "BUY" if amt > 0 else "SELL"
+                        entry_price = float(pos.get("entryPrice", 0))
+                        data.update(
+                            position_open=True, status="open", side=side,
+                            quantity=amt, entry_price=entry_price
+                        )
                         
-                        current_price = get_current_price(symbol)
-                        if current_price > 0 and self.roi_trigger:
-                            if data["side"] == "BUY":
-                                profit = (current_price - data["entry_price"]) * abs(data["quantity"])
-                            else:
-                                profit = (data["entry_price"] - current_price) * abs(data["quantity"])
-                            invested = data["entry_price"] * abs(data["quantity"]) / self.leverage
-                            if invested > 0:
-                                roi = profit / invested * 100
-                                if roi >= self.roi_trigger:
-                                    data["roi_check_activated"] = True
+                        if self.roi_trigger:
+                            current_price = self._current_price(symbol)
+                            roi = position_roi(side, entry_price, amt, current_price, self.leverage)
+                            if current_price > 0 and roi >= self.roi_trigger:
+                                data.roi_check_activated = True
+                        self._persist_symbol(symbol)
                         break
                     else:
                         found = True
@@ -1154,136 +4573,173 @@ class BaseBot:
                         break
             if not found:
                 self._reset_symbol_position(symbol)
+            return True
         except Exception as e:
-            self.log(f"❌ Lỗi _check_symbol_position {symbol}: {str(e)}")
+            self.log(f"❌ Lỗi _check_symbol_position {symbol}: {str(e)}", logging.ERROR, event="error", symbol=symbol)
+            return False
+
+    def _await_open_position(self, symbol):
+        """
+        Đối chiếu ngay sau lệnh mở: positionRisk có thể trễ hơn response lệnh nên thử lại
+        POSITION_SETTLE_RETRIES lần, cách nhau POSITION_SETTLE_DELAY giây.
+        True: thấy vị thế; False: sàn trả lời nhưng chưa có vị thế; None: không lấy được positionRisk.
+        """
+        checked = False
+        for attempt in range(POSITION_SETTLE_RETRIES):
+            if attempt:
+                self.runtime.sleep(POSITION_SETTLE_DELAY)
+            if self._check_symbol_position(symbol, fresh=True):
+                checked = True
+                if self.symbol_data[symbol].position_open:
+                    return True
+        return False if checked else None
 
     def _reset_symbol_position(self, symbol):
-        if symbol in self.symbol_data:
-            data = self.symbol_data[symbol]
-            data["position_open"] = False
-            data["status"] = "waiting"
-            data["side"] = ""
-            data["quantity"] = 0
-            data["entry_price"] = 0
-            data["close_attempted"] = False
-            data["last_close_attempt_time"] = 0
-            data["entry_base_price"] = 0
-            data["average_down_count"] = 0
-            data["high_water_mark_roi"] = 0
-            data["roi_check_activated"] = False
+        data = self.symbol_data.get(symbol)
+        if data is not None:
+            data.reset_position()
+            self._persist_symbol(symbol)
 
     # ========== XỬ LÝ 1 SYMBOL ==========
     def _process_single_symbol(self, symbol):
         try:
+            profiler = self.profiler
             data = self.symbol_data[symbol]
-            now = time.time()
+            now = self.runtime.time()
             
-            if now - data.get("last_position_check", 0) > 30:
-                self._check_symbol_position(symbol)
-                data["last_position_check"] = now
+            if now - data.last_position_check > 30:
+                with profiler.phase("position_check", symbol):
+                    # lỗi positionRisk -> giữ nguyên trạng thái, thử lại ở lượt sau
+                    if self._check_symbol_position(symbol):
+                        data.last_position_check = now
             
-            if self.smart_finder.has_existing_position(symbol) and not data["position_open"]:
-                self.log(f"⚠️ {symbol} - phát hiện có vị thế thật, dừng theo dõi")
+            with profiler.phase("existing_position_check", symbol):
+                has_position = self.smart_finder.has_existing_position(symbol)
+            if has_position is None:
+                return False
+            if has_position and not data.position_open:
+                self.log(f"⚠️ {symbol} - phát hiện có vị thế thật, dừng theo dõi", event="coin_skip", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            if data["position_open"]:
-                if self._check_smart_exit_condition(symbol):
+            if data.position_open:
+                with profiler.phase("smart_exit", symbol):
+                    exited = self._check_smart_exit_condition(symbol)
+                if exited:
                     return True
-                self._check_symbol_tp_sl(symbol)
-                self._check_symbol_averaging_down(symbol)
+                with profiler.phase("tp_sl", symbol):
+                    self._check_symbol_tp_sl(symbol)
+                with profiler.phase("averaging", symbol):
+                    self._check_symbol_averaging_down(symbol)
             else:
-                if (now - data["last_trade_time"] > 60 
-                    and now - data["last_close_time"] > 3600):
+                if (now - data.last_trade_time > 60 
+                    and now - data.last_close_time > 3600):
                     
-                    target_side = self.get_next_side_based_on_comprehensive_analysis()
-                    entry_signal = self.smart_finder.get_entry_signal(symbol)
+                    with profiler.phase("entry_signal", symbol):
+                        target_side = self.get_next_side_based_on_comprehensive_analysis()
+                        entry_signal = self.smart_finder.get_entry_signal(symbol)
                     
                     if entry_signal == target_side:
-                        if self.smart_finder.has_existing_position(symbol):
-                            self.log(f"🚫 {symbol} - đã có vị thế thật, bỏ qua")
+                        existing = self.smart_finder.has_existing_position(symbol)
+                        if existing is None:
+                            return False
+                        if existing:
+                            self.log(f"🚫 {symbol} - đã có vị thế thật, bỏ qua", event="coin_skip", symbol=symbol)
                             self.stop_symbol(symbol)
                             return False
                         
-                        if self._open_symbol_position(symbol, target_side):
-                            data["last_trade_time"] = now
+                        with profiler.phase("open_position", symbol):
+                            opened = self._open_symbol_position(symbol, target_side)
+                        if opened:
+                            data.last_trade_time = now
+                            self._persist_symbol(symbol)
                             return True
             return False
         except Exception as e:
-            self.log(f"❌ Lỗi _process_single_symbol {symbol}: {str(e)}")
+            self.log(f"❌ Lỗi _process_single_symbol {symbol}: {str(e)}", logging.ERROR, event="error", symbol=symbol)
             return False
 
     # ========== MỞ / ĐÓNG VỊ THẾ ==========
     def _open_symbol_position(self, symbol, side):
         try:
-            if self.smart_finder.has_existing_position(symbol):
-                self.log(f"⚠️ {symbol} đã có vị thế, bỏ qua")
+            existing = self.smart_finder.has_existing_position(symbol)
+            if existing is None:
+                return False
+            if existing:
+                self.log(f"⚠️ {symbol} đã có vị thế, bỏ qua", event="coin_skip", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            self._check_symbol_position(symbol)
-            if self.symbol_data[symbol]["position_open"]:
+            if not self._check_symbol_position(symbol) or self.symbol_data[symbol].position_open:
                 return False
             
             current_leverage = self.smart_finder.get_symbol_leverage(symbol)
             if current_leverage < self.leverage:
-                self.log(f"❌ {symbol} leverage không đủ: {current_leverage}x < {self.leverage}x")
+                self.log(f"❌ {symbol} leverage không đủ: {current_leverage}x < {self.leverage}x", event="open_rejected", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            if not set_leverage(symbol, self.leverage, self.api_key, self.api_secret):
-                self.log(f"❌ {symbol} không set được leverage")
+            if not set_leverage(symbol, self.leverage, self.api_key, self.api_secret, runtime=self.runtime):
+                self.log(f"❌ {symbol} không set được leverage", logging.ERROR, event="open_rejected", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
             if not balance or balance <= 0:
-                self.log(f"❌ {symbol} không đủ số dư")
+                self.log(f"❌ {symbol} không đủ số dư", event="open_rejected", symbol=symbol)
                 return False
             
-            current_price = get_current_price(symbol)
+            current_price = get_current_price(symbol, runtime=self.runtime)
             if current_price <= 0:
-                self.log(f"❌ {symbol} lỗi giá")
+                self.log(f"❌ {symbol} lỗi giá", logging.ERROR, event="open_rejected", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            step_size = get_step_size(symbol, self.api_key, self.api_secret)
             usd_amount = balance * (self.position_percent / 100)
-            quantity = (usd_amount * self.leverage) / current_price
-            
-            if step_size > 0:
-                quantity = math.floor(quantity / step_size) * step_size
-                quantity = round(quantity, 8)
-            if quantity <= 0 or quantity < step_size:
-                self.log(f"❌ {symbol} khối lượng không hợp lệ")
+            # làm tròn chính xác theo bảng stepSize/minQty/minNotional -> không bị sàn từ chối
+            quantity_str, quantity, error = order_quantity(
+                symbol, usd_amount * self.leverage, current_price, runtime=self.runtime
+            )
+            if quantity_str is None:
+                self.log(f"❌ {symbol} khối lượng không hợp lệ: {error}", event="open_rejected", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
             
-            cancel_all_orders(symbol, self.api_key, self.api_secret)
-            time.sleep(0.2)
+            cancel_all_orders(symbol, self.api_key, self.api_secret, runtime=self.runtime)
+            self.runtime.sleep(0.2)
             
-            result = place_order(symbol, side, quantity, self.api_key, self.api_secret)
+            order_started = time.perf_counter()
+            result = self.orders.submit(symbol, side, quantity_str, intent="open")
+            order_latency_ms = (time.perf_counter() - order_started) * 1000
             if result and "orderId" in result:
                 executed_qty = float(result.get("executedQty", 0))
-                avg_price = float(result.get("avgPrice", current_price))
+                avg_price = float(result.get("avgPrice") or 0) or current_price
                 if executed_qty >= 0:
-                    time.sleep(1)
-                    self._check_symbol_position(symbol)
-                    if not self.symbol_data[symbol]["position_open"]:
-                        self.log(f"❌ {symbol} lệnh khớp nhưng không tạo vị thế")
+                    if result.get("status") != "FILLED":
+                        self.runtime.sleep(1)
+                    settled = self._await_open_position(symbol)
+                    filled = result.get("status") == "FILLED" and executed_qty > 0
+                    if settled is False and not filled:
+                        self.log(f"❌ {symbol} lệnh khớp nhưng không tạo vị thế", logging.ERROR, event="open_failed", symbol=symbol)
                         self.stop_symbol(symbol)
                         return False
+                    if not settled:
+                        # lệnh đã khớp nhưng positionRisk chưa xác nhận (trễ / lỗi) -> tin kết quả lệnh,
+                        # không nhả coin để vị thế thật không bị bỏ rơi; vòng _run sẽ đối chiếu lại
+                        logger.warning(f"[{self.bot_id}] ⚠️ {symbol} positionRisk chưa thấy vị thế vừa khớp, dùng kết quả lệnh")
                     
-                    data = self.symbol_data[symbol]
-                    data["entry_price"] = avg_price
-                    data["entry_base_price"] = avg_price
-                    data["average_down_count"] = 0
-                    data["side"] = side
-                    data["quantity"] = executed_qty if side == "BUY" else -executed_qty
-                    data["position_open"] = True
-                    data["status"] = "open"
-                    data["high_water_mark_roi"] = 0
-                    data["roi_check_activated"] = False
+                    self.symbol_data[symbol].update(
+                        entry_price=avg_price, entry_base_price=avg_price, average_down_count=0,
+                        side=side, quantity=executed_qty if side == "BUY" else -executed_qty,
+                        position_open=True, status="open", high_water_mark_roi=0, roi_check_activated=False
+                    )
+                    self._persist_symbol(symbol)
+                    if self.journal:
+                        self.journal.record(
+                            self.bot_id, symbol, "open", self.runtime.time(),
+                            side=side, quantity=executed_qty, price=avg_price, entry_price=avg_price,
+                            leverage=self.leverage, latency_ms=order_latency_ms
+                        )
                     
                     msg = (
                         f"✅ <b>MỞ VỊ THẾ {symbol}</b>\n"
@@ -1296,51 +4752,59 @@ class BaseBot:
                     )
                     if self.roi_trigger:
                         msg += f" | ROI Trigger: {self.roi_trigger}%"
-                    self.log(msg)
+                    self.log(msg, event="open", symbol=symbol, latency_ms=round(order_latency_ms, 1))
                     return True
                 else:
-                    self.log(f"❌ {symbol} lệnh không khớp")
+                    self.log(f"❌ {symbol} lệnh không khớp", logging.ERROR, event="open_failed", symbol=symbol)
                     self.stop_symbol(symbol)
                     return False
             else:
                 err_msg = result.get("msg", "Unknown") if result else "No response"
-                self.log(f"❌ {symbol} lỗi đặt lệnh: {err_msg}")
+                self.log(f"❌ {symbol} lỗi đặt lệnh: {err_msg}", logging.ERROR, event="open_failed", symbol=symbol)
                 self.stop_symbol(symbol)
                 return False
         except Exception as e:
-            self.log(f"❌ {symbol} lỗi _open_symbol_position: {str(e)}")
+            self.log(f"❌ {symbol} lỗi _open_symbol_position: {str(e)}", logging.ERROR, event="error", symbol=symbol)
             self.stop_symbol(symbol)
             return False
 
-    def _close_symbol_position(self, symbol, reason=""):
+    def _close_symbol_position(self, symbol, reason="", exit_reason="other"):
         try:
-            self._check_symbol_position(symbol)
+            self._check_symbol_position(symbol, fresh=True)
             data = self.symbol_data[symbol]
-            if not data["position_open"] or abs(data["quantity"]) <= 0:
-                return True
-            
-            now = time.time()
-            if data["close_attempted"] and now - data["last_close_attempt_time"] < 30:
-                return False
-            
-            data["close_attempted"] = True
-            data["last_close_attempt_time"] = now
+            # chỉ 1 thread giành được quyền đóng (vòng _run / Telegram / dừng bot) -> không đóng trùng
+            if not data.begin_close(self.runtime.time()):
+                return not data.position_open
             
-            close_side = "SELL" if data["side"] == "BUY" else "BUY"
-            close_qty = abs(data["quantity"])
+            _, side, entry_price, quantity = data.position()
+            close_side = "SELL" if side == "BUY" else "BUY"
+            close_qty = abs(quantity)
             
-            cancel_all_orders(symbol, self.api_key, self.api_secret)
-            time.sleep(0.5)
+            cancel_all_orders(symbol, self.api_key, self.api_secret, runtime=self.runtime)
             
-            result = place_order(symbol, close_side, close_qty, self.api_key, self.api_secret)
+            order_started = time.perf_counter()
+            # reduceOnly: lệnh đóng gửi lại/trùng cũng không mở ngược vị thế
+            result = self.orders.submit(symbol, close_side, close_qty, intent="close", reduce_only=True)
+            order_latency_ms = (time.perf_counter() - order_started) * 1000
             if result and "orderId" in result:
-                current_price = get_current_price(symbol)
+                current_price = float(result.get("avgPrice") or 0) or get_current_price(symbol, runtime=self.runtime)
                 pnl = 0
-                if data["entry_price"] > 0:
-                    if data["side"] == "BUY":
-                        pnl = (current_price - data["entry_price"]) * abs(data["quantity"])
+                if entry_price > 0:
+                    if side == "BUY":
+                        pnl = (current_price - entry_price) * close_qty
                     else:
-                        pnl = (data["entry_price"] - current_price) * abs(data["quantity"])
+                        pnl = (entry_price - current_price) * close_qty
+                
+                if self.journal:
+                    invested = entry_price * close_qty / self.leverage if self.leverage else 0
+                    self.journal.record(
+                        self.bot_id, symbol, "close", self.runtime.time(),
+                        side=close_side, quantity=close_qty, price=current_price,
+                        entry_price=entry_price, leverage=self.leverage, pnl=pnl,
+                        roi=(pnl / invested * 100) if invested > 0 else None,
+                        exit_reason=exit_reason, reason=reason,
+                        average_down_count=data.average_down_count, latency_ms=order_latency_ms
+                    )
                 
                 msg = (
                     f"⛔ <b>ĐÓNG VỊ THẾ {symbol}</b>\n"
@@ -1349,95 +4813,80 @@ class BaseBot:
                     f"🏷️ Giá ra: {current_price:.4f}\n"
                     f"📊 Khối lượng: {close_qty:.4f}\n"
                     f"💰 PnL: {pnl:.2f} USDC\n"
-                    f"📈 Số lần nhồi: {data['average_down_count']}"
+                    f"📈 Số lần nhồi: {data.average_down_count}"
                 )
-                self.log(msg)
-                data["last_close_time"] = time.time()
+                self.log(msg, event="close", symbol=symbol, latency_ms=round(order_latency_ms, 1))
+                data.last_close_time = self.runtime.time()
                 self._reset_symbol_position(symbol)
                 return True
             else:
                 err_msg = result.get("msg", "Unknown") if result else "No response"
-                self.log(f"❌ {symbol} lỗi đóng lệnh: {err_msg}")
-                data["close_attempted"] = False
+                self.log(f"❌ {symbol} lỗi đóng lệnh: {err_msg}", logging.ERROR, event="close_failed", symbol=symbol)
+                data.close_attempted = False
                 return False
         except Exception as e:
-            self.log(f"❌ {symbol} lỗi _close_symbol_position: {str(e)}")
-            self.symbol_data[symbol]["close_attempted"] = False
+            self.log(f"❌ {symbol} lỗi _close_symbol_position: {str(e)}", logging.ERROR, event="error", symbol=symbol)
+            data = self.symbol_data.get(symbol)
+            if data is not None:
+                data.close_attempted = False
             return False
 
     # ========== TP/SL + ROI TRIGGER ==========
     def _check_smart_exit_condition(self, symbol):
         try:
             data = self.symbol_data[symbol]
-            if not data["position_open"] or not data["roi_check_activated"]:
+            if not data.position_open or not data.roi_check_activated:
                 return False
             
-            current_price = get_current_price(symbol)
-            if current_price <= 0:
-                return False
-            
-            if data["side"] == "BUY":
-                profit = (current_price - data["entry_price"]) * abs(data["quantity"])
-            else:
-                profit = (data["entry_price"] - current_price) * abs(data["quantity"])
-            
-            invested = data["entry_price"] * abs(data["quantity"]) / self.leverage
-            if invested <= 0:
+            risk = self._position_risk(symbol)
+            if risk is None:
                 return False
             
-            roi = profit / invested * 100
-            
+            roi = risk.roi
             if roi >= self.roi_trigger:
                 exit_signal = self.smart_finder.get_exit_signal(symbol)
                 if exit_signal:
                     reason = f"🎯 ROI {self.roi_trigger}% + tín hiệu exit (ROI: {roi:.2f}%)"
-                    self._close_symbol_position(symbol, reason)
+                    self._close_symbol_position(symbol, reason, exit_reason="roi_exit")
                     return True
             return False
         except Exception as e:
-            self.log(f"❌ {symbol} lỗi _check_smart_exit_condition: {str(e)}")
+            self.log(f"❌ {symbol} lỗi _check_smart_exit_condition: {str(e)}", logging.ERROR, event="error", symbol=symbol)
             return False
 
     def _check_symbol_tp_sl(self, symbol):
         data = self.symbol_data[symbol]
         if (
-            not data["position_open"]
-            or data["entry_price"] <= 0
-            or data["close_attempted"]
+            not data.position_open
+            or data.entry_price <= 0
+            or data.close_attempted
         ):
             return False
         
-        current_price = get_current_price(symbol)
-        if current_price <= 0:
-            return False
-        
-        if data["side"] == "BUY":
-            profit = (current_price - data["entry_price"]) * abs(data["quantity"])
-        else:
-            profit = (data["entry_price"] - current_price) * abs(data["quantity"])
-        
-        invested = data["entry_price"] * abs(data["quantity"]) / self.leverage
-        if invested <= 0:
+        # ROI / ROI đỉnh / trigger đã được sổ vị thế tính vector hóa cho mọi vị thế
+        risk = self._position_risk(symbol)
+        if risk is None:
             return False
+        roi = risk.roi
         
-        roi = profit / invested * 100
+        state_changed = False
+        if risk.high_water_mark_roi > data.high_water_mark_roi:
+            data.high_water_mark_roi = risk.high_water_mark_roi
+            state_changed = True
         
-        if roi > data["high_water_mark_roi"]:
-            data["high_water_mark_roi"] = roi
+        if risk.roi_armed and not data.roi_check_activated:
+            data.roi_check_activated = True
+            state_changed = True
         
-        if (
-            self.roi_trigger is not None
-            and data["high_water_mark_roi"] >= self.roi_trigger
-            and not data["roi_check_activated"]
-        ):
-            data["roi_check_activated"] = True
+        if state_changed:
+            self._persist_symbol(symbol)
         
         closed = False
-        if self.take_profit is not None and roi >= self.take_profit:
-            self._close_symbol_position(symbol, f"✅ Đạt TP {self.take_profit}% (ROI: {roi:.2f}%)")
+        if risk.tp_hit:
+            self._close_symbol_position(symbol, f"✅ Đạt TP {self.take_profit}% (ROI: {roi:.2f}%)", exit_reason="tp")
             closed = True
-        elif self.stop_loss is not None and self.stop_loss > 0 and roi <= -self.stop_loss:
-            self._close_symbol_position(symbol, f"❌ Đạt SL {self.stop_loss}% (ROI: {roi:.2f}%)")
+        elif risk.sl_hit:
+            self._close_symbol_position(symbol, f"❌ Đạt SL {self.stop_loss}% (ROI: {roi:.2f}%)", exit_reason="sl")
             closed = True
         
         return closed
@@ -1446,154 +4895,192 @@ class BaseBot:
     def _check_symbol_averaging_down(self, symbol):
         data = self.symbol_data[symbol]
         if (
-            not data["position_open"]
-            or not data["entry_base_price"]
-            or data["average_down_count"] >= 7
+            not data.position_open
+            or not data.entry_base_price
+            or data.average_down_count >= len(AVERAGE_DOWN_LEVELS)
         ):
             return False
         try:
-            now = time.time()
-            if now - data["last_average_down_time"] < 60:
+            now = self.runtime.time()
+            if now - data.last_average_down_time < 60:
                 return False
             
-            current_price = get_current_price(symbol)
-            if current_price <= 0:
-                return False
-            
-            if data["side"] == "BUY":
-                profit = (current_price - data["entry_base_price"]) * abs(data["quantity"])
-            else:
-                profit = (data["entry_base_price"] - current_price) * abs(data["quantity"])
-            
-            invested = data["entry_base_price"] * abs(data["quantity"]) / self.leverage
-            if invested <= 0:
-                return False
-            
-            roi = profit / invested * 100
-            if roi >= 0:
+            # average_due: ROI theo entry gốc đã lỗ tới mốc Fibonacci kế tiếp (tính trong sổ vị thế)
+            risk = self._position_risk(symbol)
+            if risk is None or not risk.average_due:
                 return False
             
-            roi_negative = abs(roi)
-            fib_levels = [200, 300, 500, 800, 1300, 2100, 3400]
-            
-            if data["average_down_count"] < len(fib_levels):
-                target = fib_levels[data["average_down_count"]]
-                if roi_negative >= target:
-                    if self._execute_symbol_average_down(symbol):
-                        data["last_average_down_time"] = now
-                        data["average_down_count"] += 1
-                        self.log(f"📈 {symbol} nhồi Fibonacci mốc {target}% lỗ")
-                        return True
+            count = data.average_down_count
+            target = AVERAGE_DOWN_LEVELS[count]
+            if self._execute_symbol_average_down(symbol):
+                data.update(last_average_down_time=now, average_down_count=count + 1)
+                self._persist_symbol(symbol)
+                self.log(f"📈 {symbol} nhồi Fibonacci mốc {target}% lỗ", event="average_down_level", symbol=symbol)
+                return True
             return False
         except Exception as e:
-            self.log(f"❌ {symbol} lỗi _check_symbol_averaging_down: {str(e)}")
+            self.log(f"❌ {symbol} lỗi _check_symbol_averaging_down: {str(e)}", logging.ERROR, event="error", symbol=symbol)
             return False
 
     def _execute_symbol_average_down(self, symbol):
         try:
             data = self.symbol_data[symbol]
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
             if not balance or balance <= 0:
                 return False
             
-            current_price = get_current_price(symbol)
+            current_price = get_current_price(symbol, runtime=self.runtime)
             if current_price <= 0:
                 return False
             
-            add_percent = self.position_percent * (data["average_down_count"] + 1)
+            add_percent = self.position_percent * (data.average_down_count + 1)
             usd_amount = balance * (add_percent / 100)
-            quantity = (usd_amount * self.leverage) / current_price
-            
-            step_size = get_step_size(symbol, self.api_key, self.api_secret)
-            if step_size > 0:
-                quantity = math.floor(quantity / step_size) * step_size
-                quantity = round(quantity, 8)
-            if quantity < step_size:
+            quantity_str, _, error = order_quantity(
+                symbol, usd_amount * self.leverage, current_price, runtime=self.runtime
+            )
+            if quantity_str is None:
+                self.log(f"⚠️ {symbol} bỏ qua nhồi lệnh: {error}", logging.INFO, event="average_down_skipped", symbol=symbol)
                 return False
             
-            result = place_order(symbol, data["side"], quantity, self.api_key, self.api_secret)
+            order_started = time.perf_counter()
+            side = data.side
+            result = self.orders.submit(symbol, side, quantity_str, intent="average_down")
+            order_latency_ms = (time.perf_counter() - order_started) * 1000
             if result and "orderId" in result:
                 executed_qty = float(result.get("executedQty", 0))
-                avg_price = float(result.get("avgPrice", current_price))
+                avg_price = float(result.get("avgPrice") or 0) or current_price
                 if executed_qty >= 0:
-                    total_qty = abs(data["quantity"]) + executed_qty
+                    _, _, entry_price, prev_qty = data.position()
+                    total_qty = abs(prev_qty) + executed_qty
                     new_entry = (
-                        abs(data["quantity"]) * data["entry_price"]
+                        abs(prev_qty) * entry_price
                         + executed_qty * avg_price
                     ) / total_qty
-                    data["entry_price"] = new_entry
-                    data["quantity"] = total_qty if data["side"] == "BUY" else -total_qty
+                    data.update(entry_price=new_entry, quantity=total_qty if side == "BUY" else -total_qty)
+                    if self.journal:
+                        self.journal.record(
+                            self.bot_id, symbol, "average_down", self.runtime.time(),
+                            side=side, quantity=executed_qty, price=avg_price,
+                            entry_price=new_entry, leverage=self.leverage,
+                            average_down_count=data.average_down_count + 1,
+                            latency_ms=order_latency_ms
+                        )
                     
                     msg = (
                         f"📈 <b>NHỒI LỆNH {symbol}</b>\n"
-                        f"🔢 Lần nhồi: {data['average_down_count'] + 1}\n"
+                        f"🔢 Lần nhồi: {data.average_down_count + 1}\n"
                         f"📊 Thêm: {executed_qty:.4f}\n"
                         f"🏷️ Giá nhồi: {avg_price:.4f}\n"
                         f"📈 Entry mới: {new_entry:.4f}\n"
                         f"💰 Tổng khối lượng: {total_qty:.4f}"
                     )
-                    self.log(msg)
+                    self.log(msg, event="average_down", symbol=symbol, latency_ms=round(order_latency_ms, 1))
                     return True
             return False
         except Exception as e:
-            self.log(f"❌ {symbol} lỗi _execute_symbol_average_down: {str(e)}")
+            self.log(f"❌ {symbol} lỗi _execute_symbol_average_down: {str(e)}", logging.ERROR, event="error", symbol=symbol)
             return False
 
     # ========== DỪNG SYMBOL / BOT ==========
-    def stop_symbol(self, symbol):
+    def _pause(self, seconds, slices=10):
+        """runtime.sleep chia lát: có lệnh dừng coin / stop() thì thức dậy sớm"""
+        for _ in range(slices):
+            if self._stop or not self._commands.empty():
+                return
+            self.runtime.sleep(seconds / slices)
+
+    def _in_loop_thread(self):
+        """True nếu đang ở thread bot hoặc thread bot không chạy (được sửa symbol_data trực tiếp)"""
+        return threading.current_thread() is self.thread or not self.thread.is_alive()
+
+    def _drain_commands(self):
+        while True:
+            try:
+                symbol, done, result = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result.append(self._stop_symbol_now(symbol))
+            except Exception as e:
+                self.log(f"❌ Lỗi dừng coin {symbol}: {str(e)}", logging.ERROR, event="error", symbol=symbol)
+                result.append(False)
+            finally:
+                done.set()
+
+    def stop_symbol(self, symbol, timeout=STOP_SYMBOL_TIMEOUT):
+        """
+        Dừng 1 coin. Gọi từ thread khác (Telegram, manager): xếp lệnh cho vòng _run thực hiện
+        giữa 2 lượt xử lý và chờ tối đa timeout giây.
+        """
+        if self._in_loop_thread():
+            return self._stop_symbol_now(symbol)
+        if symbol not in self.active_symbols:
+            return False
+        done = threading.Event()
+        result = []
+        self._commands.put((symbol, done, result))
+        if not done.wait(timeout) and not self.thread.is_alive():
+            # thread bot đã thoát trước khi nhận lệnh -> tự thực hiện
+            self._drain_commands()
+        if done.is_set():
+            return result[0]
+        self.log(f"⏳ {symbol} sẽ dừng ở lượt xử lý kế tiếp", logging.INFO, event="symbol_stopping", symbol=symbol)
+        return True
+
+    def _stop_symbol_now(self, symbol):
         with self.symbol_management_lock:
             if symbol not in self.active_symbols:
                 return False
             
-            self.log(f"⛔ Dừng coin {symbol}...")
-            
-            if self.current_processing_symbol == symbol:
-                timeout = time.time() + 10
-                while self.current_processing_symbol == symbol and time.time() < timeout:
-                    time.sleep(0.5)
+            self.log(f"⛔ Dừng coin {symbol}...", event="symbol_stopping", symbol=symbol)
             
-            if self.symbol_data[symbol]["position_open"]:
-                self._close_symbol_position(symbol, "Dừng coin theo lệnh")
+            if self.symbol_data[symbol].position_open:
+                self._close_symbol_position(symbol, "Dừng coin theo lệnh", exit_reason="manual")
             
-            self.ws_manager.remove_symbol(symbol)
-            self.coin_manager.unregister_coin(symbol)
+            self.ws_manager.remove_symbol(symbol, owner=self.bot_id)
+            self.coin_manager.release(symbol, owner=self.bot_id)
+            if self.state_store:
+                self.state_store.delete_symbol(self.bot_id, symbol)
             
-            if symbol in self.symbol_data:
-                del self.symbol_data[symbol]
+            self.symbol_data.pop(symbol, None)
+            self.position_book.remove((self.bot_id, symbol))
             if symbol in self.active_symbols:
                 self.active_symbols.remove(symbol)
             
-            self.log(f"✅ Đã dừng {symbol} | Còn lại {len(self.active_symbols)}/{self.max_coins}")
+            self.log(f"✅ Đã dừng {symbol} | Còn lại {len(self.active_symbols)}/{self.max_coins}", event="symbol_stopped", symbol=symbol)
             
             if len(self.active_symbols) < self.max_coins:
-                self.log(f"🔄 Tự tìm coin mới thay {symbol}...")
-                threading.Thread(target=self._delayed_find_new_coin, daemon=True).start()
+                # vòng _run tự bổ sung coin ở lượt kế tiếp (chỉ thread bot thêm symbol)
+                self.log(f"🔄 Tự tìm coin mới thay {symbol}...", logging.INFO, event="coin_search", symbol=symbol)
             return True
 
-    def _delayed_find_new_coin(self):
-        time.sleep(2)
-        self._find_and_add_new_coin()
-
     def stop_all_symbols(self):
-        self.log("⛔ Dừng tất cả coin...")
+        self.log("⛔ Dừng tất cả coin...", event="bot_stopping")
         to_stop = self.active_symbols.copy()
         stopped = 0
         for sym in to_stop:
             if self.stop_symbol(sym):
                 stopped += 1
-                time.sleep(1)
-        self.log(f"✅ Đã dừng {stopped} coin, bot vẫn chạy (có thể thêm coin mới)")
+                self.runtime.sleep(1)
+        self.log(f"✅ Đã dừng {stopped} coin, bot vẫn chạy (có thể thêm coin mới)", event="symbols_stopped")
         return stopped
 
     def stop(self):
         self._stop = True
+        # chờ vòng _run thoát rồi dừng coin trực tiếp (không phải xếp lệnh từng coin)
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(STOP_SYMBOL_TIMEOUT)
         stopped = self.stop_all_symbols()
-        self.log(f"🔴 Bot dừng - đã dừng {stopped} coin")
+        self._clear_metrics()
+        self.log(f"🔴 Bot dừng - đã dừng {stopped} coin", event="bot_stopped")
 
     # ========== PHÂN TÍCH TOÀN TÀI KHOẢN ==========
     def check_global_positions(self):
         try:
-            positions = get_position_summary(self.api_key, self.api_secret)
+            positions = get_position_summary(self.api_key, self.api_secret, runtime=self.runtime)
+            if positions is None:
+                # không lấy được dữ liệu -> giữ thống kê cũ
+                return
             if not positions:
                 self.global_long_count = 0
                 self.global_short_count = 0
@@ -1621,9 +5108,9 @@ class BaseBot:
             self.global_long_pnl = long_pnl
             self.global_short_pnl = short_pnl
         except Exception as e:
-            if time.time() - self.last_error_log_time > 30:
-                self.log(f"❌ Lỗi kiểm tra vị thế toàn tài khoản: {str(e)}")
-                self.last_error_log_time = time.time()
+            if self.runtime.time() - self.last_error_log_time > 30:
+                self.log(f"❌ Lỗi kiểm tra vị thế toàn tài khoản: {str(e)}", logging.ERROR, event="error")
+                self.last_error_log_time = self.runtime.time()
 
     def get_next_side_based_on_comprehensive_analysis(self):
         self.check_global_positions()
@@ -1673,14 +5160,32 @@ class GlobalMarketBot(BaseBot):
         )
 
 # ========== GLOBAL INSTANCES ==========
+API_VERIFY_TTL = 60     # giây dùng lại kết quả kiểm tra API thành công
+POSITION_SNAPSHOT_MAX_AGE = 30  # giây: snapshot positionRisk của add_bots còn dùng được khi bot khởi động
+POSITION_SETTLE_RETRIES = 3     # số lần đọc positionRisk sau lệnh mở trước khi kết luận chưa có vị thế
+POSITION_SETTLE_DELAY = 1.0     # giây giữa các lần đọc đó
 coin_manager = CoinManager()
 # ========== BOT MANAGER (FORMAT CŨ + HỖ TRỢ HỆ RSI + KHỐI LƯỢNG) ==========
 class BotManager:
-    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None):
-        self.ws_manager = WebSocketManager()
+    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None,
+                 runtime=None, metrics_port=None, profiling=False, cprofile_dir=None, cprofile_every=0,
+                 state_db=None, journal_db=None, coin_service=None, market_stream=False,
+                 confirm_timeframes=(), coin_authkey=None):
+        self.runtime = runtime or get_runtime()
+        self.ws_manager = WebSocketManager(runtime=self.runtime)
+        # Giá toàn thị trường qua 1 socket (get_current_price đọc bảng giá thay vì REST)
+        self.market_stream = market_stream
+        if market_stream:
+            self.runtime.prices.start()
+        # Khung xác nhận tín hiệu 5m (vd ("15m", "1h")), nến gộp từ trade stream
+        unknown = [tf for tf in confirm_timeframes or () if tf not in CANDLE_TIMEFRAMES]
+        if unknown:
+            logger.warning(f"Bỏ qua khung xác nhận không hỗ trợ: {unknown} (hỗ trợ {CANDLE_TIMEFRAMES})")
+        self.confirm_timeframes = tuple(tf for tf in confirm_timeframes or () if tf in CANDLE_TIMEFRAMES)
         self.bots = {}              # {bot_id: bot_instance}
         self.running = True
-        self.start_time = time.time()
+        self.start_time = self.runtime.time()
+        self._created_perf = time.perf_counter()
         self.user_states = {}       # {chat_id: {...}}
 
         self.api_key = api_key
@@ -1688,50 +5193,107 @@ class BotManager:
         self.telegram_bot_token = telegram_bot_token
         self.telegram_chat_id = str(telegram_chat_id) if telegram_chat_id else None
 
-        # tài nguyên dùng chung cho tất cả bot
-        self.coin_manager = CoinManager()
-        self.symbol_locks = defaultdict(threading.Lock)
+        # Dịch vụ giữ coin giữa các process (Unix socket / host:port); None = chỉ trong process này
+        # coin_authkey: khóa dùng chung bắt buộc khi dịch vụ chạy qua TCP
+        self.coin_service = coin_service
+        self.coin_authkey = coin_authkey
+        self.coin_server = ensure_coin_service(coin_service, authkey=coin_authkey) if coin_service else None
+
+        # Tài khoản: mỗi tài khoản có CoinManager / key riêng; WebSocket + cache thị trường dùng chung
+        self.accounts = {}          # {account_id: Account}
+        if api_key and api_secret:
+            self.add_account(DEFAULT_ACCOUNT_ID, api_key, api_secret)
+        default_account = self.accounts.get(DEFAULT_ACCOUNT_ID)
+        self.coin_manager = default_account.coin_manager if default_account else CoinManager()
+        self.symbol_locks = default_account.symbol_locks if default_account else defaultdict(threading.Lock)
+
+        # Lưu trạng thái bền vững (None = tắt)
+        self.state_store = StateStore(state_db, clock=self.runtime.time) if state_db else None
+        self.journal = TradeJournal(journal_db) if journal_db else None
+        # Sổ vị thế dùng chung: ROI/TP/SL của mọi bot tính 1 bước vector hóa mỗi lượt giá
+        self.position_book = PositionBook(clock=self.runtime.time, registry=self.runtime.symbols)
+
+        # Thông báo Telegram gửi nền, dùng chung cho manager + tất cả bot
+        self.notifier = None
+        if self.telegram_bot_token and self.telegram_chat_id:
+            self.notifier = TelegramNotifier(
+                self.telegram_bot_token, self.telegram_chat_id, runtime=self.runtime
+            )
+
+        # Profiling vòng lặp bot (tùy chọn)
+        self.profiling = profiling
+        self.cprofile_dir = cprofile_dir
+        self.cprofile_every = cprofile_every
+
+        # Endpoint /metrics cục bộ (Prometheus)
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(port=int(metrics_port))
+            if self.metrics_server.start():
+                self.log(f"📡 Metrics: http://{self.metrics_server.host}:{self.metrics_server.port}/metrics", logging.INFO, event="metrics_started")
+            else:
+                self.metrics_server = None
 
         # Thread lắng nghe Telegram (long-polling)
         self.telegram_thread = None
         if self.telegram_bot_token and self.telegram_chat_id:
             self.telegram_thread = threading.Thread(target=self._telegram_listener, daemon=True)
             self.telegram_thread.start()
-            # gửi menu chính khi khởi động
-            self.send_main_menu(self.telegram_chat_id)
         else:
-            self.log("⚡ BotManager khởi động ở chế độ không dùng Telegram")
+            self.log("⚡ BotManager khởi động ở chế độ không dùng Telegram", logging.INFO, event="manager_start")
 
     # ----- LOG -----
-    def log(self, message):
-        prefix = "[BotManager]"
-        if any(k in message for k in ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫']):
-            logger.warning(f"{prefix} {message}")
-            # gửi admin nếu có
-            if self.telegram_bot_token and self.telegram_chat_id:
-                send_telegram(
-                    message,
-                    chat_id=self.telegram_chat_id,
-                    bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
-                )
-        else:
-            logger.info(f"{prefix} {message}")
+    def log(self, message, level=logging.WARNING, event=None, bot_id=None):
+        if logger.isEnabledFor(level):
+            logger.log(
+                level, f"[BotManager] {message}",
+                extra={"bot_id": bot_id, "event": event}
+            )
+        # gửi admin nếu có (qua hàng đợi nền)
+        if level >= logging.WARNING and self.notifier:
+            self.notifier.notify(message)
+
+    # ----- TÀI KHOẢN -----
+    def add_account(self, account_id, api_key, api_secret):
+        """Thêm 1 tài khoản (sub-account) vào process; bot chọn tài khoản qua account_id"""
+        if account_id in self.accounts:
+            return self.accounts[account_id]
+        coin_manager = (
+            RemoteCoinManager(self.coin_service, namespace=account_id, authkey=self.coin_authkey)
+            if self.coin_service else None
+        )
+        account = Account(account_id, api_key, api_secret, runtime=self.runtime, coin_manager=coin_manager)
+        self.accounts[account_id] = account
+        return account
 
     # ----- KIỂM TRA KẾT NỐI BINANCE -----
-    def _verify_api_connection(self):
-        """Kiểm tra kết nối API Binance trước khi tạo bot"""
+    def _verify_api_connection(self, account_id=DEFAULT_ACCOUNT_ID):
+        """
+        Kiểm tra kết nối API Binance của 1 tài khoản trước khi tạo bot.
+        Kết quả OK được dùng lại trong API_VERIFY_TTL giây (tạo nhiều bot liên tiếp chỉ gọi API 1 lần).
+        """
+        account = self.accounts.get(account_id)
+        if account is None:
+            self.log(f"❌ Không có tài khoản '{account_id}'", logging.ERROR, event="api_check_failed")
+            return False
+        now = self.runtime.time()
+        if account.verified_at is not None and now - account.verified_at < API_VERIFY_TTL:
+            return True
         try:
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = account.balance()
             if balance is None:
-                self.log("❌ LỖI: Không thể kết nối Binance API. Kiểm tra:")
-                self.log("   • API Key / Secret")
-                self.log("   • IP/VPS/Railway có bị chặn Binance không")
+                self.log(
+                    f"❌ LỖI: Không thể kết nối Binance API [{account_id}]. Kiểm tra:\n"
+                    "   • API Key / Secret\n"
+                    "   • IP/VPS/Railway có bị chặn Binance không",
+                    logging.ERROR, event="api_check_failed"
+                )
                 return False
-            self.log(f"✅ Kết nối Binance OK – Số dư USDC: {balance:.2f}")
+            self.log(f"✅ Kết nối Binance OK [{account_id}] – Số dư USDC: {balance:.2f}", event="api_check_ok")
+            account.verified_at = now
             return True
         except Exception as e:
-            self.log(f"❌ Lỗi khi kiểm tra API: {str(e)}")
+            self.log(f"❌ Lỗi khi kiểm tra API: {str(e)}", logging.ERROR, event="api_check_failed")
             return False
 
     # ----- TELEGRAM MENU -----
@@ -1742,19 +5304,22 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     # ----- LẮNG NGHE TELEGRAM (LONG-POLLING) -----
     def _telegram_listener(self):
         last_update_id = 0
-        self.log("▶ Đang lắng nghe Telegram...")
+        self.log("▶ Đang lắng nghe Telegram...", logging.INFO, event="telegram_listener")
+        # gửi menu chính khi khởi động (trong thread này để không chặn khởi tạo)
+        self.send_main_menu(self.telegram_chat_id)
 
         while self.running and self.telegram_bot_token:
             try:
-                url = (
-                    f"https://api.telegram.org/bot{self.telegram_bot_token}"
-                    f"/getUpdates?offset={last_update_id+1}&timeout=30"
+                url = self.runtime.telegram_url(
+                    self.telegram_bot_token,
+                    f"getUpdates?offset={last_update_id+1}&timeout=30"
                 )
                 response = requests.get(url, timeout=35)
                 if response.status_code == 200:
@@ -1804,7 +5369,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
             return
 
@@ -1833,6 +5399,8 @@ class BotManager:
             self._show_config_info(chat_id)
         elif text == "🎯 Chiến lược":
             self._show_strategy_info(chat_id)
+        elif text == "/profile":
+            self._show_profile(chat_id)
         elif text == "/stop":
             self.stop_all()
             send_telegram(
@@ -1840,7 +5408,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
         else:
             # tin nhắn không khớp menu -> hiện lại menu
@@ -1849,7 +5418,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
 
     # ----- FLOW TẠO BOT (CÁC STEP waiting_*) -----
@@ -1873,7 +5443,8 @@ class BotManager:
             chat_id,
             create_bot_count_keyboard(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     def _handle_create_bot_steps(self, chat_id, text, user_state, current_step):
@@ -1887,7 +5458,8 @@ class BotManager:
                         chat_id,
                         create_bot_count_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
                 user_state["bot_count"] = bot_count
@@ -1898,7 +5470,8 @@ class BotManager:
                     chat_id,
                     create_bot_mode_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             except ValueError:
                 send_telegram(
@@ -1906,7 +5479,8 @@ class BotManager:
                     chat_id,
                     create_bot_count_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -1921,15 +5495,16 @@ class BotManager:
                     "Bạn có thể chọn coin trên bàn phím hoặc nhập ví dụ: <code>BTCUSDC</code>\n\n"
                     "Chọn coin:",
                     chat_id,
-                    create_symbols_keyboard(),
+                    create_symbols_keyboard(runtime=self.runtime),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             elif text == "🔄 Bot Động - Tự tìm coin":
                 user_state["bot_mode"] = "dynamic"
                 user_state["symbols"] = None
                 user_state["step"] = "waiting_leverage"
-                balance = get_balance(self.api_key, self.api_secret)
+                balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
                 balance_info = f"\n💰 Số dư hiện có: {balance:.2f} USDC" if balance else ""
                 send_telegram(
                     "🔄 <b>ĐÃ CHỌN: BOT ĐỘNG</b>\n\n"
@@ -1939,7 +5514,8 @@ class BotManager:
                     chat_id,
                     create_leverage_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             else:
                 send_telegram(
@@ -1947,7 +5523,8 @@ class BotManager:
                     chat_id,
                     create_bot_mode_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -1959,15 +5536,16 @@ class BotManager:
                 send_telegram(
                     "⚠️ Vui lòng nhập / chọn ít nhất 1 symbol hợp lệ (ví dụ: BTCUSDC hoặc BTCUSDC,ETHUSDC)",
                     chat_id,
-                    create_symbols_keyboard(),
+                    create_symbols_keyboard(runtime=self.runtime),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
                 return
             user_state["symbols"] = symbols
             user_state["step"] = "waiting_leverage"
 
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
             balance_info = f"\n💰 Số dư hiện có: {balance:.2f} USDC" if balance else ""
             send_telegram(
                 "✅ Coin đã chọn: " + ", ".join(symbols) + f"{balance_info}\n\n"
@@ -1975,7 +5553,8 @@ class BotManager:
                 chat_id,
                 create_leverage_keyboard(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
             return
 
@@ -1990,13 +5569,14 @@ class BotManager:
                         chat_id,
                         create_leverage_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
                 user_state["leverage"] = lev
                 user_state["step"] = "waiting_percent"
 
-                balance = get_balance(self.api_key, self.api_secret)
+                balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
                 balance_info = f"\n💰 Số dư hiện có: {balance:.2f} USDC" if balance else ""
 
                 send_telegram(
@@ -2005,7 +5585,8 @@ class BotManager:
                     chat_id,
                     create_percent_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             except ValueError:
                 send_telegram(
@@ -2013,7 +5594,8 @@ class BotManager:
                     chat_id,
                     create_leverage_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -2027,13 +5609,14 @@ class BotManager:
                         chat_id,
                         create_percent_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
                 user_state["percent"] = percent
                 user_state["step"] = "waiting_tp"
 
-                balance = get_balance(self.api_key, self.api_secret)
+                balance = get_balance(self.api_key, self.api_secret, runtime=self.runtime)
                 actual_amount = balance * (percent / 100) if balance else 0
 
                 send_telegram(
@@ -2043,7 +5626,8 @@ class BotManager:
                     chat_id,
                     create_tp_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             except ValueError:
                 send_telegram(
@@ -2051,7 +5635,8 @@ class BotManager:
                     chat_id,
                     create_percent_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -2065,7 +5650,8 @@ class BotManager:
                         chat_id,
                         create_tp_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
                 user_state["tp"] = tp
@@ -2077,7 +5663,8 @@ class BotManager:
                     chat_id,
                     create_sl_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             except ValueError:
                 send_telegram(
@@ -2085,7 +5672,8 @@ class BotManager:
                     chat_id,
                     create_tp_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -2099,7 +5687,8 @@ class BotManager:
                         chat_id,
                         create_sl_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
                 user_state["sl"] = sl
@@ -2112,7 +5701,8 @@ class BotManager:
                     chat_id,
                     create_roi_trigger_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             except ValueError:
                 send_telegram(
@@ -2120,7 +5710,8 @@ class BotManager:
                     chat_id,
                     create_sl_keyboard(),
                     bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id
+                    default_chat_id=self.telegram_chat_id,
+                    runtime=self.runtime
                 )
             return
 
@@ -2137,7 +5728,8 @@ class BotManager:
                             chat_id,
                             create_roi_trigger_keyboard(),
                             bot_token=self.telegram_bot_token,
-                            default_chat_id=self.telegram_chat_id
+                            default_chat_id=self.telegram_chat_id,
+                            runtime=self.runtime
                         )
                         return
                     user_state["roi_trigger"] = roi_trigger
@@ -2147,7 +5739,8 @@ class BotManager:
                         chat_id,
                         create_roi_trigger_keyboard(),
                         bot_token=self.telegram_bot_token,
-                        default_chat_id=self.telegram_chat_id
+                        default_chat_id=self.telegram_chat_id,
+                        runtime=self.runtime
                     )
                     return
 
@@ -2175,7 +5768,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
             return
 
@@ -2206,7 +5800,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
         else:
             send_telegram(
@@ -2214,7 +5809,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
 
     # ----- TẠO BOT (FORMAT CŨ) -----
@@ -2229,30 +5825,43 @@ class BotManager:
         strategy_type: chuỗi tên chiến lược (ví dụ: 'RSI-Khoi-luong')
         bot_count: số coin tối đa bot quản lý (max_coins)
         kwargs: bot_mode='static' hoặc 'dynamic'
+                config_key: khóa cấu hình gốc (vd. 1 dòng BOT_CONFIGS) để tránh tạo trùng sau restart
+                bot_id, restored_symbols, verify_api: dùng khi khôi phục từ StateStore
+                open_positions_snapshot: set symbol đang có vị thế (add_bots dùng chung 1 snapshot)
+                account_id: tài khoản giao dịch (mặc định DEFAULT_ACCOUNT_ID)
         """
+        original_sl = sl
         if sl == 0:
             sl = None
 
-        if not self.api_key or not self.api_secret:
-            self.log("❌ Chưa thiết lập API Key / Secret trong BotManager")
+        account_id = kwargs.get("account_id") or DEFAULT_ACCOUNT_ID
+        account = self.accounts.get(account_id)
+        if account is None:
+            self.log(f"❌ Chưa thiết lập API Key / Secret cho tài khoản '{account_id}'", logging.ERROR, event="config_error")
             return False
 
-        if not self._verify_api_connection():
-            self.log("❌ KHÔNG THỂ KẾT NỐI BINANCE - KHÔNG TẠO ĐƯỢC BOT")
+        if kwargs.get("verify_api", True) and not self._verify_api_connection(account_id):
+            self.log("❌ KHÔNG THỂ KẾT NỐI BINANCE - KHÔNG TẠO ĐƯỢC BOT", logging.ERROR, event="bot_create_failed")
             return False
 
         bot_mode = kwargs.get("bot_mode", "static")
+        config_key = kwargs.get("config_key")
         try:
             # Tạo bot_id
-            if bot_mode == "static" and symbol:
-                bot_id = f"STATIC_{strategy_type}_{int(time.time())}"
-            else:
-                bot_id = f"DYNAMIC_{strategy_type}_{int(time.time())}"
+            bot_id = kwargs.get("bot_id") or self._new_bot_id(bot_mode, symbol, strategy_type)
 
             if bot_id in self.bots:
-                self.log(f"⚠️ Bot {bot_id} đã tồn tại, bỏ qua.")
+                self.log(f"⚠️ Bot {bot_id} đã tồn tại, bỏ qua.", event="bot_exists", bot_id=bot_id)
                 return False
 
+            profiler = None
+            if self.profiling:
+                profiler = LoopProfiler(
+                    bot_id,
+                    cprofile_dir=self.cprofile_dir,
+                    cprofile_every=self.cprofile_every
+                )
+
             # Tạo instance GlobalMarketBot
             bot = GlobalMarketBot(
                 symbol=symbol,
@@ -2262,20 +5871,47 @@ class BotManager:
                 stop_loss=sl,
                 roi_trigger=roi_trigger,
                 ws_manager=self.ws_manager,
-                api_key=self.api_key,
-                api_secret=self.api_secret,
+                api_key=account.api_key,
+                api_secret=account.api_secret,
                 telegram_bot_token=self.telegram_bot_token,
                 telegram_chat_id=self.telegram_chat_id,
-                coin_manager=self.coin_manager,
-                symbol_locks=self.symbol_locks,
+                coin_manager=account.coin_manager,
+                symbol_locks=account.symbol_locks,
                 bot_id=bot_id,
-                max_coins=bot_count
+                max_coins=bot_count,
+                runtime=self.runtime,
+                profiler=profiler,
+                notifier=self.notifier,
+                config_key=config_key,
+                state_store=self.state_store,
+                restored_symbols=kwargs.get("restored_symbols"),
+                journal=self.journal,
+                open_positions_snapshot=kwargs.get("open_positions_snapshot"),
+                position_book=self.position_book,
+                order_manager=account.orders,
+                confirm_timeframes=self.confirm_timeframes
             )
 
             # liên kết ngược
             bot._bot_manager = self
+            bot.account_id = account_id
             self.bots[bot_id] = bot
 
+            if self.state_store:
+                self.state_store.save_bot(bot_id, {
+                    "symbol": symbol,
+                    "leverage": lev,
+                    "percent": percent,
+                    "tp": tp,
+                    "sl": original_sl,
+                    "roi_trigger": roi_trigger,
+                    "strategy_type": strategy_type,
+                    "bot_count": bot_count,
+                    "bot_mode": bot_mode,
+                    "config_key": config_key,
+                    "account_id": account_id,
+                })
+
             roi_info = f"{roi_trigger}%" if roi_trigger else "Tắt"
             msg = (
                 "✅ <b>ĐÃ TẠO BOT MỚI</b>\n"
@@ -2288,19 +5924,238 @@ class BotManager:
                 f"🎯 ROI Trigger: {roi_info}\n"
                 f"🔢 Số coin tối đa: {bot_count}\n"
             )
+            if account_id != DEFAULT_ACCOUNT_ID:
+                msg += f"👤 Tài khoản: {account_id}\n"
             if bot_mode == "static" and symbol:
                 msg += f"🔗 Coin khởi tạo: {symbol}\n"
             else:
                 msg += "🔗 Coin: Tự động tìm theo hệ RSI + Khối lượng\n"
 
             msg += "\n🔄 <b>CƠ CHẾ NỐI TIẾP</b> đã kích hoạt – bot xử lý từng coin một."
-            self.log(msg)
+            self.log(msg, event="bot_created", bot_id=bot_id)
             return True
 
         except Exception as e:
-            self.log(f"❌ Lỗi tạo bot: {str(e)}")
+            self.log(f"❌ Lỗi tạo bot: {str(e)}", logging.ERROR, event="bot_create_failed")
             return False
 
+    def _new_bot_id(self, bot_mode, symbol, strategy_type):
+        prefix = "STATIC" if bot_mode == "static" and symbol else "DYNAMIC"
+        base_id = bot_id = f"{prefix}_{strategy_type}_{int(self.runtime.time())}"
+        # nhiều bot tạo cùng 1 giây -> thêm hậu tố để không trùng id
+        suffix = 2
+        while bot_id in self.bots:
+            bot_id = f"{base_id}_{suffix}"
+            suffix += 1
+        return bot_id
+
+    # ----- TẠO NHIỀU BOT CÙNG LÚC -----
+    @staticmethod
+    def _normalize_bot_config(config):
+        """
+        Chuẩn hóa 1 cấu hình bot: dòng BOT_CONFIGS
+        [symbol, lev, percent, tp, sl, strategy, (roi_trigger), (bot_count)] hoặc dict cùng tên tham số add_bot.
+        Sai định dạng -> ValueError.
+        """
+        if isinstance(config, dict):
+            cfg = dict(config)
+        elif isinstance(config, (list, tuple)) and len(config) >= 6:
+            cfg = {
+                "symbol": config[0], "lev": config[1], "percent": config[2],
+                "tp": config[3], "sl": config[4], "strategy_type": config[5],
+                "roi_trigger": config[6] if len(config) > 6 else None,
+                "bot_count": config[7] if len(config) > 7 else 1,
+                "config_key": json.dumps(config),
+            }
+        else:
+            raise ValueError("cần list >= 6 phần tử [symbol, lev, percent, tp, sl, strategy] hoặc dict")
+
+        try:
+            symbol = cfg.get("symbol")
+            cfg["symbol"] = str(symbol).upper() if symbol else None
+            cfg["lev"] = int(cfg["lev"])
+            cfg["percent"] = float(cfg["percent"])
+            cfg["tp"] = float(cfg["tp"])
+            cfg["sl"] = float(cfg.get("sl") or 0)
+            roi_trigger = cfg.get("roi_trigger")
+            cfg["roi_trigger"] = float(roi_trigger) if roi_trigger else None
+            cfg["bot_count"] = int(cfg.get("bot_count") or 1)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"giá trị không hợp lệ: {e}")
+
+        if not cfg.get("strategy_type"):
+            raise ValueError("thiếu strategy")
+        if not 1 <= cfg["lev"] <= 125:
+            raise ValueError(f"đòn bẩy {cfg['lev']} ngoài khoảng 1-125")
+        if not 0 < cfg["percent"] <= 100:
+            raise ValueError(f"% số dư {cfg['percent']} ngoài khoảng (0, 100]")
+        if cfg["tp"] <= 0 or cfg["sl"] < 0:
+            raise ValueError("TP phải > 0 và SL >= 0")
+        if cfg["bot_count"] < 1:
+            raise ValueError("bot_count phải >= 1")
+        cfg.setdefault("bot_mode", "static" if cfg["symbol"] else "dynamic")
+        cfg["account_id"] = cfg.get("account_id") or DEFAULT_ACCOUNT_ID
+        return cfg
+
+    def add_bots(self, configs, wait=True, timeout=30):
+        """
+        Tạo nhiều bot 1 lần: kiểm tra toàn bộ cấu hình trước, 1 lần kiểm tra API và
+        1 snapshot vị thế cho mỗi tài khoản, các bot tự khởi động song song trong thread riêng.
+        Trả về list kết quả theo thứ tự configs:
+            {"index", "bot_id", "ok", "skipped", "error", "create_ms", "startup_ms"}
+        skipped=True: cấu hình đã có bot (khôi phục từ StateStore), không tạo lại.
+        """
+        results = []
+        valid = []
+        for index, config in enumerate(configs):
+            result = {
+                "index": index, "bot_id": None, "ok": False, "skipped": False,
+                "error": None, "create_ms": None, "startup_ms": None
+            }
+            results.append(result)
+            try:
+                cfg = self._normalize_bot_config(config)
+            except ValueError as e:
+                result["error"] = f"cấu hình lỗi: {e}"
+                continue
+            if cfg.get("config_key") and self.has_config_key(cfg["config_key"]):
+                result["skipped"] = True
+                continue
+            valid.append((result, cfg))
+
+        if not valid:
+            return results
+
+        # 1 lần kiểm tra API + 1 lần positionRisk cho mỗi tài khoản (thay vì mỗi bot tự gọi khi khởi động)
+        snapshots = {}
+        for account_id in dict.fromkeys(cfg["account_id"] for _, cfg in valid):
+            if not self._verify_api_connection(account_id):
+                self.log(f"❌ KHÔNG THỂ KẾT NỐI BINANCE [{account_id}] - KHÔNG TẠO ĐƯỢC BOT", logging.ERROR, event="bot_create_failed")
+                continue
+            positions = self.accounts[account_id].open_positions()
+            # positionRisk lỗi -> không có snapshot (None), mỗi bot tự kiểm tra khi khởi động
+            snapshots[account_id] = {pos.get("symbol") for pos in positions} if positions is not None else None
+
+        started = time.perf_counter()
+        known = set(self.bots)
+        created = []
+        for result, cfg in valid:
+            if cfg["account_id"] not in snapshots:
+                result["error"] = f"không kết nối được Binance API [{cfg['account_id']}]"
+                continue
+            snapshot = snapshots[cfg["account_id"]]
+            t0 = time.perf_counter()
+            ok = self.add_bot(
+                cfg["symbol"], cfg["lev"], cfg["percent"], cfg["tp"], cfg["sl"],
+                cfg["roi_trigger"], cfg["strategy_type"],
+                bot_count=cfg["bot_count"],
+                bot_mode=cfg["bot_mode"],
+                config_key=cfg.get("config_key"),
+                bot_id=cfg.get("bot_id"),
+                account_id=cfg["account_id"],
+                verify_api=False,
+                open_positions_snapshot=snapshot
+            )
+            result["create_ms"] = (time.perf_counter() - t0) * 1000
+            result["ok"] = bool(ok)
+            if ok:
+                new_ids = set(self.bots) - known
+                known |= new_ids
+                result["bot_id"] = new_ids.pop() if new_ids else cfg.get("bot_id")
+                created.append(result)
+            else:
+                result["error"] = "add_bot thất bại"
+
+        if wait and created:
+            deadline = time.perf_counter() + timeout
+            for result in created:
+                bot = self.bots.get(result["bot_id"])
+                if bot and bot.ready.wait(max(0, deadline - time.perf_counter())):
+                    result["startup_ms"] = bot.startup_seconds * 1000
+
+        elapsed = time.perf_counter() - started
+        self.log(
+            f"🚀 Đã tạo {len(created)}/{len(results)} bot trong {elapsed:.2f}s",
+            logging.INFO, event="bots_created"
+        )
+        return results
+
+    # ----- KHÔI PHỤC BOT SAU RESTART -----
+    def restore_bots(self):
+        """
+        Dựng lại tất cả bot đã lưu trong StateStore (kể cả symbol đang có vị thế mở).
+        Chỉ kiểm tra API 1 lần cho mỗi tài khoản. Trả về số bot đã khôi phục.
+        """
+        if not self.state_store:
+            return 0
+        saved = self.state_store.load_bots()
+        if not saved:
+            return 0
+        verified = {}
+        for entry in saved:
+            account_id = entry["config"].get("account_id") or DEFAULT_ACCOUNT_ID
+            if account_id not in verified:
+                verified[account_id] = self._verify_api_connection(account_id)
+                if not verified[account_id]:
+                    self.log(
+                        f"❌ KHÔNG THỂ KẾT NỐI BINANCE [{account_id}] - KHÔNG KHÔI PHỤC ĐƯỢC BOT",
+                        logging.ERROR, event="restore_failed"
+                    )
+
+        started = time.perf_counter()
+        restored = 0
+        for entry in saved:
+            bot_id = entry["bot_id"]
+            cfg = entry["config"]
+            account_id = cfg.get("account_id") or DEFAULT_ACCOUNT_ID
+            if bot_id in self.bots or not verified[account_id]:
+                continue
+            ok = self.add_bot(
+                cfg.get("symbol"),
+                cfg.get("leverage"),
+                cfg.get("percent"),
+                cfg.get("tp"),
+                cfg.get("sl"),
+                cfg.get("roi_trigger"),
+                cfg.get("strategy_type"),
+                bot_count=cfg.get("bot_count", 1),
+                bot_mode=cfg.get("bot_mode", "static"),
+                config_key=cfg.get("config_key"),
+                bot_id=bot_id,
+                account_id=account_id,
+                restored_symbols=entry["symbols"],
+                verify_api=False
+            )
+            if ok:
+                restored += 1
+        elapsed = time.perf_counter() - started
+        self.log(
+            f"♻️ Đã khôi phục {restored}/{len(saved)} bot từ trạng thái lưu ({elapsed:.1f}s)",
+            event="restore"
+        )
+        return restored
+
+    def wait_until_ready(self, timeout=30, since=None):
+        """
+        Chờ các bot hoàn tất khởi động (tối đa timeout giây).
+        Trả về thời gian (giây, tính từ `since` hoặc lúc tạo manager) tới bot sẵn sàng đầu tiên / tất cả.
+        """
+        since = self._created_perf if since is None else since
+        deadline = time.perf_counter() + timeout
+        bots = list(self.bots.values())
+        for bot in bots:
+            bot.ready.wait(max(0, deadline - time.perf_counter()))
+        ready_times = sorted(bot.ready_at - since for bot in bots if bot.ready_at is not None)
+        return {
+            "total": len(bots),
+            "ready": len(ready_times),
+            "first_ready": ready_times[0] if ready_times else None,
+            "all_ready": ready_times[-1] if bots and len(ready_times) == len(bots) else None,
+        }
+
+    def has_config_key(self, config_key):
+        return any(getattr(bot, "config_key", None) == config_key for bot in self.bots.values())
+
     # ----- QUẢN LÝ DỪNG BOT / COIN -----
     def stop_bot_symbol(self, bot_id, symbol):
         """Dừng 1 coin cụ thể trong 1 bot"""
@@ -2308,7 +6163,7 @@ class BotManager:
         if bot and hasattr(bot, "stop_symbol"):
             ok = bot.stop_symbol(symbol)
             if ok:
-                self.log(f"⛔ Đã dừng coin {symbol} trong bot {bot_id}")
+                self.log(f"⛔ Đã dừng coin {symbol} trong bot {bot_id}", event="symbol_stopped", bot_id=bot_id)
             return ok
         return False
 
@@ -2317,7 +6172,7 @@ class BotManager:
         bot = self.bots.get(bot_id)
         if bot and hasattr(bot, "stop_all_symbols"):
             count = bot.stop_all_symbols()
-            self.log(f"⛔ Đã dừng {count} coin trong bot {bot_id}")
+            self.log(f"⛔ Đã dừng {count} coin trong bot {bot_id}", event="symbols_stopped", bot_id=bot_id)
             return count
         return 0
 
@@ -2327,16 +6182,36 @@ class BotManager:
         if bot:
             bot.stop()
             del self.bots[bot_id]
-            self.log(f"🔴 Đã dừng bot {bot_id}")
+            if self.state_store:
+                self.state_store.delete_bot(bot_id)
+            self.log(f"🔴 Đã dừng bot {bot_id}", event="bot_stopped", bot_id=bot_id)
             return True
         return False
 
     def stop_all(self):
         """Dừng tất cả bot (đóng tất cả vị thế và xóa khỏi danh sách)"""
-        self.log("🔴 Đang dừng tất cả bot...")
+        self.log("🔴 Đang dừng tất cả bot...", event="stop_all")
         for bot_id in list(self.bots.keys()):
             self.stop_bot(bot_id)
-        self.log("🔴 Đã dừng tất cả bot – hệ thống vẫn chạy, có thể thêm bot mới")
+        self.log("🔴 Đã dừng tất cả bot – hệ thống vẫn chạy, có thể thêm bot mới", event="stop_all")
+
+    def shutdown(self):
+        """
+        Dừng các dịch vụ nền khi thoát chương trình (gọi sau stop_all):
+        /metrics, stream giá toàn thị trường, bảng xếp hạng coin, lease giữ coin.
+        stop_all vẫn để hệ thống chạy (nút '⛔ Dừng Bot') nên không dừng các dịch vụ này.
+        """
+        self.running = False
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        self.position_book.stop()
+        self.runtime.close()
+        if self.coin_service:
+            for account in self.accounts.values():
+                account.coin_manager.close()
+        if self.coin_server:
+            self.coin_server.stop()
 
     def _start_stop_all_bots(self, chat_id):
         """Xử lý nút '⛔ Dừng Bot' trong menu – tạm dừng toàn bộ"""
@@ -2347,7 +6222,8 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     # ----- HIỂN THỊ THÔNG TIN TRÊN TELEGRAM -----
@@ -2358,7 +6234,8 @@ class BotManager:
                 chat_id,
                 create_main_menu(),
                 bot_token=self.telegram_bot_token,
-                default_chat_id=self.telegram_chat_id
+                default_chat_id=self.telegram_chat_id,
+                runtime=self.runtime
             )
             return
 
@@ -2379,41 +6256,57 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     def _show_balance(self, chat_id):
-        balance = get_balance(self.api_key, self.api_secret)
-        if balance is None:
+        lines = []
+        for account_id, account in self.accounts.items():
+            balance = account.balance()
+            label = f" [{account_id}]" if len(self.accounts) > 1 else ""
+            if balance is None:
+                lines.append(f"❌ Không lấy được số dư{label}. Kiểm tra kết nối Binance / API Key.")
+            else:
+                lines.append(f"📦 Số dư khả dụng{label}: <b>{balance:.4f} USDC</b>")
+        if not lines:
             msg = "❌ Không lấy được số dư. Kiểm tra kết nối Binance / API Key."
         else:
-            msg = f"💰 <b>SỐ DƯ USDC</b>\n\n"
-            msg += f"📦 Số dư khả dụng: <b>{balance:.4f} USDC</b>"
+            msg = f"💰 <b>SỐ DƯ USDC</b>\n\n" + "\n".join(lines)
         send_telegram(
             msg,
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     def _show_positions(self, chat_id):
-        positions = get_position_summary(self.api_key, self.api_secret)
+        positions = []
+        for account_id, account in self.accounts.items():
+            for pos in account.open_positions() or []:
+                positions.append((account_id, pos))
         if not positions:
             msg = "📈 Hiện tại <b>không có vị thế nào</b> đang mở."
         else:
             lines = ["📈 <b>DANH SÁCH VỊ THẾ</b>\n"]
-            for pos in positions:
+            for account_id, pos in positions:
                 symbol = pos.get("symbol")
+                if len(self.accounts) > 1:
+                    symbol = f"{symbol} [{account_id}]"
                 amt = float(pos.get("positionAmt", 0))
                 entry = float(pos.get("entryPrice", 0))
                 upnl = float(pos.get("unRealizedProfit", 0))
                 lev = int(float(pos.get("leverage", 0)))
                 side = "LONG" if amt > 0 else "SHORT"
+                mark = self.runtime.prices.price(pos.get("symbol"), kind="mark")
+                mark_line = f"   • Giá mark: {mark:.4f}\n" if mark else ""
                 lines.append(
                     f"🔗 {symbol} | {side}\n"
                     f"   • Kích thước: {abs(amt):.4f}\n"
                     f"   • Entry: {entry:.4f}\n"
+                    f"{mark_line}"
                     f"   • Leverage: {lev}x\n"
                     f"   • PnL chưa thực: {upnl:.4f} USDC\n"
                 )
@@ -2423,11 +6316,12 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     def _show_system_stats(self, chat_id):
-        uptime = time.time() - self.start_time
+        uptime = self.runtime.time() - self.start_time
         hours = int(uptime // 3600)
         minutes = int((uptime % 3600) // 60)
         seconds = int(uptime % 60)
@@ -2436,14 +6330,79 @@ class BotManager:
             f"🕒 Uptime: {hours}h {minutes}m {seconds}s\n"
             f"🤖 Số bot đang chạy: {len(self.bots)}\n"
         )
+        if self.journal:
+            msg += self._format_journal_stats()
+        msg += self._format_order_stats()
         send_telegram(
             msg,
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
+        )
+
+    def dump_profile(self):
+        """Báo cáo profiling của tất cả bot (dùng cho Telegram /profile và CLI)"""
+        if not self.profiling:
+            return "⏱️ Profiling đang tắt (bật bằng BotManager(profiling=True))"
+        if not self.bots:
+            return "⏱️ Chưa có bot nào để profile"
+        return "\n\n".join(bot.profiler.format_report() for bot in list(self.bots.values()))
+
+    def _show_profile(self, chat_id):
+        send_telegram(
+            self.dump_profile(),
+            chat_id,
+            create_main_menu(),
+            bot_token=self.telegram_bot_token,
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
+    def _format_order_stats(self):
+        lines = []
+        for account_id, account in list(self.accounts.items()):
+            for intent, st in sorted(account.orders.fill_stats().items()):
+                lines.append(
+                    f"• {account_id} {intent}: {st['count']} lệnh | "
+                    f"p50 {st['p50_ms']:.0f}ms | p95 {st['p95_ms']:.0f}ms"
+                )
+        if not lines:
+            return ""
+        return "\n⚡ <b>Độ trễ khớp lệnh</b>\n" + "\n".join(lines) + "\n"
+
+    def _format_journal_stats(self):
+        day_start = self.runtime.time() // 86400 * 86400   # 00:00 UTC hôm nay
+        total = self.journal.totals()
+        today = self.journal.totals(since=day_start)
+        lines = [
+            "",
+            f"💰 PnL hôm nay: <b>{today['pnl']:.2f} USDC</b> ({today['trades']} lệnh, {today['wins']} thắng)",
+            f"💰 PnL tổng: <b>{total['pnl']:.2f} USDC</b> ({total['trades']} lệnh, {total['wins']} thắng)",
+        ]
+        by_reason = self.journal.pnl_by_exit_reason()
+        if by_reason:
+            lines.append("\n🎯 <b>Theo lý do thoát</b>")
+            for r in by_reason:
+                lines.append(f"• {r['key']}: {r['pnl']:.2f} USDC ({r['trades']} lệnh)")
+        by_bot = self.journal.pnl_by_bot()
+        if by_bot:
+            lines.append("\n🤖 <b>Theo bot</b>")
+            for r in by_bot[:10]:
+                lines.append(f"• {r['key']}: {r['pnl']:.2f} USDC ({r['trades']} lệnh)")
+        by_symbol = self.journal.pnl_by_symbol()
+        if by_symbol:
+            lines.append("\n🔗 <b>Top coin</b>")
+            for r in by_symbol[:5]:
+                lines.append(f"• {r['key']}: {r['pnl']:.2f} USDC ({r['trades']} lệnh)")
+        by_day = self.journal.pnl_by_day(since=day_start - 6 * 86400)
+        if by_day:
+            lines.append("\n📅 <b>7 ngày gần nhất</b>")
+            for r in by_day:
+                lines.append(f"• {r['key']}: {r['pnl']:.2f} USDC ({r['trades']} lệnh)")
+        return "\n".join(lines) + "\n"
+
     def _show_config_info(self, chat_id):
         msg = (
             "⚙️ <b>CẤU HÌNH HIỆN TẠI</b>\n\n"
@@ -2457,7 +6416,8 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
     def _show_strategy_info(self, chat_id):
@@ -2473,23 +6433,486 @@ class BotManager:
             chat_id,
             create_main_menu(),
             bot_token=self.telegram_bot_token,
-            default_chat_id=self.telegram_chat_id
+            default_chat_id=self.telegram_chat_id,
+            runtime=self.runtime
         )
 
 # ========== HÀM KHỞI ĐỘNG HỆ THỐNG (GIỮ NGUYÊN TÊN CŨ) ==========
-def start_trading_system(api_key, api_secret, telegram_bot_token=None, telegram_chat_id=None):
+# ========== SHARDING: BOT CHẠY TRÊN NHIỀU WORKER PROCESS ==========
+SHARD_CALL_TIMEOUT = 30         # giây chờ worker trả lời 1 lệnh
+SHARD_MONITOR_INTERVAL = 5      # giây kiểm tra worker còn sống
+
+class HashRing:
+    """Consistent hashing (md5, nhiều điểm ảo mỗi node): thêm/bớt node chỉ dời ~1/N key"""
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._ring = []         # [(hash, node)] đã sắp xếp
+        self._hashes = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self._ring, (self._hash(f"{node}#{i}"), node))
+        self._hashes = [h for h, _ in self._ring]
+
+    def remove_node(self, node):
+        self._ring = [item for item in self._ring if item[1] != node]
+        self._hashes = [h for h, _ in self._ring]
+
+    def node_for(self, key):
+        if not self._ring:
+            raise ValueError("HashRing rỗng")
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+# --- Phía worker ---
+class _ForwardingNotifier:
+    """Notifier của worker: chuyển thông báo về supervisor (supervisor gửi Telegram)"""
+    def __init__(self, events):
+        self.events = events
+
+    def notify(self, message, chat_id=None, reply_markup=None):
+        try:
+            self.events.put_nowait(("notify", message, chat_id))
+        except Exception as e:
+            logger.error(f"Lỗi chuyển thông báo về supervisor: {str(e)}")
+
+    def ready(self, bot_id, info):
+        try:
+            self.events.put_nowait(("ready", bot_id, info))
+        except Exception as e:
+            logger.error(f"Lỗi báo bot {bot_id} sẵn sàng về supervisor: {str(e)}")
+
+def _shard_bot_info(manager, bot_id):
+    bot = manager.bots.get(bot_id)
+    if bot is None:
+        return None
+    return {
+        "status": bot.status,
+        "active_symbols": list(bot.active_symbols),
+        "leverage": bot.leverage,
+        "position_percent": bot.position_percent,
+        "ready": bot.ready.is_set(),
+        "ready_at": bot.ready_at,
+        "startup_seconds": bot.startup_seconds,
+    }
+
+def _forward_ready(manager, bot_id):
+    """Chờ bot khởi động xong rồi báo supervisor (supervisor không phải hỏi liên tục qua Pipe)"""
+    bot = manager.bots.get(bot_id)
+    while bot is not None and not bot.ready.wait(SHARD_MONITOR_INTERVAL):
+        if manager.bots.get(bot_id) is not bot:
+            return
+    if bot is not None:
+        manager.notifier.ready(bot_id, _shard_bot_info(manager, bot_id))
+
+def _shard_add_bot(manager, args, kwargs):
+    ok = manager.add_bot(*args, **kwargs)
+    bot_id = kwargs.get("bot_id")
+    if ok and bot_id in manager.bots:
+        threading.Thread(target=_forward_ready, args=(manager, bot_id), daemon=True).start()
+    return ok
+
+def _shard_bot_call(manager, bot_id, method, *args):
+    if method not in ("stop_symbol", "stop_all_symbols"):
+        raise ValueError(f"lệnh bot không hợp lệ: {method}")
+    bot = manager.bots.get(bot_id)
+    return getattr(bot, method)(*args) if bot else False
+
+def _shard_stop_bot(manager, bot_id):
+    # supervisor tự log + xóa StateStore; worker chỉ dừng bot
+    bot = manager.bots.pop(bot_id, None)
+    if bot:
+        bot.stop()
+    return bot is not None
+
+def _shard_profile_report(manager, bot_id):
+    bot = manager.bots.get(bot_id)
+    return bot.profiler.format_report() if bot else ""
+
+_SHARD_COMMANDS = {
+    "add_bot": _shard_add_bot,
+    "bot_info": _shard_bot_info,
+    "bot_call": _shard_bot_call,
+    "stop_bot": _shard_stop_bot,
+    "profile_report": _shard_profile_report,
+}
+
+def _shard_worker_main(conn, events, settings):
+    """Entry point worker process: 1 BotManager cục bộ, nhận lệnh từ supervisor qua Pipe"""
+    runtime = RuntimeContext(**settings["runtime"])
+    set_runtime(runtime)
+    manager = BotManager(
+        api_key=settings["api_key"],
+        api_secret=settings["api_secret"],
+        runtime=runtime,
+        metrics_port=settings["metrics_port"],
+        profiling=settings["profiling"],
+        cprofile_dir=settings["cprofile_dir"],
+        cprofile_every=settings["cprofile_every"],
+        state_db=settings["state_db"],
+        journal_db=settings["journal_db"],
+        # CoinManager của mọi tài khoản dùng dịch vụ giữ coin chung -> không 2 worker nào giữ cùng 1 coin
+        coin_service=settings["coin_service"],
+        coin_authkey=settings["coin_authkey"],
+        market_stream=settings["market_stream"],
+        confirm_timeframes=settings["confirm_timeframes"]
+    )
+    manager.notifier = _ForwardingNotifier(events)
+    for account_id, (api_key, api_secret) in settings["accounts"].items():
+        manager.add_account(account_id, api_key, api_secret)
+
+    while True:
+        try:
+            seq, command, args, kwargs = conn.recv()
+        except (EOFError, OSError):
+            break
+        if command == "shutdown":
+            for bot_id in list(manager.bots):
+                _shard_stop_bot(manager, bot_id)
+            conn.send((seq, True, None))
+            break
+        try:
+            handler = _SHARD_COMMANDS[command]
+            reply = (seq, True, handler(manager, *args, **kwargs))
+        except Exception as e:
+            reply = (seq, False, f"{type(e).__name__}: {e}")
+        conn.send(reply)
+
+    manager.shutdown()
+    if manager.journal:
+        manager.journal.close()
+
+# --- Phía supervisor ---
+class _WorkerHandle:
+    """Process worker + kênh Pipe gửi lệnh (mỗi lần 1 lệnh, có số thứ tự để bỏ phản hồi trễ)"""
+    def __init__(self, worker_id, ctx, settings, events):
+        self.worker_id = worker_id
+        self.ctx = ctx
+        self.settings = dict(settings, worker_id=worker_id)
+        self.events = events
+        self.process = None
+        self.conn = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(
+            target=_shard_worker_main,
+            args=(child_conn, self.events, self.settings),
+            name=self.worker_id,
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def call(self, command, *args, timeout=SHARD_CALL_TIMEOUT, **kwargs):
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self.conn.send((seq, command, args, kwargs))
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    raise TimeoutError(f"{self.worker_id} không trả lời lệnh {command} sau {timeout}s")
+                reply_seq, ok, result = self.conn.recv()
+                if reply_seq == seq:
+                    break
+        if not ok:
+            raise RuntimeError(f"{self.worker_id}: {result}")
+        return result
+
+class _RemoteProfiler:
+    def __init__(self, bot):
+        self.bot = bot
+
+    def format_report(self):
+        return self.bot.handle.call("profile_report", self.bot.bot_id)
+
+class _RemoteBot:
+    """
+    Đại diện phía supervisor của 1 bot chạy trong worker: cùng các thuộc tính / method
+    mà BotManager + màn hình Telegram dùng, lấy dữ liệu qua lệnh gửi worker (cache INFO_TTL giây).
+    """
+    INFO_TTL = 1.0
+    INFO_FIELDS = ("status", "active_symbols", "leverage", "position_percent", "ready_at", "startup_seconds")
+    UNREACHABLE_INFO = {
+        "status": "worker không phản hồi", "active_symbols": [], "leverage": "?", "position_percent": "?",
+        "ready": False, "ready_at": None, "startup_seconds": None,
+    }
+
+    def __init__(self, handle, bot_id, config_key=None, account_id=DEFAULT_ACCOUNT_ID):
+        self.handle = handle
+        self.bot_id = bot_id
+        self.config_key = config_key
+        self.account_id = account_id
+        # set khi worker báo "ready" qua hàng đợi sự kiện
+        self.ready = threading.Event()
+        self.profiler = _RemoteProfiler(self)
+        self._info = None
+        self._info_at = 0
+
+    def _mark_ready(self, info):
+        if info:
+            self._info = info
+            self._info_at = time.monotonic()
+        self.ready.set()
+
+    def _remote_info(self, refresh=False):
+        now = time.monotonic()
+        if refresh or self._info is None or now - self._info_at > self.INFO_TTL:
+            try:
+                self._info = self.handle.call("bot_info", self.bot_id) or self.UNREACHABLE_INFO
+            except Exception as e:
+                logger.error(f"Lỗi lấy thông tin bot {self.bot_id} từ {self.handle.worker_id}: {str(e)}")
+                self._info = self.UNREACHABLE_INFO
+            self._info_at = now
+        return self._info
+
+    def __getattr__(self, name):
+        if name in _RemoteBot.INFO_FIELDS:
+            return self._remote_info().get(name)
+        raise AttributeError(name)
+
+    def stop_symbol(self, symbol):
+        return self.handle.call("bot_call", self.bot_id, "stop_symbol", symbol)
+
+    def stop_all_symbols(self):
+        return self.handle.call("bot_call", self.bot_id, "stop_all_symbols")
+
+    def stop(self):
+        return self.handle.call("stop_bot", self.bot_id)
+
+class ShardedBotManager(BotManager):
+    """
+    Chế độ supervisor: bot chạy trong N worker process (mỗi worker 1 BotManager cục bộ, GIL riêng).
+    - Bot được gán worker bằng consistent hashing (symbol với bot static, bot_id với bot dynamic)
+      -> bot cùng symbol chung worker, chung WebSocket.
+    - Coin được giữ qua CoinReservationServer (lease TTL) do supervisor chạy -> độc quyền coin toàn cục,
+      worker chết thì coin tự nhả sau COIN_LEASE_TTL.
+    - Telegram và khôi phục bot vẫn ở supervisor như BotManager thường.
+    - StateStore / nhật ký giao dịch: supervisor và mọi worker mở chung file state_db / journal_db
+      (SQLite WAL + busy_timeout, mỗi process 1 kết nối); bot trong worker ghi trực tiếp.
+    Chỉ hỗ trợ đồng hồ thật (không chia sẻ VirtualClock giữa các process).
+    """
+    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None,
+                 runtime=None, metrics_port=None, profiling=False, cprofile_dir=None, cprofile_every=0,
+                 state_db=None, journal_db=None, coin_service=None, market_stream=False, confirm_timeframes=(),
+                 workers=2, accounts=None, coin_authkey=None):
+        runtime = runtime or get_runtime()
+        if runtime.clock is not time.time:
+            raise ValueError("ShardedBotManager chỉ hỗ trợ đồng hồ thật (time.time)")
+        # mặc định: Unix socket trong thư mục tạm riêng cho supervisor này (xóa khi shutdown)
+        self._coin_service_dir = None
+        if not coin_service:
+            self._coin_service_dir = tempfile.mkdtemp(prefix="trading_bot_")
+            coin_service = os.path.join(self._coin_service_dir, "coins.sock")
+        super().__init__(
+            api_key=api_key, api_secret=api_secret,
+            telegram_bot_token=telegram_bot_token, telegram_chat_id=telegram_chat_id,
+            runtime=runtime, metrics_port=metrics_port, profiling=profiling,
+            cprofile_dir=cprofile_dir, cprofile_every=cprofile_every,
+            state_db=state_db, journal_db=journal_db, coin_service=coin_service,
+            market_stream=market_stream, confirm_timeframes=confirm_timeframes, coin_authkey=coin_authkey
+        )
+        for account_id, keys in (accounts or {}).items():
+            self.add_account(account_id, keys["api_key"], keys["api_secret"])
+
+        self._shutting_down = False
+        self._ctx = multiprocessing.get_context("spawn")
+
+        settings = {
+            "runtime": {
+                "rest_base_url": self.runtime.rest_base_url,
+                "ws_base_url": self.runtime.ws_base_url,
+                "telegram_base_url": self.runtime.telegram_base_url,
+            },
+            "api_key": api_key,
+            "api_secret": api_secret,
+            "accounts": {
+                account_id: (account.api_key, account.api_secret)
+                for account_id, account in self.accounts.items()
+                if account_id != DEFAULT_ACCOUNT_ID
+            },
+            "profiling": profiling,
+            "cprofile_dir": cprofile_dir,
+            "cprofile_every": cprofile_every,
+            "state_db": state_db,
+            "journal_db": journal_db,
+            "coin_service": self.coin_service,
+            "coin_authkey": self.coin_authkey,
+            "market_stream": market_stream,
+            "confirm_timeframes": self.confirm_timeframes,
+        }
+        self.events = self._ctx.Queue()
+        self.workers = {}
+        for index in range(max(1, int(workers))):
+            worker_id = f"worker-{index}"
+            # mỗi worker 1 cổng /metrics riêng: metrics_port + 1 + index
+            worker_settings = dict(settings, metrics_port=(int(metrics_port) + 1 + index) if metrics_port else None)
+            self.workers[worker_id] = _WorkerHandle(worker_id, self._ctx, worker_settings, self.events)
+        self.ring = HashRing(self.workers)
+        self._bot_specs = {}        # {bot_id: (worker_id, args, kwargs)} để dựng lại khi worker chết
+        self._starting = {}         # {bot_id: _RemoteBot} đang chờ worker tạo (sự kiện ready có thể về trước)
+
+        threading.Thread(target=self._event_listener, daemon=True).start()
+        threading.Thread(target=self._monitor_workers, daemon=True).start()
+        self.log(f"🧩 Chế độ supervisor: {len(self.workers)} worker process", logging.INFO, event="sharding_started")
+
+    def _shard_key(self, bot_id, bot_mode, symbol):
+        return symbol.upper() if bot_mode == "static" and symbol else bot_id
+
+    def add_bot(self, symbol, lev, percent, tp, sl, roi_trigger, strategy_type, bot_count=1, **kwargs):
+        """Giống BotManager.add_bot nhưng tạo bot trong worker được chọn bằng consistent hashing"""
+        account_id = kwargs.get("account_id") or DEFAULT_ACCOUNT_ID
+        if account_id not in self.accounts:
+            self.log(f"❌ Chưa thiết lập API Key / Secret cho tài khoản '{account_id}'", logging.ERROR, event="config_error")
+            return False
+        if kwargs.get("verify_api", True) and not self._verify_api_connection(account_id):
+            self.log("❌ KHÔNG THỂ KẾT NỐI BINANCE - KHÔNG TẠO ĐƯỢC BOT", logging.ERROR, event="bot_create_failed")
+            return False
+
+        bot_mode = kwargs.get("bot_mode", "static")
+        bot_id = kwargs.get("bot_id") or self._new_bot_id(bot_mode, symbol, strategy_type)
+        if bot_id in self.bots:
+            self.log(f"⚠️ Bot {bot_id} đã tồn tại, bỏ qua.", event="bot_exists", bot_id=bot_id)
+            return False
+
+        worker_id = self.ring.node_for(self._shard_key(bot_id, bot_mode, symbol))
+        args = (symbol, lev, percent, tp, sl, roi_trigger, strategy_type, bot_count)
+        kwargs = dict(kwargs, bot_id=bot_id, account_id=account_id, verify_api=False)
+        return self._add_remote_bot(worker_id, bot_id, args, kwargs)
+
+    def _add_remote_bot(self, worker_id, bot_id, args, kwargs):
+        handle = self.workers[worker_id]
+        remote = _RemoteBot(handle, bot_id, kwargs.get("config_key"), kwargs["account_id"])
+        self._starting[bot_id] = remote
+        try:
+            ok = handle.call("add_bot", args, kwargs)
+            if ok:
+                self.bots[bot_id] = remote
+                self._bot_specs[bot_id] = (worker_id, args, kwargs)
+            return ok
+        except Exception as e:
+            self.log(f"❌ Lỗi tạo bot {bot_id} trên {worker_id}: {str(e)}", logging.ERROR, event="bot_create_failed", bot_id=bot_id)
+            return False
+        finally:
+            self._starting.pop(bot_id, None)
+
+    def stop_bot(self, bot_id):
+        ok = super().stop_bot(bot_id)
+        if ok:
+            self._bot_specs.pop(bot_id, None)
+        return ok
+
+    def _event_listener(self):
+        while self.running:
+            try:
+                event = self.events.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            kind, payload, extra = event
+            if kind == "notify" and self.notifier:
+                self.notifier.notify(payload, chat_id=extra)
+            elif kind == "ready":
+                bot = self._starting.get(payload) or self.bots.get(payload)
+                if isinstance(bot, _RemoteBot):
+                    bot._mark_ready(extra)
+
+    def _monitor_workers(self):
+        while self.running and not self._shutting_down:
+            time.sleep(SHARD_MONITOR_INTERVAL)
+            for worker_id, handle in self.workers.items():
+                if self._shutting_down or handle.is_alive():
+                    continue
+                self.log(
+                    f"❌ {worker_id} đã dừng (exit code {handle.process.exitcode}) – khởi động lại",
+                    logging.ERROR, event="worker_died"
+                )
+                self._respawn(worker_id)
+
+    def _respawn(self, worker_id):
+        """Khởi động lại worker và dựng lại bot của nó (kèm trạng thái symbol từ StateStore nếu có)"""
+        handle = self.workers[worker_id]
+        handle.start()
+        saved_symbols = {}
+        if self.state_store:
+            saved_symbols = {entry["bot_id"]: entry["symbols"] for entry in self.state_store.load_bots()}
+        for bot_id, (owner, args, kwargs) in list(self._bot_specs.items()):
+            if owner != worker_id:
+                continue
+            self.bots.pop(bot_id, None)
+            kwargs = dict(kwargs, restored_symbols=saved_symbols.get(bot_id), open_positions_snapshot=None)
+            self._add_remote_bot(worker_id, bot_id, args, kwargs)
+
+    def shutdown(self, timeout=10):
+        """Dừng worker process rồi các dịch vụ của supervisor (gọi sau stop_all khi thoát chương trình)"""
+        self._shutting_down = True
+        for handle in self.workers.values():
+            try:
+                if handle.is_alive():
+                    handle.call("shutdown", timeout=timeout)
+            except Exception as e:
+                logger.error(f"Lỗi dừng {handle.worker_id}: {str(e)}")
+            handle.process.join(timeout)
+            if handle.process.is_alive():
+                handle.process.terminate()
+        super().shutdown()
+        if self._coin_service_dir:
+            shutil.rmtree(self._coin_service_dir, ignore_errors=True)
+            self._coin_service_dir = None
+
+def start_trading_system(api_key, api_secret, telegram_bot_token=None, telegram_chat_id=None, runtime=None,
+                         metrics_port=None, profiling=False, state_db=None, journal_db=None, accounts=None,
+                         workers=0, coin_service=None, market_stream=False, confirm_timeframes=(), coin_authkey=None):
     """
     Khởi động hệ thống giao dịch hoàn chỉnh.
+    accounts: {account_id: {"api_key", "api_secret"}} – tài khoản phụ chạy chung process.
+    workers > 1: chế độ supervisor (ShardedBotManager) chạy bot trên nhiều process.
+    coin_service: địa chỉ dịch vụ giữ coin dùng chung giữa các process ('/path.sock' hoặc 'host:port').
+    coin_authkey: khóa dùng chung của dịch vụ giữ coin (bắt buộc với 'host:port').
+    market_stream: bật bảng giá toàn thị trường (1 WebSocket !miniTicker@arr + !markPrice@arr@1s).
+    confirm_timeframes: khung xác nhận tín hiệu 5m, vd ("15m", "1h"); khung lớn ngược chiều -> bỏ tín hiệu.
     Trả về instance BotManager để main.py dùng nếu cần.
     """
     try:
         logger.info("🚀 Đang khởi động Hệ thống RSI + Khối lượng...")
-        bot_manager = BotManager(
+        options = dict(
             api_key=api_key,
             api_secret=api_secret,
             telegram_bot_token=telegram_bot_token,
-            telegram_chat_id=telegram_chat_id
+            telegram_chat_id=telegram_chat_id,
+            runtime=runtime,
+            metrics_port=metrics_port,
+            profiling=profiling,
+            state_db=state_db,
+            journal_db=journal_db,
+            coin_service=coin_service,
+            coin_authkey=coin_authkey,
+            market_stream=market_stream,
+            confirm_timeframes=confirm_timeframes
         )
+        if workers and workers > 1:
+            bot_manager = ShardedBotManager(workers=workers, accounts=accounts, **options)
+        else:
+            bot_manager = BotManager(**options)
+            for account_id, keys in (accounts or {}).items():
+                bot_manager.add_account(account_id, keys["api_key"], keys["api_secret"])
+        bot_manager.restore_bots()
         logger.info("✅ Hệ thống đã khởi động thành công!")
         return bot_manager
     except Exception as e: